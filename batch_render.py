@@ -0,0 +1,28 @@
+import argparse
+import logging
+import sys
+
+from rendtools import batch
+
+parser = argparse.ArgumentParser()
+parser.add_argument('manifest', type=str)
+parser.add_argument('--out', dest='output_dir', type=str, required=True)
+parser.add_argument('--workers', dest='num_workers', type=int, default=4)
+parser.add_argument('--overwrite', action='store_true')
+parser.add_argument('--aovs', dest='save_aovs', action='store_true',
+                    help='Also save depth, normal and uv buffers as .npz.')
+parser.add_argument('--quiet', '-q', action='store_true',
+                    help='Only log warnings.')
+
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING if args.quiet
+                        else logging.INFO, format='%(message)s')
+    jobs = batch.load_manifest(args.manifest)
+    _, failed = batch.run_batch(jobs, args.output_dir,
+                                num_workers=args.num_workers,
+                                overwrite=args.overwrite,
+                                save_aovs=args.save_aovs)
+    if failed:
+        sys.exit(1)
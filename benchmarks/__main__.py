@@ -0,0 +1,48 @@
+import argparse
+import sys
+
+from . import suite
+
+parser = argparse.ArgumentParser(prog='python -m benchmarks')
+subparsers = parser.add_subparsers(dest='command')
+
+run_parser = subparsers.add_parser('run', help='Run benchmarks.')
+run_parser.add_argument('--out', dest='output_path', type=str,
+                        default='benchmark_results.json')
+run_parser.add_argument('--only', dest='names', type=str, nargs='+',
+                        choices=list(suite.BENCHMARKS))
+run_parser.add_argument('--quick', action='store_true',
+                        help='Only run the smallest size of each sweep.')
+run_parser.add_argument('--repeat', type=int, default=suite.DEFAULT_REPEAT)
+run_parser.add_argument('--workdir', type=str,
+                        help='Keep generated inputs here between runs.')
+
+compare_parser = subparsers.add_parser(
+    'compare', help='Compare results against a baseline.')
+compare_parser.add_argument('baseline', type=str)
+compare_parser.add_argument('current', type=str)
+compare_parser.add_argument('--threshold', type=float,
+                            default=suite.DEFAULT_THRESHOLD,
+                            help='Relative increase counted as regression.')
+
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    if args.command == 'run':
+        results = suite.run_suite(args.names, args.quick, args.repeat,
+                                  args.workdir)
+        suite.save_results(args.output_path, results)
+        print('Saved results to {}'.format(args.output_path))
+    elif args.command == 'compare':
+        changes, regressions = suite.compare(
+            suite.load_results(args.baseline),
+            suite.load_results(args.current), args.threshold)
+        for name, size, metric, old, new, change in changes:
+            print('{:<24} {:>8} {:<13} {:12.4g} -> {:12.4g} ({:+.1%}){}'.format(
+                name, size, metric, old, new, change,
+                '  REGRESSION' if change > args.threshold else ''))
+        print('{} regressions over {:.0%}.'.format(len(regressions),
+                                                   args.threshold))
+        sys.exit(1 if regressions else 0)
+    else:
+        parser.print_help()
@@ -0,0 +1,233 @@
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import numpy as np
+
+from . import synthetic
+
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.2
+
+
+def _obj_path(workdir, num_faces, num_segments=8):
+    path = os.path.join(workdir, 'mesh_{}_{}.obj'.format(num_faces,
+                                                         num_segments))
+    if not os.path.exists(path):
+        synthetic.write_obj(path, num_faces, num_segments)
+    return path
+
+
+def _pfm_path(workdir, resolution):
+    path = os.path.join(workdir, 'map_{}.pfm'.format(resolution))
+    if not os.path.exists(path):
+        synthetic.write_pfm(path, resolution, resolution)
+    return path
+
+
+def _read_obj(bulk):
+    def setup(num_faces, workdir):
+        from meshtools import wavefront
+        path = _obj_path(workdir, num_faces)
+        return lambda: wavefront.read_obj_file(path, bulk=bulk)
+    return setup
+
+
+def _expand(smooth):
+    def setup(num_faces, workdir):
+        from meshtools import wavefront
+        mesh = wavefront.read_obj_file(_obj_path(workdir, num_faces),
+                                       bulk=True)
+        return lambda: mesh.expand_segments('material', smooth=smooth)
+    return setup
+
+
+def _expand_face_vertices(num_faces, workdir):
+    from meshtools import wavefront
+    mesh = wavefront.read_obj_file(_obj_path(workdir, num_faces), bulk=True)
+    return lambda: (mesh.expand_face_vertices(), mesh.expand_face_normals(),
+                    mesh.expand_face_uvs())
+
+
+def _load_pfm(mmap):
+    def setup(resolution, workdir):
+        from svbrdf.io import load_pfm_texture
+        path = _pfm_path(workdir, resolution)
+        if mmap:
+            # Touch every page so the read is measured, not just the map.
+            return lambda: float(load_pfm_texture(path, mmap=True).sum())
+        return lambda: load_pfm_texture(path)
+    return setup
+
+
+def _transfer_color(resolution, workdir):
+    from svbrdf import transfer_color
+    source = synthetic.random_image(resolution, resolution, seed=1)
+    target = synthetic.random_image(resolution, resolution, seed=2) ** 2
+    return lambda: transfer_color(source, target)
+
+
+def _unproject(resolution, workdir):
+    from rendtools.camera import PerspectiveCamera
+    from rendtools.graphics_utils import unproject_depth_map
+    size = (resolution, resolution)
+    camera = PerspectiveCamera(size, 1.0, 10.0, 40.0, (0, 0, 5), (0, 0, 0),
+                               (0, 1, 0))
+    depth = synthetic.sphere_depth_map(resolution, resolution, 1.0, 10.0)
+    return lambda: unproject_depth_map(resolution, resolution,
+                                       camera.perspective_mat(),
+                                       camera.view_mat(), depth)
+
+
+def _build_bvh(num_faces, workdir):
+    from meshtools import wavefront
+    from meshtools.bvh import BVH
+    mesh = wavefront.read_obj_file(_obj_path(workdir, num_faces), bulk=True)
+    return lambda: BVH.from_mesh(mesh)
+
+
+def _intersect_bvh(num_rays, workdir):
+    from meshtools import wavefront
+    from meshtools.bvh import BVH
+    mesh = wavefront.read_obj_file(_obj_path(workdir, 100000), bulk=True)
+    bvh = BVH.from_mesh(mesh)
+    # Rays from one viewpoint through random points around the torus.
+    rng = np.random.RandomState(0)
+    origins = np.tile(np.array([0.0, 1.0, 3.0]), (num_rays, 1))
+    directions = rng.uniform(-1.3, 1.3, (num_rays, 3)) - origins
+    return lambda: bvh.intersect(origins, directions)
+
+
+# name: (setup(size, workdir) returning the function to time, size unit,
+#        sizes of the sweep).
+BENCHMARKS = OrderedDict([
+    ('read_obj_bulk', (_read_obj(True), 'faces',
+                       (10000, 100000, 1000000))),
+    ('read_obj', (_read_obj(False), 'faces', (10000, 100000))),
+    ('expand_segments', (_expand(False), 'faces',
+                         (10000, 100000, 1000000))),
+    ('expand_segments_smooth', (_expand(True), 'faces',
+                                (10000, 100000, 1000000))),
+    ('expand_face_attributes', (_expand_face_vertices, 'faces',
+                                (10000, 100000, 1000000))),
+    ('load_pfm', (_load_pfm(False), 'pixels/side', (512, 1024, 2048))),
+    ('load_pfm_mmap', (_load_pfm(True), 'pixels/side', (512, 1024, 2048))),
+    ('transfer_color', (_transfer_color, 'pixels/side', (256, 512, 1024))),
+    ('unproject', (_unproject, 'pixels/side', (512, 1024, 2048))),
+    ('build_bvh', (_build_bvh, 'faces', (10000, 100000, 1000000))),
+    ('intersect_bvh', (_intersect_bvh, 'rays', (10000, 100000, 1000000))),
+])
+
+
+def run_benchmark(name, size, workdir, repeat=DEFAULT_REPEAT):
+    """
+    Times one benchmark at one size. The function is run repeat times for
+    timing and once more under tracemalloc for its peak memory, which
+    covers NumPy allocations but not memory-mapped files.
+    :return: result dict.
+    """
+    setup, unit, _ = BENCHMARKS[name]
+    func = setup(size, workdir)
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'name': name,
+        'size': size,
+        'unit': unit,
+        'min_seconds': min(times),
+        'median_seconds': float(np.median(times)),
+        'peak_bytes': peak_bytes,
+    }
+
+
+def run_suite(names=None, quick=False, repeat=DEFAULT_REPEAT, workdir=None):
+    """
+    Runs benchmarks over their size sweeps. Synthetic inputs are generated
+    into workdir, a temporary directory by default.
+    :param names: benchmarks to run, all by default.
+    :param quick: if True, only run the smallest size of each sweep.
+    :return: dict with 'environment' info and a list of 'results'.
+    """
+    names = list(BENCHMARKS) if names is None else names
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError('Unknown benchmark {}.'.format(name))
+    tmpdir = tempfile.mkdtemp(prefix='svbrdf-bench-') \
+        if workdir is None else None
+    workdir = tmpdir or workdir
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    try:
+        for name in names:
+            sizes = BENCHMARKS[name][2]
+            for size in sizes[:1] if quick else sizes:
+                result = run_benchmark(name, size, workdir, repeat)
+                print('{:<24} {:>8} {:<12} {:9.4f}s {:9.1f} MB'.format(
+                    name, size, result['unit'], result['min_seconds'],
+                    result['peak_bytes'] / 2 ** 20))
+                results.append(result)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+
+
+def save_results(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+    Compares two run_suite results benchmark by benchmark.
+    :param threshold: relative increase of the minimum time or the peak
+                      memory counted as a regression.
+    :return: list of (name, size, metric, baseline value, current value,
+             relative change) for every metric of the benchmarks present in
+             both, and the subset of those that regressed.
+    """
+    def _index(results):
+        return {(r['name'], r['size']): r for r in results['results']}
+
+    baseline = _index(baseline)
+    changes, regressions = [], []
+    for key, result in _index(current).items():
+        if key not in baseline:
+            continue
+        for metric in ('min_seconds', 'peak_bytes'):
+            old, new = baseline[key][metric], result[metric]
+            change = (new - old) / old if old > 0 else 0.0
+            entry = (key[0], key[1], metric, old, new, change)
+            changes.append(entry)
+            if change > threshold:
+                regressions.append(entry)
+    return changes, regressions
@@ -0,0 +1,91 @@
+import numpy as np
+
+from svbrdf.io import save_pfm_texture
+
+
+def _grid_shape(num_faces):
+    num_quads = max(1, (num_faces + 1) // 2)
+    cols = int(np.ceil(np.sqrt(num_quads)))
+    rows = int(np.ceil(num_quads / cols))
+    return rows, cols
+
+
+def torus_mesh(num_faces, major_radius=1.0, minor_radius=0.3):
+    """
+    A triangulated torus with about num_faces faces, as OBJ-style arrays.
+    :return: (V, 3) positions, (V, 3) normals, (V, 2) uvs and (F, 3)
+             0-based vertex indices, shared by all three attributes.
+    """
+    rows, cols = _grid_shape(num_faces)
+    u = np.linspace(0, 1, cols + 1)
+    v = np.linspace(0, 1, rows + 1)
+    uu, vv = np.meshgrid(u, v)
+    theta = uu.ravel() * 2 * np.pi
+    phi = vv.ravel() * 2 * np.pi
+    normals = np.stack((np.cos(phi) * np.cos(theta),
+                        np.sin(phi),
+                        np.cos(phi) * np.sin(theta)), axis=1)
+    centers = np.stack((np.cos(theta), np.zeros_like(theta),
+                        np.sin(theta)), axis=1) * major_radius
+    positions = centers + minor_radius * normals
+    uvs = np.stack((uu.ravel(), vv.ravel()), axis=1)
+
+    corner = (np.arange(rows)[:, None] * (cols + 1)
+              + np.arange(cols)[None, :]).ravel()
+    quads = np.stack((corner, corner + 1, corner + cols + 2,
+                      corner + cols + 1), axis=1)
+    # Both triangles of a quad are adjacent, so segments are contiguous.
+    faces = np.stack((quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]),
+                     axis=1).reshape(-1, 3)
+    return positions, normals, uvs, faces[:num_faces]
+
+
+def write_obj(path, num_faces, num_segments=1):
+    """
+    Writes a torus with about num_faces faces to an OBJ file, with its faces
+    split evenly into num_segments materials named 'segment_<i>'.
+    """
+    positions, normals, uvs, faces = torus_mesh(num_faces)
+    corners = np.repeat(faces + 1, 3, axis=1)
+    bounds = np.linspace(0, len(faces), num_segments + 1).astype(np.int64)
+    with open(path, 'w') as f:
+        np.savetxt(f, positions, fmt='v %.6f %.6f %.6f')
+        np.savetxt(f, uvs, fmt='vt %.6f %.6f')
+        np.savetxt(f, normals, fmt='vn %.6f %.6f %.6f')
+        for i in range(num_segments):
+            f.write('usemtl segment_{}\n'.format(i))
+            np.savetxt(f, corners[bounds[i]:bounds[i + 1]],
+                       fmt='f %d/%d/%d %d/%d/%d %d/%d/%d')
+    return path
+
+
+def random_image(width, height, channels=3, seed=0):
+    """
+    :return: (height, width, channels) float32 image of uniform noise in
+             [0, 1).
+    """
+    rng = np.random.RandomState(seed)
+    return rng.random_sample((height, width, channels)).astype(np.float32)
+
+
+def write_pfm(path, width, height, channels=3, seed=0):
+    """
+    Writes a random float32 map to a PFM file, see random_image.
+    """
+    save_pfm_texture(path, random_image(width, height, channels, seed))
+    return path
+
+
+def sphere_depth_map(width, height, near=1.0, far=10.0):
+    """
+    Window depth of a sphere filling the middle of the image, 1 (background)
+    elsewhere, for unprojection benchmarks.
+    """
+    x = (np.arange(width) + 0.5) / width * 2 - 1
+    y = (np.arange(height) + 0.5) / height * 2 - 1
+    r2 = x[None, :] ** 2 + y[:, None] ** 2
+    inside = r2 < 0.81
+    eye_z = 5.0 - np.sqrt(np.maximum(0.81 - r2, 0))
+    ndc_z = ((far + near) / (far - near)
+             - 2 * far * near / ((far - near) * eye_z))
+    return np.where(inside, ndc_z * 0.5 + 0.5, 1.0).astype(np.float32)
@@ -1,11 +1,15 @@
 import numpy as np
-from numpy import linalg
 import argparse
+import os
+import logging
 from vispy import app, gloo
-from vispy.gloo import gl
+import proftools
 from meshtools import wavefront
+from meshtools.bvh import bvh_path, get_bvh
+from meshtools.lod import get_lod_chain
 from rendtools import (Renderer, Light, SVBRDFMaterial, Renderable,
                        ArcballCamera)
+from rendtools.lod import LODSet, bounding_sphere
 from svbrdf import SVBRDF
 
 app.use_app('glfw')
@@ -13,13 +17,27 @@ app.use_app('glfw')
 parser = argparse.ArgumentParser()
 parser.add_argument('--brdf', dest='brdf_path', type=str, required=True)
 parser.add_argument('--obj', dest='obj_path', type=str, required=True)
+parser.add_argument('--verbose', '-v', action='store_true')
+parser.add_argument('--trace', dest='trace_path', type=str,
+                    help='Write a Chrome trace of load and draw spans here.')
+parser.add_argument('--lod', action='store_true',
+                    help='Draw the mesh at a level of detail suiting its '
+                         'size on screen.')
+parser.add_argument('--compact', action='store_true',
+                    help='Keep the SVBRDF maps as half floats with an '
+                         'octahedral-encoded normal map.')
+parser.add_argument('--pick', action='store_true',
+                    help='Log the face under the mouse, using a BVH stored '
+                         'next to the mesh.')
 
 args = parser.parse_args()
 
 np.set_printoptions(suppress=True)
 
+logger = logging.getLogger(__name__)
+
 class MyRenderer(Renderer):
-    def __init__(self, svbrdf, mesh, camera, size):
+    def __init__(self, svbrdf, mesh, camera, size, lod_chain=None):
         super().__init__(size, 0, 1000, camera, show=True)
 
         gloo.set_state(depth_test=True)
@@ -31,64 +49,76 @@ class MyRenderer(Renderer):
                 Light((0, 100, 10), 2000),
                 ]
 
+        material = SVBRDFMaterial(svbrdf)
+        levels = [mesh] if lod_chain is None else lod_chain.levels
+        renderables = [self._create_renderable(level, material)
+                       for level in levels]
+        self.renderables = renderables[:1]
+        self.lod_set = None
+        if lod_chain is not None:
+            self.lod_set = LODSet(renderables, lod_chain.errors,
+                                  *bounding_sphere(mesh.vertices))
+
+    def _create_renderable(self, mesh, material):
         vertex_positions = mesh.expand_face_vertices()
         vertex_normals = mesh.expand_face_normals()
         vertex_tangents, vertex_bitangents = mesh.expand_tangents()
         vertex_uvs = mesh.expand_face_uvs()
 
-        material = SVBRDFMaterial(svbrdf)
-        self.renderables = [Renderable(material, {
+        return Renderable(material, {
             'a_position': vertex_positions,
             'a_normal': vertex_normals,
             'a_tangent': vertex_tangents,
             'a_bitangent': vertex_bitangents,
             'a_uv': vertex_uvs,
-            }, len(self.lights))]
+            }, len(self.lights))
 
     def update_uniforms(self):
-        self.program['cam_pos'] = linalg.inv(self.camera.view_mat())[:3, 3]
-        self.program['u_view_mat'] = self.camera.view_mat().T
-        self.program['u_model_mat'] = np.eye(4)
-        self.program['u_perspective_mat'] = self.camera.perspective_mat().T
-
-        for i, light in enumerate(self.lights):
-            self.program['light_position[{}]'.format(i)] = light.position
-            self.program['light_intensity[{}]'.format(i)] = light.intensity
-            self.program['light_color[{}]'.format(i)] = light.color
+        self.upload_scene_uniforms(self.program, self.lights)
 
     def draw(self):
         gloo.clear(color=(1, 1, 1))
+        if self.lod_set is not None:
+            self.renderables = [self.lod_set.select(self.camera,
+                                                    self.size[1])]
         for renderable in self.renderables:
-            self.program = renderable.program
+            self.program = renderable.bind()
             self.update_uniforms()
-            self.program.draw(gl.GL_TRIANGLES)
+            renderable.draw()
+
+    def on_mouse_move(self, event):
+        last_picked = self.picked
+        super().on_mouse_move(event)
+        if self.picked is not None and (
+                last_picked is None or self.picked[0] != last_picked[0]):
+            logger.info('Picked face %d at %s', *self.picked)
 
     def on_key_press(self, event):
         super().on_key_press(event)
         if event.key == '=':
-            print('(+) UV scale.')
+            logger.info('(+) UV scale.')
             for renderable in self.renderables:
-                if 'a_uv' in renderable.attributes:
-                    renderable.attributes['a_uv'] *= 2
-                    renderable.update()
+                renderable.uv_scale *= 2
             self.draw()
         elif event.key == '-':
-            print('(-) UV scale.')
+            logger.info('(-) UV scale.')
             for renderable in self.renderables:
-                if 'a_uv' in renderable.attributes:
-                    renderable.attributes['a_uv'] /= 2
-                    renderable.update()
+                renderable.uv_scale /= 2
             self.draw()
         self.update()
 
 
 if __name__=='__main__':
-    print('Loading mesh {}'.format(args.obj_path))
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING)
+    if args.trace_path is not None:
+        proftools.enable()
+    logger.info('Loading mesh %s', args.obj_path)
     mesh = wavefront.read_obj_file(args.obj_path)
     mesh.resize(100)
-    print('Mesh bounding size is {}'.format(mesh.bounding_size()))
-    print('Loading BRDF {}'.format(args.brdf_path))
-    brdf = SVBRDF(args.brdf_path)
+    logger.info('Mesh bounding size is %s', mesh.bounding_size())
+    logger.info('Loading BRDF %s', args.brdf_path)
+    brdf = SVBRDF(args.brdf_path, compact=args.compact)
 
     camera = ArcballCamera(
             size=(1280, 800), fov=75, near=10, far=1000.0,
@@ -96,5 +126,19 @@ if __name__=='__main__':
             lookat=(0.0, 0.0, -0.0),
             up=(0.0, 1.0, 0.0))
 
-    canvas = MyRenderer(brdf, mesh, camera, size=(1280, 800))
+    lod_chain = None
+    if args.lod:
+        lod_chain = get_lod_chain(
+            mesh, os.path.splitext(args.obj_path)[0] + '_lod')
+        logger.info('LOD chain: %s faces',
+                    ', '.join(str(level.num_faces) for level in lod_chain))
+
+    canvas = MyRenderer(brdf, mesh, camera, size=(1280, 800),
+                        lod_chain=lod_chain)
+    if args.pick:
+        canvas.bvh = get_bvh(mesh, bvh_path(args.obj_path))
     app.run()
+
+    if args.trace_path is not None:
+        proftools.write_chrome_trace(args.trace_path)
+        print(proftools.summary())
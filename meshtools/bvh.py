@@ -0,0 +1,475 @@
+import hashlib
+import logging
+import os
+import uuid
+
+import numpy as np
+
+from proftools import count, traced
+
+logger = logging.getLogger(__name__)
+
+BVH_VERSION = 1
+DEFAULT_NUM_BINS = 16
+# Nodes with at most this many triangles become leaves.
+DEFAULT_LEAF_SIZE = 4
+# Nodes with more triangles are split at the median when no binned split
+# pays off, e.g. when their centroids coincide.
+DEFAULT_MAX_LEAF_SIZE = 32
+# Rays traced at once, bounding the memory of the traversal front.
+DEFAULT_RAY_CHUNK_SIZE = 65536
+# Cost of visiting a node relative to intersecting a triangle in the SAH.
+_TRAVERSAL_COST = 1.0
+# Slack of the barycentric test, so rays through an edge shared by two
+# triangles hit at least one of them despite float32 rounding.
+_EDGE_TOLERANCE = 1e-6
+# Bins evaluated at once while building, bounding the memory of levels
+# with many nodes.
+_MAX_BINS = 2 ** 20
+# Padding of node boxes during traversal, relative to the scene size.
+_BOX_PADDING = 1e-6
+_ARRAY_NAMES = ('node_min', 'node_max', 'node_start', 'node_count',
+                'node_child', 'order', 'v0', 'e1', 'e2')
+
+
+def _cross(a, b):
+    return np.stack((a[:, 1] * b[:, 2] - a[:, 2] * b[:, 1],
+                     a[:, 2] * b[:, 0] - a[:, 0] * b[:, 2],
+                     a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]), axis=1)
+
+
+def _dot(a, b):
+    return np.einsum('ij,ij->i', a, b)
+
+
+def _box_area(box_min, box_max):
+    """
+    :return: surface areas of boxes with their coordinates along the first
+             axis of box_min and box_max, 0 for empty boxes.
+    """
+    x, y, z = np.maximum(box_max - box_min, 0)
+    return 2 * (x * y + y * z + z * x)
+
+
+def _segment_ids(counts):
+    """
+    :return: the segment id of every element of consecutive segments with
+             the given counts, and the offset of each segment.
+    """
+    offsets = np.cumsum(counts) - counts
+    return np.repeat(np.arange(len(counts)), counts), offsets
+
+
+def geometry_digest(vertices, faces):
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(vertices, dtype=np.float32).data)
+    digest.update(np.ascontiguousarray(faces, dtype=np.int64).data)
+    return digest.hexdigest()
+
+
+class BVH:
+    """
+    Bounding volume hierarchy over the triangles of a mesh for batched ray
+    queries. Nodes are stored as flat arrays: the triangles of node i are
+    order[node_start[i]:node_start[i] + node_count[i]], and its children
+    are node_child[i] and node_child[i] + 1, or node_child[i] is -1 for
+    leaves. Triangles are kept as a vertex and two edges in BVH order.
+    """
+
+    def __init__(self, node_min, node_max, node_start, node_count,
+                 node_child, order, v0, e1, e2, digest=None):
+        self.node_min = node_min
+        self.node_max = node_max
+        self.node_start = node_start
+        self.node_count = node_count
+        self.node_child = node_child
+        self.order = order
+        self.v0 = v0
+        self.e1 = e1
+        self.e2 = e2
+        # geometry_digest of the mesh the BVH was built for.
+        self.digest = digest
+        self._bounds = None
+
+    def _axis_bounds(self):
+        """
+        :return: (3, 2, num_nodes) float32 node bounds, minimum and maximum
+                 per axis.
+        """
+        if self._bounds is None:
+            # Boxes are padded so rays grazing or lying in a box face, e.g.
+            # parallel to an axis through a row of vertices, still enter.
+            scale = np.max(np.abs(np.concatenate(
+                (self.node_min[:1], self.node_max[:1]))))
+            pad = np.float32(_BOX_PADDING * max(scale, 1e-30))
+            self._bounds = np.ascontiguousarray(np.stack(
+                (self.node_min - pad, self.node_max + pad),
+                axis=0).transpose(2, 0, 1), dtype=np.float32)
+        return self._bounds
+
+    @property
+    def num_nodes(self):
+        return len(self.node_child)
+
+    @property
+    def num_triangles(self):
+        return len(self.order)
+
+    @classmethod
+    def from_mesh(cls, mesh, **kwargs):
+        """
+        :param kwargs: see build_bvh.
+        """
+        return build_bvh(mesh.vertices, mesh.face_vertices, **kwargs)
+
+    def save(self, path):
+        """
+        Writes the BVH to an .npz file, replacing it atomically.
+        """
+        tmp_path = '{}.tmp-{}'.format(path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, version=BVH_VERSION, digest=self.digest or '',
+                     **{name: getattr(self, name) for name in _ARRAY_NAMES})
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a BVH written by save.
+        :return: the BVH, or None if the file is from another version.
+        """
+        with np.load(path) as data:
+            if int(data['version']) != BVH_VERSION:
+                return None
+            return cls(*(data[name] for name in _ARRAY_NAMES),
+                       digest=str(data['digest']) or None)
+
+    def intersect(self, origins, directions, t_min=0.0, t_max=np.inf,
+                  chunk_size=DEFAULT_RAY_CHUNK_SIZE):
+        """
+        Finds the closest triangle hit by each ray.
+        :param origins: (N, 3) ray origins.
+        :param directions: (N, 3) ray directions, not necessarily unit
+                           length; t is measured in their lengths.
+        :param t_min: scalar or (N,) start of the rays.
+        :param t_max: scalar or (N,) end of the rays.
+        :return: (N,) float32 ray parameters of the hits, inf for misses,
+                 (N,) int64 face indices, -1 for misses, and (N, 2) float32
+                 barycentric coordinates of the hits relative to corners 1
+                 and 2.
+        """
+        return self._trace(origins, directions, t_min, t_max, chunk_size,
+                           any_hit=False)
+
+    def occluded(self, origins, directions, t_min=0.0, t_max=np.inf,
+                 chunk_size=DEFAULT_RAY_CHUNK_SIZE):
+        """
+        Tests whether rays hit any triangle, e.g. for shadow rays, stopping
+        at the first hit found.
+        :return: (N,) bool array.
+        """
+        _, faces, _ = self._trace(origins, directions, t_min, t_max,
+                                  chunk_size, any_hit=True)
+        return faces >= 0
+
+    @traced('BVH.trace')
+    def _trace(self, origins, directions, t_min, t_max, chunk_size, any_hit):
+        origins = np.asarray(origins, dtype=np.float32).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float32).reshape(-1, 3)
+        num_rays = len(origins)
+        t_min = np.broadcast_to(np.asarray(t_min, dtype=np.float32),
+                                (num_rays,))
+        t_max = np.broadcast_to(np.asarray(t_max, dtype=np.float32),
+                                (num_rays,))
+        hit_t = np.full(num_rays, np.inf, dtype=np.float32)
+        hit_faces = np.full(num_rays, -1, dtype=np.int64)
+        hit_uvs = np.zeros((num_rays, 2), dtype=np.float32)
+        if self.num_triangles == 0:
+            return hit_t, hit_faces, hit_uvs
+        for start in range(0, num_rays, chunk_size):
+            rays = slice(start, min(start + chunk_size, num_rays))
+            self._trace_chunk(origins[rays], directions[rays],
+                              t_min[rays], t_max[rays].copy(), any_hit,
+                              hit_t[rays], hit_faces[rays], hit_uvs[rays])
+        count('rays_traced', num_rays)
+        return hit_t, hit_faces, hit_uvs
+
+    def _trace_chunk(self, origins, directions, t_min, best_t, any_hit,
+                     hit_t, hit_faces, hit_uvs):
+        """
+        Traverses the tree breadth first with a front of (ray, node) pairs.
+        Pairs are culled against the closest hit found so far, and for any
+        hit queries rays leave the front at their first hit.
+        """
+        # Zero components would make 0 * inf in the slab test.
+        safe = np.where(np.abs(directions) < 1e-30,
+                        np.copysign(np.float32(1e-30), directions),
+                        directions)
+        # Per axis rows, so the slab test gathers contiguous 1D arrays.
+        axis_origins = np.ascontiguousarray(origins.T)
+        axis_inv_directions = np.ascontiguousarray((1 / safe).T)
+        axis_bounds = self._axis_bounds()
+        found = np.zeros(len(origins), dtype=bool)
+        ray_ids = np.arange(len(origins), dtype=np.int32)
+        nodes = np.zeros(len(origins), dtype=np.int32)
+        while len(ray_ids) > 0:
+            t_near = t_min[ray_ids]
+            t_far = best_t[ray_ids]
+            for axis in range(3):
+                ray_origins = axis_origins[axis].take(ray_ids)
+                inv_directions = axis_inv_directions[axis].take(ray_ids)
+                t1 = axis_bounds[axis, 0].take(nodes) - ray_origins
+                t1 *= inv_directions
+                t2 = axis_bounds[axis, 1].take(nodes) - ray_origins
+                t2 *= inv_directions
+                np.maximum(t_near, np.minimum(t1, t2), out=t_near)
+                np.minimum(t_far, np.maximum(t1, t2), out=t_far)
+            keep = t_near <= t_far
+            if any_hit:
+                keep &= ~found[ray_ids]
+            ray_ids, nodes = ray_ids[keep], nodes[keep]
+            children = self.node_child[nodes]
+            leaf = children < 0
+
+            leaf_rays, leaf_nodes = ray_ids[leaf], nodes[leaf]
+            counts = self.node_count[leaf_nodes]
+            pair_ids, offsets = _segment_ids(counts)
+            pair_rays = leaf_rays[pair_ids]
+            slots = (self.node_start[leaf_nodes][pair_ids]
+                     + np.arange(len(pair_ids)) - offsets[pair_ids])
+            self._intersect_pairs(origins, directions, t_min, best_t,
+                                  pair_rays, slots, found, hit_faces,
+                                  hit_uvs)
+
+            inner_rays = ray_ids[~leaf]
+            inner_children = children[~leaf].astype(np.int32)
+            ray_ids = np.concatenate((inner_rays, inner_rays))
+            nodes = np.concatenate((inner_children, inner_children + 1))
+        hit_t[found] = best_t[found]
+
+    def _intersect_pairs(self, origins, directions, t_min, best_t,
+                         pair_rays, slots, found, hit_faces, hit_uvs):
+        """
+        Moller-Trumbore intersection of (ray, triangle slot) pairs, keeping
+        the closest hit of every ray in best_t, hit_faces and hit_uvs.
+        """
+        if len(pair_rays) == 0:
+            return
+        d = directions[pair_rays]
+        e1 = self.e1[slots]
+        e2 = self.e2[slots]
+        p = _cross(d, e2)
+        det = _dot(e1, p)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_det = 1 / det
+            s = origins[pair_rays] - self.v0[slots]
+            u = _dot(s, p) * inv_det
+            q = _cross(s, e1)
+            v = _dot(d, q) * inv_det
+            t = _dot(e2, q) * inv_det
+            hit = ((det != 0) & (u >= -_EDGE_TOLERANCE)
+                   & (v >= -_EDGE_TOLERANCE)
+                   & (u + v <= 1 + _EDGE_TOLERANCE)
+                   & (t >= t_min[pair_rays]) & (t <= best_t[pair_rays]))
+        pair_rays, slots = pair_rays[hit], slots[hit]
+        t, u, v = t[hit], u[hit], v[hit]
+        np.minimum.at(best_t, pair_rays, t)
+        closest = t == best_t[pair_rays]
+        pair_rays, slots = pair_rays[closest], slots[closest]
+        found[pair_rays] = True
+        hit_faces[pair_rays] = self.order[slots]
+        hit_uvs[pair_rays] = np.stack((u[closest], v[closest]), axis=1)
+
+
+def _binned_splits(prim_min, prim_max, centroids, segments, counts, cmin,
+                   cmax, num_bins):
+    """
+    Finds the binned SAH split of nodes with consecutive triangle segments.
+    Centroids are binned along every axis, and the cost of splitting after
+    each bin comes from prefix and suffix bounds of the bins.
+    :param segments: (P,) node of each triangle, from 0.
+    :param counts: (N,) triangles per node.
+    :param cmin: (N, 3) minimum of the centroids of each node.
+    :param cmax: (N, 3) maximum of the centroids of each node.
+    :return: (P, 3) bin of each triangle along each axis, and the axis, last
+             bin of the left child and SAH cost (inf if no split separates
+             the triangles) of the best split of each node.
+    """
+    # Small nodes need fewer bins.
+    num_bins = int(min(num_bins, max(2, counts.max())))
+    num_nodes = len(counts)
+    extent = cmax - cmin
+    scale = num_bins / np.where(extent > 0, extent, np.inf)
+    bins = ((centroids - cmin[segments]) * scale[segments]).astype(np.int64)
+    np.minimum(bins, num_bins - 1, out=bins)
+    # Bin-major keys, so prefix and suffix bounds accumulate whole rows.
+    keys = ((bins * num_nodes + segments[:, None]) * 3
+            + np.arange(3)).ravel()
+    num_keys = num_bins * num_nodes * 3
+    bin_counts = np.bincount(keys, minlength=num_keys)
+    bin_min = np.full((3, num_keys), np.inf, dtype=np.float32)
+    bin_max = np.full((3, num_keys), -np.inf, dtype=np.float32)
+    # One component at a time, as ufunc.at is much faster on 1D arrays.
+    for component in range(3):
+        np.minimum.at(bin_min[component], keys,
+                      np.repeat(prim_min[:, component], 3))
+        np.maximum.at(bin_max[component], keys,
+                      np.repeat(prim_max[:, component], 3))
+    shape = (num_bins, num_nodes, 3)
+    bin_counts = bin_counts.reshape(shape)
+    bin_min = bin_min.reshape((3,) + shape)
+    bin_max = bin_max.reshape((3,) + shape)
+
+    left_counts = np.cumsum(bin_counts, axis=0)[:-1]
+    right_counts = counts[None, :, None] - left_counts
+    left_area = _box_area(np.minimum.accumulate(bin_min, axis=1),
+                          np.maximum.accumulate(bin_max, axis=1))
+    right_area = _box_area(
+        np.minimum.accumulate(bin_min[:, ::-1], axis=1)[:, ::-1],
+        np.maximum.accumulate(bin_max[:, ::-1], axis=1)[:, ::-1])
+    costs = left_counts * left_area[:-1] + right_counts * right_area[1:]
+    costs[(left_counts == 0) | (right_counts == 0)] = np.inf
+    costs = costs.transpose(1, 2, 0).reshape(num_nodes, -1)
+    best = np.argmin(costs, axis=1)
+    split_axis, split_bin = np.divmod(best, num_bins - 1)
+    return bins, split_axis, split_bin, costs[np.arange(num_nodes), best]
+
+
+@traced('build_bvh')
+def build_bvh(vertices, faces, num_bins=DEFAULT_NUM_BINS,
+              leaf_size=DEFAULT_LEAF_SIZE,
+              max_leaf_size=DEFAULT_MAX_LEAF_SIZE):
+    """
+    Builds a BVH over triangles with binned surface area heuristic splits.
+    All nodes of a level are split at once, see _binned_splits, and their
+    triangles are partitioned in place within each node's range.
+    :param vertices: (V, 3) vertex positions.
+    :param faces: (F, 3) vertex indices of the triangles.
+    :param num_bins: candidate split planes per axis and node.
+    :return: BVH.
+    """
+    vertices = np.asarray(vertices, dtype=np.float32)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    corners = vertices[faces]
+    prim_min = corners.min(axis=1)
+    prim_max = corners.max(axis=1)
+    centroids = (prim_min + prim_max) / 2
+    num_faces = len(faces)
+
+    max_nodes = max(1, 2 * num_faces - 1)
+    node_min = np.zeros((max_nodes, 3), dtype=np.float32)
+    node_max = np.zeros((max_nodes, 3), dtype=np.float32)
+    node_start = np.zeros(max_nodes, dtype=np.int64)
+    node_count = np.zeros(max_nodes, dtype=np.int64)
+    node_child = np.full(max_nodes, -1, dtype=np.int64)
+    node_count[0] = num_faces
+    order = np.arange(num_faces)
+    num_nodes = 1
+    active = np.zeros(1 if num_faces > 0 else 0, dtype=np.int64)
+
+    while len(active) > 0:
+        # Triangles of the active nodes, which have increasing disjoint
+        # ranges.
+        starts, counts = node_start[active], node_count[active]
+        segments, offsets = _segment_ids(counts)
+        positions = (starts[segments] + np.arange(len(segments))
+                     - offsets[segments])
+        prims = order[positions]
+        node_min[active] = np.minimum.reduceat(prim_min[prims], offsets)
+        node_max[active] = np.maximum.reduceat(prim_max[prims], offsets)
+        cmin = np.minimum.reduceat(centroids[prims], offsets)
+        cmax = np.maximum.reduceat(centroids[prims], offsets)
+
+        # Split candidates, for chunks of nodes so the bins of deep levels
+        # with many small nodes take bounded memory.
+        num_active = len(active)
+        bins = np.empty((len(prims), 3), dtype=np.int64)
+        split_axis = np.empty(num_active, dtype=np.int64)
+        split_bin = np.empty(num_active, dtype=np.int64)
+        best_cost = np.empty(num_active)
+        chunk_size = max(1, _MAX_BINS // (3 * num_bins))
+        for first in range(0, num_active, chunk_size):
+            nodes = slice(first, min(first + chunk_size, num_active))
+            last = nodes.stop - 1
+            chunk_prims = slice(offsets[first], offsets[last] + counts[last])
+            chunk = prims[chunk_prims]
+            (bins[chunk_prims], split_axis[nodes], split_bin[nodes],
+             best_cost[nodes]) = _binned_splits(
+                prim_min[chunk], prim_max[chunk], centroids[chunk],
+                segments[chunk_prims] - first, counts[nodes], cmin[nodes],
+                cmax[nodes], num_bins)
+        area = _box_area(node_min[active].T, node_max[active].T)
+        use_sah = (np.isfinite(best_cost)
+                   & (_TRAVERSAL_COST * area + best_cost < counts * area))
+        split = (counts > leaf_size) & (use_sah | (counts > max_leaf_size))
+        if not np.any(split):
+            break
+
+        # Partition the triangles of split nodes, left ones first.
+        rank = np.arange(len(segments)) - offsets[segments]
+        goes_left = np.where(
+            use_sah[segments],
+            bins[np.arange(len(segments)), split_axis[segments]]
+            <= split_bin[segments],
+            rank < counts[segments] // 2)
+        left_before = np.cumsum(goes_left) - goes_left
+        right_before = np.arange(len(segments)) - left_before
+        num_left = np.add.reduceat(goes_left.astype(np.int64), offsets)
+        left_rank = left_before - left_before[offsets][segments]
+        right_rank = right_before - right_before[offsets][segments]
+        new_positions = starts[segments] + np.where(
+            goes_left, left_rank, num_left[segments] + right_rank)
+        moved = split[segments]
+        order[new_positions[moved]] = prims[moved]
+
+        split_nodes = active[split]
+        children = num_nodes + 2 * np.arange(len(split_nodes))
+        node_child[split_nodes] = children
+        node_start[children] = starts[split]
+        node_count[children] = num_left[split]
+        node_start[children + 1] = starts[split] + num_left[split]
+        node_count[children + 1] = counts[split] - num_left[split]
+        num_nodes += 2 * len(split_nodes)
+        active = np.stack((children, children + 1), axis=1).ravel()
+
+    ordered = corners[order]
+    return BVH(node_min[:num_nodes], node_max[:num_nodes],
+               node_start[:num_nodes], node_count[:num_nodes],
+               node_child[:num_nodes], order, ordered[:, 0],
+               ordered[:, 1] - ordered[:, 0], ordered[:, 2] - ordered[:, 0],
+               digest=geometry_digest(vertices, faces))
+
+
+def bvh_path(mesh_path):
+    """
+    :return: the path of the BVH stored next to a mesh file.
+    """
+    return os.path.splitext(mesh_path)[0] + '.bvh.npz'
+
+
+def get_bvh(mesh, path=None, **kwargs):
+    """
+    Loads the BVH of mesh from path if it was built for the same geometry,
+    or builds it and stores it there.
+    :param path: .npz file, e.g. bvh_path of the mesh file. Without it the
+                 BVH is just built.
+    :param kwargs: see build_bvh.
+    """
+    if path is not None:
+        try:
+            bvh = BVH.load(path)
+        except (OSError, ValueError, KeyError):
+            bvh = None
+        if bvh is not None and bvh.digest == geometry_digest(
+                mesh.vertices, mesh.face_vertices):
+            logger.debug('Loaded BVH %s', path)
+            return bvh
+    bvh = BVH.from_mesh(mesh, **kwargs)
+    logger.info('Built BVH with %d nodes over %d triangles', bvh.num_nodes,
+                bvh.num_triangles)
+    if path is not None:
+        try:
+            bvh.save(path)
+        except OSError:
+            logger.warning('Could not write BVH to %s', path)
+    return bvh
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+from meshtools.mesh import Material, Mesh
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 8 * 1024 ** 3
+
+_HASH_BLOCK_SIZE = 16 * 1024 * 1024
+_META_FNAME = 'meta.json'
+_KEYS_DIRNAME = 'keys'
+_ENTRIES_DIRNAME = 'entries'
+_ARRAY_NAMES = (
+    'vertices', 'normals', 'uvs',
+    'face_vertices', 'face_normals', 'face_uvs',
+    'face_materials', 'face_groups', 'face_objects',
+)
+
+
+def hash_file(path):
+    """
+    Computes the SHA-256 digest of a file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(_HASH_BLOCK_SIZE)
+            if len(block) == 0:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _atomic_write(path, data):
+    tmp_path = '{}.tmp-{}'.format(path, uuid.uuid4().hex)
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _dir_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path)
+               if entry.is_file())
+
+
+class MeshCache:
+    """
+    On-disk cache of parsed meshes.
+
+    Each entry is a directory of .npy arrays plus a JSON table of material,
+    group and object names, so warm loads memory-map the arrays instead of
+    parsing. Entries are named by the content hash of the OBJ file; a small
+    key file per (path, size, mtime) points at the entry so unchanged files
+    are not rehashed. Entries are written to a temporary directory and
+    renamed into place, so concurrent writers never expose partial entries.
+    The least recently used entries are evicted once the cache grows past
+    max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._keys_dir = os.path.join(cache_dir, _KEYS_DIRNAME)
+        self._entries_dir = os.path.join(cache_dir, _ENTRIES_DIRNAME)
+        os.makedirs(self._keys_dir, exist_ok=True)
+        os.makedirs(self._entries_dir, exist_ok=True)
+
+    def _key_path(self, path):
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        key = '{}|{}|{}'.format(path, stat.st_size, stat.st_mtime_ns)
+        return os.path.join(self._keys_dir,
+                            hashlib.sha1(key.encode()).hexdigest())
+
+    def _entry_path(self, digest):
+        return os.path.join(self._entries_dir, digest)
+
+    def _content_digest(self, path):
+        key_path = self._key_path(path)
+        try:
+            with open(key_path, 'r') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            pass
+        digest = hash_file(path)
+        _atomic_write(key_path, digest)
+        return digest
+
+    def load(self, path):
+        """
+        Loads a cached mesh for the OBJ file at path.
+        :return: the Mesh with memory-mapped arrays, or None on a miss.
+        """
+        digest = self._content_digest(path)
+        entry_path = self._entry_path(digest)
+        try:
+            with open(os.path.join(entry_path, _META_FNAME), 'r') as f:
+                meta = json.load(f)
+            if meta['version'] != CACHE_VERSION:
+                return None
+            # Copy-on-write maps share pages with the file until written.
+            arrays = {
+                name: np.load(os.path.join(entry_path, name + '.npy'),
+                              mmap_mode='c')
+                for name in _ARRAY_NAMES
+            }
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+        # Mark the entry as recently used.
+        os.utime(os.path.join(entry_path, _META_FNAME))
+        logger.debug('Mesh cache hit for %s', path)
+
+        materials = OrderedDict([])
+        for name, index in meta['materials']:
+            materials[name] = Material(name, index)
+        faces = {
+            'vertices': arrays['face_vertices'],
+            'normals': arrays['face_normals'],
+            'uvs': arrays['face_uvs'],
+            'material': arrays['face_materials'],
+            'group': arrays['face_groups'],
+            'object': arrays['face_objects'],
+        }
+        return Mesh(arrays['vertices'], faces, arrays['normals'],
+                    arrays['uvs'], materials,
+                    dict(meta['group_names']), dict(meta['object_names']),
+                    center=False)
+
+    def store(self, path, mesh):
+        """
+        Stores a freshly parsed mesh for the OBJ file at path.
+        """
+        digest = self._content_digest(path)
+        entry_path = self._entry_path(digest)
+        if os.path.exists(entry_path):
+            return
+
+        tmp_path = os.path.join(self._entries_dir,
+                                'tmp-{}'.format(uuid.uuid4().hex))
+        os.makedirs(tmp_path)
+        try:
+            for name in _ARRAY_NAMES:
+                np.save(os.path.join(tmp_path, name + '.npy'),
+                        np.ascontiguousarray(getattr(mesh, name)))
+            meta = {
+                'version': CACHE_VERSION,
+                'source': os.path.realpath(path),
+                'materials': [(name, material.index)
+                              for name, material in mesh.materials.items()],
+                'group_names': list(mesh.group_names.items()),
+                'object_names': list(mesh.object_names.items()),
+            }
+            with open(os.path.join(tmp_path, _META_FNAME), 'w') as f:
+                json.dump(meta, f)
+            os.rename(tmp_path, entry_path)
+        except OSError:
+            # Another writer stored the same entry first.
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.exists(entry_path):
+                raise
+        logger.debug('Stored mesh cache entry for %s', path)
+        self.evict(keep=digest)
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used entries until the cache fits in
+        max_bytes.
+        :param keep: digest of an entry that must not be evicted.
+        """
+        entries = []
+        total_bytes = 0
+        for entry in os.scandir(self._entries_dir):
+            if entry.name.startswith('tmp-') or not entry.is_dir():
+                continue
+            try:
+                last_used = os.stat(
+                    os.path.join(entry.path, _META_FNAME)).st_mtime
+                size = _dir_size(entry.path)
+            except FileNotFoundError:
+                continue
+            entries.append((last_used, size, entry.name))
+            total_bytes += size
+
+        for last_used, size, digest in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if digest == keep:
+                continue
+            # Rename first so readers never see a half-deleted entry.
+            trash_path = os.path.join(self._entries_dir,
+                                      'tmp-{}'.format(uuid.uuid4().hex))
+            try:
+                os.rename(self._entry_path(digest), trash_path)
+            except OSError:
+                continue
+            shutil.rmtree(trash_path, ignore_errors=True)
+            total_bytes -= size
+            logger.debug('Evicted mesh cache entry %s', digest)
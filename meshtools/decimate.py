@@ -0,0 +1,222 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from proftools import traced
+from .mesh import Mesh
+
+# Weight of the boundary quadrics keeping seam and material boundary
+# vertices on their boundary, relative to the area-weighted face quadrics.
+DEFAULT_BOUNDARY_WEIGHT = 100.0
+# Eigenvalues of a cluster quadric below this fraction of its largest one
+# are treated as zero, leaving the position along those directions at the
+# mean of the cluster.
+_EIGENVALUE_TOLERANCE = 1e-3
+# Upper triangle of a symmetric 4x4 matrix.
+_QUADRIC_ROWS, _QUADRIC_COLS = np.triu_indices(4)
+
+
+def _rows_key(rows):
+    """
+    :return: an (N,) id per distinct row of an (N, K) int array, and the
+             number of distinct rows.
+    """
+    rows = np.ascontiguousarray(rows, dtype=np.int64)
+    records = rows.view(np.dtype((np.void, 8 * rows.shape[1]))).ravel()
+    _, inverse = np.unique(records, return_inverse=True)
+    inverse = inverse.ravel()
+    return inverse, (inverse.max() + 1 if len(inverse) > 0 else 0)
+
+
+def feature_edges(mesh):
+    """
+    Finds the edges that do not join exactly two faces with the same
+    vertices, uvs and material on both sides: uv seams, material
+    boundaries, open and non-manifold edges.
+    :return: (F, 3) bool array, edge k of a face running from corner k to
+             corner k + 1.
+    """
+    start = mesh.face_vertices
+    end = np.roll(start, -1, axis=1)
+    start_uv = mesh.face_uvs
+    end_uv = np.roll(start_uv, -1, axis=1)
+    # Orient edges so both faces of an interior edge give the same key.
+    swap = start > end
+    keys = np.stack((np.where(swap, end, start), np.where(swap, start, end),
+                     np.where(swap, end_uv, start_uv),
+                     np.where(swap, start_uv, end_uv),
+                     np.repeat(mesh.face_materials[:, None], 3, axis=1)),
+                    axis=2).reshape(-1, 5)
+    edge_ids, num_edges = _rows_key(keys)
+    counts = np.bincount(edge_ids, minlength=num_edges)
+    return (counts[edge_ids] != 2).reshape(-1, 3)
+
+
+def _plane_quadrics(normals, offsets, weights):
+    """
+    :return: (N, 10) upper triangles of weight * p p^T for planes
+             p = (normal, offset).
+    """
+    planes = np.concatenate((normals, offsets[:, None]), axis=1)
+    return (planes[:, _QUADRIC_ROWS] * planes[:, _QUADRIC_COLS]
+            * weights[:, None])
+
+
+def _accumulate(ids, quadrics, size):
+    return np.stack([np.bincount(ids, weights=quadrics[:, i], minlength=size)
+                     for i in range(quadrics.shape[1])], axis=1)
+
+
+def _solve_positions(quadrics, means):
+    """
+    Finds the points minimizing the quadric errors, closest to means along
+    directions the quadrics do not constrain.
+    """
+    full = np.zeros((len(quadrics), 4, 4))
+    full[:, _QUADRIC_ROWS, _QUADRIC_COLS] = quadrics
+    full[:, _QUADRIC_COLS, _QUADRIC_ROWS] = quadrics
+    a = full[:, :3, :3]
+    b = -full[:, :3, 3]
+    eigenvalues, eigenvectors = np.linalg.eigh(a)
+    largest = eigenvalues[:, -1:]
+    keep = eigenvalues > _EIGENVALUE_TOLERANCE * np.maximum(largest, 1e-30)
+    inverse = np.where(keep, 1.0 / np.where(keep, eigenvalues, 1.0), 0.0)
+    residual = b - np.einsum('nij,nj->ni', a, means)
+    projected = np.einsum('nji,nj->ni', eigenvectors, residual) * inverse
+    return means + np.einsum('nij,nj->ni', eigenvectors, projected)
+
+
+@traced('decimate')
+def decimate(mesh, cell_size, boundary_weight=DEFAULT_BOUNDARY_WEIGHT):
+    """
+    Simplifies a mesh by vertex clustering with quadric error metrics: the
+    vertices in each cell of a uniform grid are merged into the point
+    minimizing the summed squared distance to their faces' planes, and faces
+    collapsing to a line or point are removed.
+
+    Vertices on feature edges (see feature_edges) are clustered apart from
+    interior vertices and held on their edges by boundary quadrics, so uv
+    seams and material boundaries are kept. Corners keep indices into the
+    original uvs and normals, taken from the nearest uv-continuous corner
+    of their cluster.
+    :param cell_size: edge length of the grid cells in mesh units.
+    :param boundary_weight: weight of boundary quadrics.
+    :return: the simplified Mesh, sharing uvs and normals with mesh.
+    """
+    vertices = np.asarray(mesh.vertices, dtype=np.float64)
+    face_vertices = mesh.face_vertices
+    feature = feature_edges(mesh)
+
+    # Cluster by grid cell, feature vertices apart from interior ones.
+    is_feature = np.zeros(len(vertices), dtype=bool)
+    is_feature[face_vertices[feature]] = True
+    is_feature[np.roll(face_vertices, -1, axis=1)[feature]] = True
+    used = np.zeros(len(vertices), dtype=bool)
+    used[face_vertices] = True
+    cells = np.floor((vertices - vertices[used].min(axis=0))
+                     / cell_size).astype(np.int64)
+    vertex_keys = np.concatenate((cells, is_feature[:, None]), axis=1)
+    clusters, num_clusters = _rows_key(vertex_keys)
+
+    # Face quadrics, weighted by area.
+    corners = vertices[face_vertices]
+    cross = np.cross(corners[:, 1] - corners[:, 0],
+                     corners[:, 2] - corners[:, 0])
+    double_area = np.linalg.norm(cross, axis=1)
+    normals = cross / np.where(double_area == 0, 1.0, double_area)[:, None]
+    face_quadrics = _plane_quadrics(
+        normals, -np.sum(normals * corners[:, 0], axis=1), double_area / 2)
+    quadrics = _accumulate(clusters[face_vertices].ravel(),
+                           np.repeat(face_quadrics, 3, axis=0),
+                           num_clusters)
+
+    # Boundary quadrics: planes through feature edges perpendicular to
+    # their face.
+    edge_faces, edge_corners = np.nonzero(feature)
+    if len(edge_faces) > 0:
+        start = corners[edge_faces, edge_corners]
+        end = corners[edge_faces, (edge_corners + 1) % 3]
+        edge = end - start
+        length2 = np.sum(edge * edge, axis=1)
+        plane_normals = np.cross(edge, normals[edge_faces])
+        norm = np.linalg.norm(plane_normals, axis=1)
+        plane_normals /= np.where(norm == 0, 1.0, norm)[:, None]
+        boundary_quadrics = _plane_quadrics(
+            plane_normals, -np.sum(plane_normals * start, axis=1),
+            boundary_weight * length2)
+        edge_vertices = np.stack(
+            (face_vertices[edge_faces, edge_corners],
+             face_vertices[edge_faces, (edge_corners + 1) % 3]), axis=1)
+        quadrics += _accumulate(clusters[edge_vertices].ravel(),
+                                np.repeat(boundary_quadrics, 2, axis=0),
+                                num_clusters)
+
+    counts = np.bincount(clusters[used], minlength=num_clusters)
+    means = np.stack([np.bincount(clusters[used], weights=vertices[used, i],
+                                  minlength=num_clusters)
+                      for i in range(3)], axis=1)
+    means /= np.maximum(counts, 1)[:, None]
+    positions = _solve_positions(quadrics, means)
+    # Points far outside their cell come from nearly flat quadrics.
+    stray = np.linalg.norm(positions - means, axis=1) > cell_size * np.sqrt(3)
+    positions[stray] = means[stray]
+
+    # Keep faces spanning three clusters, once per material.
+    face_clusters = clusters[face_vertices]
+    keep = ((face_clusters[:, 0] != face_clusters[:, 1])
+            & (face_clusters[:, 1] != face_clusters[:, 2])
+            & (face_clusters[:, 2] != face_clusters[:, 0]))
+    kept = np.flatnonzero(keep)
+    face_keys = np.concatenate((np.sort(face_clusters[kept], axis=1),
+                                mesh.face_materials[kept, None]), axis=1)
+    face_ids, _ = _rows_key(face_keys)
+    _, first = np.unique(face_ids, return_index=True)
+    kept = kept[np.sort(first)]
+
+    # Corners keep the uv and normal of a nearby original corner of the
+    # same wedge: corners sharing a vertex and uv, or joined by an edge of
+    # a face inside the cluster, are uv-continuous. Corners on the two
+    # sides of a uv seam are never joined and keep their own uvs.
+    corner_clusters = face_clusters.ravel()
+    nodes, num_nodes = _rows_key(np.stack((face_vertices.ravel(),
+                                           mesh.face_uvs.ravel()), axis=1))
+    nodes = nodes.reshape(-1, 3)
+    inner = face_clusters == np.roll(face_clusters, -1, axis=1)
+    links = coo_matrix((np.ones(np.count_nonzero(inner)),
+                        (nodes[inner], np.roll(nodes, -1, axis=1)[inner])),
+                       shape=(num_nodes, num_nodes))
+    _, node_wedges = connected_components(links, directed=False)
+    wedges = node_wedges[nodes.ravel()]
+    distances = np.sum((corners.reshape(-1, 3)
+                        - positions[corner_clusters]) ** 2, axis=1)
+    order = np.lexsort((distances, wedges))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = wedges[order[1:]] != wedges[order[:-1]]
+    wedge_ids = wedges[order[first]]
+    representatives = order[first]
+
+    def _corner_indices(face_indices):
+        wedge = np.searchsorted(wedge_ids, wedges.reshape(-1, 3)[kept])
+        return face_indices.ravel()[representatives[wedge]]
+
+    # Renumber the clusters used by the kept faces.
+    new_face_vertices = face_clusters[kept]
+    used_clusters, new_face_vertices = np.unique(new_face_vertices,
+                                                 return_inverse=True)
+    faces = {
+        'vertices': new_face_vertices.reshape(-1, 3).astype(np.int32),
+        'normals': _corner_indices(mesh.face_normals).astype(np.int32),
+        'uvs': _corner_indices(mesh.face_uvs).astype(np.int32),
+        'material': mesh.face_materials[kept],
+        'group': mesh.face_groups[kept],
+        'object': mesh.face_objects[kept],
+    }
+    return Mesh(positions[used_clusters].astype(np.float32), faces,
+                mesh.normals, mesh.uvs, mesh.materials, mesh.group_names,
+                mesh.object_names, center=False)
+
+
+def mean_edge_length(mesh):
+    corners = np.asarray(mesh.vertices)[mesh.face_vertices]
+    edges = corners - np.roll(corners, -1, axis=1)
+    return float(np.mean(np.linalg.norm(edges, axis=2)))
@@ -0,0 +1,150 @@
+import numpy as np
+
+DEFAULT_CACHE_SIZE = 32
+MORTON_BITS = 10
+
+
+def deduplicate_vertices(attributes):
+    """
+    Merges corners whose attributes are all bitwise equal into one vertex.
+    The attribute rows of each corner are packed into a single record and
+    sorted, so this runs in one vectorized pass.
+    :param attributes: dict of (3F, ...) per-corner arrays, as returned by
+                       Mesh.expand_segments.
+    :return: dict of (V, ...) unique vertex arrays with the same keys, and
+             an (F, 3) uint32 index array into them. Vertices are numbered
+             in order of first use.
+    """
+    names = list(attributes)
+    arrays = [np.asarray(attributes[name]) for name in names]
+    num_corners = len(arrays[0])
+    columns = [a.reshape(num_corners, -1) for a in arrays]
+    # Adding 0.0 turns -0.0 into 0.0, so equal values compare equal bytewise.
+    packed = np.ascontiguousarray(
+        np.hstack([c.astype(np.float32) + np.float32(0.0) for c in columns]))
+    records = packed.view(np.dtype((np.void, packed.dtype.itemsize
+                                    * packed.shape[1]))).ravel()
+    _, first, inverse = np.unique(records, return_index=True,
+                                  return_inverse=True)
+
+    # np.unique numbers vertices in sort order, renumber them by first use.
+    order = np.argsort(first, kind='stable')
+    remap = np.empty(len(order), dtype=np.uint32)
+    remap[order] = np.arange(len(order), dtype=np.uint32)
+    indices = remap[inverse.ravel()].reshape(-1, 3)
+    first = first[order]
+    return {name: a[first] for name, a in zip(names, arrays)}, indices
+
+
+def _part1by2(values):
+    values = values.astype(np.uint32) & 0x3ff
+    values = (values | (values << 16)) & 0xff0000ff
+    values = (values | (values << 8)) & 0x0300f00f
+    values = (values | (values << 4)) & 0x030c30c3
+    values = (values | (values << 2)) & 0x09249249
+    return values
+
+
+def morton_codes(points, bits=MORTON_BITS):
+    """
+    Z-order curve codes of points quantized to their bounding box.
+    :param points: (N, 3) array.
+    :return: (N,) uint32 codes.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) == 0:
+        return np.empty(0, dtype=np.uint32)
+    lo = points.min(axis=0)
+    extent = points.max(axis=0) - lo
+    scale = ((1 << bits) - 1) / np.where(extent == 0, 1.0, extent)
+    cells = ((points - lo) * scale).astype(np.uint32)
+    return (_part1by2(cells[:, 0]) | (_part1by2(cells[:, 1]) << 1)
+            | (_part1by2(cells[:, 2]) << 2))
+
+
+def optimize_triangle_order(indices, positions):
+    """
+    Reorders triangles along a Z-order curve over their centroids, so that
+    consecutive triangles share vertices and hit the post-transform vertex
+    cache, then renumbers vertices in order of first use for locality of
+    vertex fetches.
+    :param indices: (F, 3) index array.
+    :param positions: (V, 3) vertex positions.
+    :return: the reordered (F, 3) index array and the (V,) permutation to
+             apply to all vertex arrays, i.e. new vertex i is old vertex
+             permutation[i].
+    """
+    indices = np.asarray(indices)
+    positions = np.asarray(positions)
+    centroids = positions[indices].mean(axis=1)
+    triangle_order = np.argsort(morton_codes(centroids), kind='stable')
+    indices = indices[triangle_order]
+
+    used, first = np.unique(indices.ravel(), return_index=True)
+    permutation = used[np.argsort(first, kind='stable')]
+    remap = np.zeros(len(positions), dtype=indices.dtype)
+    remap[permutation] = np.arange(len(permutation), dtype=indices.dtype)
+    return remap[indices], permutation
+
+
+def average_cache_miss_ratio(indices, cache_size=DEFAULT_CACHE_SIZE,
+                             max_triangles=None):
+    """
+    Simulates a FIFO post-transform vertex cache.
+    :param indices: (F, 3) index array, in draw order.
+    :param max_triangles: only simulate this many leading triangles.
+    :return: average number of vertices transformed per triangle (ACMR),
+             3 for unindexed geometry and about 0.5 at best.
+    """
+    indices = np.asarray(indices)
+    if max_triangles is not None:
+        indices = indices[:max_triangles]
+    if len(indices) == 0:
+        return 0.0
+    # Insertion number of each cached vertex; a vertex is evicted once
+    # cache_size newer vertices were inserted.
+    inserted = {}
+    misses = 0
+    for vertex in indices.ravel().tolist():
+        inserted_at = inserted.get(vertex)
+        if inserted_at is None or misses - inserted_at >= cache_size:
+            misses += 1
+            inserted[vertex] = misses
+    return misses / len(indices)
+
+
+def index_attributes(attributes, position_key='vertices', reorder=True):
+    """
+    Turns per-corner attributes into indexed geometry, see
+    deduplicate_vertices and optimize_triangle_order.
+    :return: dict of unique vertex arrays, (F, 3) uint32 index array.
+    """
+    vertices, indices = deduplicate_vertices(attributes)
+    if reorder and len(indices) > 0:
+        indices, permutation = optimize_triangle_order(
+            indices, vertices[position_key])
+        vertices = {k: v[permutation] for k, v in vertices.items()}
+    return vertices, indices
+
+
+def indexing_report(attributes, vertices, indices,
+                    cache_size=DEFAULT_CACHE_SIZE, max_triangles=100000):
+    """
+    Compares per-corner attributes with their indexed version.
+    :return: dict with the number of corners and unique vertices, the bytes
+             of both layouts (as float32 attributes and uint32 indices) and
+             the ACMR of the indexed triangles.
+    """
+    def _nbytes(arrays):
+        return sum(np.asarray(a).size * 4 for a in arrays.values())
+
+    expanded_bytes = _nbytes(attributes)
+    indexed_bytes = _nbytes(vertices) + np.asarray(indices).size * 4
+    return {
+        'num_corners': len(next(iter(attributes.values()))),
+        'num_vertices': len(next(iter(vertices.values()))),
+        'expanded_bytes': expanded_bytes,
+        'indexed_bytes': indexed_bytes,
+        'memory_ratio': expanded_bytes / max(indexed_bytes, 1),
+        'acmr': average_cache_miss_ratio(indices, cache_size, max_triangles),
+    }
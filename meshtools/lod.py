@@ -0,0 +1,181 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+from proftools import span
+from .decimate import DEFAULT_BOUNDARY_WEIGHT, decimate, mean_edge_length
+from .mesh import Mesh
+
+logger = logging.getLogger(__name__)
+
+LOD_CACHE_VERSION = 1
+DEFAULT_MAX_LEVELS = 6
+DEFAULT_MIN_FACES = 512
+# Levels reducing the face count by less than this factor end the chain.
+MIN_REDUCTION = 1.5
+
+_META_FNAME = 'meta.json'
+_LEVEL_ARRAYS = (
+    'vertices', 'face_vertices', 'face_normals', 'face_uvs',
+    'face_materials', 'face_groups', 'face_objects',
+)
+
+
+class LODChain:
+    """
+    Versions of a mesh at decreasing levels of detail. Level 0 is the mesh
+    itself; every level has a geometric error, about the distance in mesh
+    units its surface may be off from level 0.
+    """
+
+    def __init__(self, levels, errors):
+        self.levels = levels
+        self.errors = errors
+
+    def __len__(self):
+        return len(self.levels)
+
+    def __getitem__(self, level):
+        return self.levels[level]
+
+
+def mesh_digest(mesh):
+    """
+    Identifies the geometry of a mesh by the hash of its arrays.
+    """
+    digest = hashlib.sha256()
+    for name in ('vertices', 'normals', 'uvs') + _LEVEL_ARRAYS[1:]:
+        digest.update(np.ascontiguousarray(getattr(mesh, name)).data)
+    return digest.hexdigest()
+
+
+def build_lod_chain(mesh, max_levels=DEFAULT_MAX_LEVELS,
+                    min_faces=DEFAULT_MIN_FACES,
+                    boundary_weight=DEFAULT_BOUNDARY_WEIGHT):
+    """
+    Decimates a mesh into a chain of levels with about 4x fewer faces each,
+    see decimate. Every level is simplified from the full mesh with twice
+    the grid cell size of the one before.
+    :param max_levels: maximum number of levels, including level 0.
+    :param min_faces: stop once a level has fewer faces.
+    """
+    levels, errors = [mesh], [0.0]
+    cell_size = 2 * mean_edge_length(mesh)
+    while len(levels) < max_levels and levels[-1].num_faces >= min_faces:
+        level = decimate(mesh, cell_size, boundary_weight)
+        if level.num_faces == 0 or (
+                level.num_faces * MIN_REDUCTION > levels[-1].num_faces):
+            break
+        levels.append(level)
+        errors.append(cell_size)
+        cell_size *= 2
+    return LODChain(levels, errors)
+
+
+class LODCache:
+    """
+    On-disk cache of LOD chains, keyed by the digest of the full resolution
+    mesh and the decimation parameters. Each entry is a directory of .npy
+    arrays per level, written to a temporary directory and renamed into
+    place like MeshCache entries. Levels share the uvs and normals of the
+    full resolution mesh, so only level 0 has to be loaded to restore them.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _entry_path(self, mesh, params):
+        key = json.dumps([mesh_digest(mesh), params], sort_keys=True)
+        return os.path.join(self.cache_dir,
+                            hashlib.sha256(key.encode()).hexdigest())
+
+    def get(self, mesh, max_levels=DEFAULT_MAX_LEVELS,
+            min_faces=DEFAULT_MIN_FACES,
+            boundary_weight=DEFAULT_BOUNDARY_WEIGHT):
+        """
+        Returns the LOD chain of mesh, building and storing it on a miss.
+        """
+        params = {'max_levels': max_levels, 'min_faces': min_faces,
+                  'boundary_weight': boundary_weight,
+                  'version': LOD_CACHE_VERSION}
+        entry_path = self._entry_path(mesh, params)
+        chain = self._load(entry_path, mesh)
+        if chain is not None:
+            logger.debug('LOD cache hit for %s', entry_path)
+            return chain
+        with span('build_lod_chain', faces=mesh.num_faces):
+            chain = build_lod_chain(mesh, max_levels, min_faces,
+                                    boundary_weight)
+        try:
+            self._store(entry_path, chain)
+        except OSError:
+            # Read-only asset directories just rebuild the chain next time.
+            logger.warning('Could not write LOD chain to %s', entry_path)
+        return chain
+
+    def _load(self, entry_path, mesh):
+        try:
+            with open(os.path.join(entry_path, _META_FNAME), 'r') as f:
+                meta = json.load(f)
+            levels = [mesh]
+            for i in range(1, meta['num_levels']):
+                arrays = {
+                    name: np.load(os.path.join(
+                        entry_path, '{}_{}.npy'.format(i, name)),
+                        mmap_mode='c')
+                    for name in _LEVEL_ARRAYS
+                }
+                levels.append(_level_mesh(mesh, arrays))
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+        return LODChain(levels, meta['errors'])
+
+    def _store(self, entry_path, chain):
+        if os.path.exists(entry_path):
+            return
+        tmp_path = '{}.tmp-{}'.format(entry_path, uuid.uuid4().hex)
+        os.makedirs(tmp_path)
+        try:
+            for i, level in enumerate(chain.levels[1:], 1):
+                for name in _LEVEL_ARRAYS:
+                    np.save(os.path.join(tmp_path,
+                                         '{}_{}.npy'.format(i, name)),
+                            np.ascontiguousarray(getattr(level, name)))
+            with open(os.path.join(tmp_path, _META_FNAME), 'w') as f:
+                json.dump({'num_levels': len(chain),
+                           'errors': chain.errors}, f)
+            os.rename(tmp_path, entry_path)
+        except OSError:
+            # Another writer stored the same entry first.
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.exists(entry_path):
+                raise
+
+
+def _level_mesh(mesh, arrays):
+    faces = {
+        'vertices': arrays['face_vertices'],
+        'normals': arrays['face_normals'],
+        'uvs': arrays['face_uvs'],
+        'material': arrays['face_materials'],
+        'group': arrays['face_groups'],
+        'object': arrays['face_objects'],
+    }
+    return Mesh(arrays['vertices'], faces, mesh.normals, mesh.uvs,
+                mesh.materials, mesh.group_names, mesh.object_names,
+                center=False)
+
+
+def get_lod_chain(mesh, cache_dir=None, **kwargs):
+    """
+    Returns the LOD chain of mesh, from the LODCache in cache_dir if given.
+    :param kwargs: see build_lod_chain.
+    """
+    if cache_dir is None:
+        return build_lod_chain(mesh, **kwargs)
+    return LODCache(cache_dir).get(mesh, **kwargs)
@@ -1,19 +1,99 @@
+from collections.abc import Sequence
+
 import numpy as np
 
+from proftools import traced
+
 EPSILON = 1e-10
 
 
+class FaceView(Sequence):
+    """
+    Read-only sequence of per-face dicts backed by the face arrays of a mesh.
+    Indices are 1-based with None marking a missing index, as in OBJ files.
+    """
+
+    def __init__(self, mesh, indices=None):
+        self._mesh = mesh
+        self._indices = indices
+
+    def __len__(self):
+        if self._indices is None:
+            return self._mesh.num_faces
+        return len(self._indices)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if self._indices is not None:
+            i = self._indices[i]
+        mesh = self._mesh
+
+        def _corners(array):
+            return [None if v < 0 else v + 1 for v in array[i].tolist()]
+
+        return {
+            'vertices': _corners(mesh.face_vertices),
+            'normals': _corners(mesh.face_normals),
+            'uvs': _corners(mesh.face_uvs),
+            'material': int(mesh.face_materials[i]),
+            'group': int(mesh.face_groups[i]),
+            'object': int(mesh.face_objects[i]),
+        }
+
+
+def _face_arrays_from_dicts(faces):
+    """
+    Converts a list of per-face dicts with 1-based indices into face arrays
+    with 0-based indices and -1 marking a missing index.
+    """
+    def _corners(key):
+        indices = [[0 if v is None else v for v in face[key]]
+                   for face in faces]
+        return np.array(indices, dtype=np.int32).reshape(-1, 3) - 1
+
+    def _ids(key):
+        return np.array([face[key] for face in faces], dtype=np.int32)
+
+    return {
+        'vertices': _corners('vertices'),
+        'normals': _corners('normals'),
+        'uvs': _corners('uvs'),
+        'material': _ids('material'),
+        'group': _ids('group'),
+        'object': _ids('object'),
+    }
+
+
 class Mesh:
     def __init__(self, vertices, faces, normals, uvs, materials, group_names,
                  object_names, center=True):
+        """
+        :param faces: either a list of per-face dicts with 1-based indices,
+                      or a dict with the same keys holding (F, 3) index arrays
+                      ('vertices', 'normals', 'uvs') with 0-based indices and
+                      -1 for missing indices, and (F,) id arrays ('material',
+                      'group', 'object').
+        """
         self.vertices = vertices
-        self.faces = faces
-        self.normals = normals
-        self.uvs = uvs[:, :2]
+        self.normals = normals.reshape(-1, 3)
+        self.uvs = uvs[:, :2] if len(uvs) > 0 else np.zeros(
+            (0, 2), dtype=np.float32)
         self.materials = materials
         self.group_names = group_names
         self.object_names = object_names
 
+        if not isinstance(faces, dict):
+            faces = _face_arrays_from_dicts(faces)
+        self.face_vertices = _as_index_array(faces['vertices'])
+        self.face_normals = _as_index_array(faces['normals'])
+        self.face_uvs = _as_index_array(faces['uvs'])
+        self.face_materials = _as_index_array(faces['material'])
+        self.face_groups = _as_index_array(faces['group'])
+        self.face_objects = _as_index_array(faces['object'])
+        self._synthesize_missing_normals()
+        self._segment_indices = {}
+
         max = self.vertices.max(axis=0)
         min = self.vertices.min(axis=0)
         center_point = (max + min) / 2
@@ -21,77 +101,262 @@ class Mesh:
         if center:
             self.vertices -= center_point[None, :]
 
-    def get_faces(self, filter=None):
+    @property
+    def num_faces(self):
+        return len(self.face_vertices)
+
+    @property
+    def faces(self):
+        """
+        Compatibility view of the faces as a sequence of dicts.
+        """
+        return FaceView(self)
+
+    def face_indices(self, filter=None):
+        """
+        Returns the indices of the faces matching all key/value pairs of the
+        filter in ascending order, or None if there is no filter. Each face
+        is returned at most once.
+        """
         if filter is None:
-            return self.faces
-        faces = []
-        for face in self.faces:
-            for k, v in filter.items():
-                if face[k] == v:
-                    faces.append(face)
-        return faces
-
-    def expand_tangents(self, filter=None):
-        tangents = []
-        bitangents = []
-        for face in self.get_faces(filter):
-            face_vertex_indices = [v for v in face['vertices']]
-            face_uv_indices = [v for v in face['uvs']]
-            if None not in face_uv_indices:
-                face_vertices = [self.vertices[i - 1, :]
-                                 for i in face_vertex_indices]
-                face_uvs = [self.uvs[i - 1, :] * 100
-                            for i in face_uv_indices]
-                delta_pos1 = face_vertices[1] - face_vertices[0]
-                delta_pos2 = face_vertices[2] - face_vertices[0]
-                delta_uv1 = face_uvs[1] - face_uvs[0]
-                delta_uv2 = face_uvs[2] - face_uvs[0]
-                denom = (delta_uv1[0] * delta_uv2[1]
-                           - delta_uv1[1] * delta_uv2[0])
-                r = 1.0 / (denom if denom > 0 else EPSILON)
-                tangent = r * (delta_pos1 * delta_uv2[1]
-                               - delta_pos2 * delta_uv1[1])
-                bitangent = r * (delta_pos2 * delta_uv1[0]
-                                 - delta_pos1 * delta_uv2[0])
-            else:
-                tangent = np.array([0.0, 0.0, 0.0], dtype=np.float32)
-                bitangent = np.array([0.0, 0.0, 0.0], dtype=np.float32)
-            tangents.extend([tangent] * 3)
-            bitangents.extend([bitangent] * 3)
-
-        return np.array(tangents), np.array(bitangents)
+            return None
+        segments = [self.segment_faces(k, v) for k, v in filter.items()]
+        indices = min(segments, key=len)
+        for k, v in filter.items():
+            indices = indices[self._face_ids(k)[indices] == v]
+        return indices
+
+    def segment_index(self, segment_type='material'):
+        """
+        Returns the faces sorted into contiguous runs by segment id. The index
+        is built once per segment type.
+        :return: (order, offsets) where the faces of segment i are
+                 order[offsets[i + 1]:offsets[i + 2]]; offset 0 holds faces
+                 without a segment (id -1).
+        """
+        if segment_type not in self._segment_indices:
+            ids = self._face_ids(segment_type)
+            order = np.argsort(ids, kind='stable')
+            counts = np.bincount(
+                ids + 1, minlength=self.num_segments(segment_type) + 1)
+            offsets = np.concatenate(([0], np.cumsum(counts)))
+            self._segment_indices[segment_type] = order, offsets
+        return self._segment_indices[segment_type]
+
+    def segment_faces(self, segment_type, segment_id):
+        """
+        Returns the indices of the faces in a segment in ascending order.
+        """
+        order, offsets = self.segment_index(segment_type)
+        if not -1 <= segment_id < len(offsets) - 2:
+            return order[:0]
+        return order[offsets[segment_id + 1]:offsets[segment_id + 2]]
+
+    @traced('Mesh.expand_segments')
+    def expand_segments(self, segment_type='material', smooth=False):
+        """
+        Expands the vertex attributes of all segments in one pass. Faces
+        without a segment id are skipped.
+        :param smooth: see expand_tangents.
+        :return: dict mapping segment id to a dict of per-corner 'vertices',
+                 'normals', 'tangents', 'bitangents' and 'uvs' arrays.
+        """
+        order, offsets = self.segment_index(segment_type)
+        order = order[offsets[1]:]
+        offsets = 3 * (offsets[1:] - offsets[1])
+        corners = (3 * order[:, None] + np.arange(3)).ravel()
+
+        face_vertices = self.face_vertices[order]
+        face_uvs = self.face_uvs[order]
+        attributes = {
+            'vertices': _expand(self.vertices, face_vertices),
+            'normals': _expand(self.normals, self.face_normals[order]),
+            'uvs': self._expand_uvs(face_uvs),
+        }
+        if smooth:
+            tangents, bitangents = self._smooth_tangents()
+            attributes['tangents'] = tangents[corners]
+            attributes['bitangents'] = bitangents[corners]
+        else:
+            tangents, bitangents = self._face_tangents(face_vertices,
+                                                       face_uvs)
+            attributes['tangents'] = np.repeat(tangents, 3, axis=0)
+            attributes['bitangents'] = np.repeat(bitangents, 3, axis=0)
+
+        segments = {}
+        for segment_id in range(len(offsets) - 1):
+            start, end = offsets[segment_id], offsets[segment_id + 1]
+            segments[segment_id] = {k: v[start:end]
+                                    for k, v in attributes.items()}
+        return segments
+
+    def _face_ids(self, segment_type):
+        if segment_type == 'material':
+            return self.face_materials
+        elif segment_type == 'group':
+            return self.face_groups
+        elif segment_type == 'object':
+            return self.face_objects
+        raise ValueError('Unknown segment type {}'.format(segment_type))
+
+    def _select(self, array, filter):
+        indices = self.face_indices(filter)
+        return array if indices is None else array[indices]
+
+    def get_faces(self, filter=None):
+        """
+        :param filter: dict of face key ('material', 'group' or 'object') to
+                       value. Faces must match every pair, see face_indices.
+        """
+        return FaceView(self, self.face_indices(filter))
+
+    @traced('Mesh.expand_tangents')
+    def expand_tangents(self, filter=None, smooth=False):
+        """
+        Computes per-corner unit tangents and bitangents from the UV mapping.
+        :param filter: face filter, see get_faces.
+        :param smooth: if True, average the frames of corners sharing a vertex
+                       and UV, weighted by corner angle, and orthogonalize
+                       them against the vertex normals (Gram-Schmidt).
+                       Otherwise return flat per-face frames.
+        :return: (tangents, bitangents) as (3F, 3) float32 arrays. Faces
+                 without UVs get zero vectors.
+        """
+        if smooth:
+            tangents, bitangents = self._smooth_tangents()
+            indices = self.face_indices(filter)
+            if indices is not None:
+                corners = (3 * indices[:, None] + np.arange(3)).ravel()
+                tangents = tangents[corners]
+                bitangents = bitangents[corners]
+            return tangents, bitangents
+
+        tangents, bitangents = self._face_tangents(
+            self._select(self.face_vertices, filter),
+            self._select(self.face_uvs, filter))
+        return (np.repeat(tangents, 3, axis=0),
+                np.repeat(bitangents, 3, axis=0))
+
+    def _face_tangents(self, face_vertices, face_uvs):
+        """
+        Computes a unit tangent and bitangent per face. Faces with a
+        degenerate UV mapping get an arbitrary frame orthogonal to the face.
+        """
+        tangents = np.zeros((len(face_vertices), 3), dtype=np.float32)
+        bitangents = np.zeros((len(face_vertices), 3), dtype=np.float32)
+        has_uvs = np.all(face_uvs >= 0, axis=1)
+        if not np.any(has_uvs):
+            return tangents, bitangents
+
+        positions = self.vertices[face_vertices[has_uvs]]
+        uvs = self.uvs[face_uvs[has_uvs]]
+        delta_pos1 = positions[:, 1] - positions[:, 0]
+        delta_pos2 = positions[:, 2] - positions[:, 0]
+        delta_uv1 = uvs[:, 1] - uvs[:, 0]
+        delta_uv2 = uvs[:, 2] - uvs[:, 0]
+        denom = (delta_uv1[:, 0] * delta_uv2[:, 1]
+                 - delta_uv1[:, 1] * delta_uv2[:, 0])
+        degenerate = np.abs(denom) < EPSILON
+        r = 1.0 / np.where(degenerate, 1.0, denom)[:, None]
+        tangent = r * (delta_pos1 * delta_uv2[:, 1, None]
+                       - delta_pos2 * delta_uv1[:, 1, None])
+        bitangent = r * (delta_pos2 * delta_uv1[:, 0, None]
+                         - delta_pos1 * delta_uv2[:, 0, None])
+
+        degenerate |= ((_norm(tangent) < EPSILON)
+                       | (_norm(bitangent) < EPSILON))
+        if np.any(degenerate):
+            normal = _normalized(np.cross(delta_pos1[degenerate],
+                                          delta_pos2[degenerate]))
+            tangent[degenerate], bitangent[degenerate] = _orthonormal_frame(
+                normal)
+
+        tangents[has_uvs] = _normalized(tangent)
+        bitangents[has_uvs] = _normalized(bitangent)
+        return tangents, bitangents
 
+    def _smooth_tangents(self):
+        """
+        Computes angle-weighted per-(vertex, uv) tangent frames for all face
+        corners, orthogonalized against the corner normals.
+        """
+        face_tangents, face_bitangents = self._face_tangents(
+            self.face_vertices, self.face_uvs)
+        weights = _corner_angles(self.vertices[self.face_vertices])
+
+        # Corners sharing both a position and a UV are smoothed together, so
+        # frames are not averaged across UV seams.
+        keys = (self.face_vertices.astype(np.int64) * (len(self.uvs) + 1)
+                + self.face_uvs + 1).ravel()
+        unique_keys, corner_ids = np.unique(keys, return_inverse=True)
+        tangents = _accumulate(corner_ids, face_tangents, weights,
+                               len(unique_keys))[corner_ids]
+        bitangents = _accumulate(corner_ids, face_bitangents, weights,
+                                 len(unique_keys))[corner_ids]
+
+        normals = _normalized(self.expand_face_normals())
+        tangents -= normals * np.sum(normals * tangents, axis=1,
+                                     keepdims=True)
+        handedness = np.where(
+            np.sum(np.cross(normals, tangents) * bitangents, axis=1,
+                   keepdims=True) < 0, -1.0, 1.0)
+        tangents = _normalized(tangents)
+        bitangents = np.cross(normals, tangents) * handedness
+
+        has_uvs = np.repeat(np.all(self.face_uvs >= 0, axis=1), 3)
+        tangents[~has_uvs] = 0
+        bitangents[~has_uvs] = 0
+        return (tangents.astype(np.float32, copy=False),
+                bitangents.astype(np.float32, copy=False))
+
+    def compute_vertex_normals(self):
+        """
+        Computes angle-weighted per-vertex normals from the faces.
+        :return: (V, 3) float32 array of unit normals.
+        """
+        positions = self.vertices[self.face_vertices]
+        face_normals = _normalized(np.cross(positions[:, 1] - positions[:, 0],
+                                            positions[:, 2] - positions[:, 0]))
+        weights = _corner_angles(positions)
+        normals = _accumulate(self.face_vertices.ravel(), face_normals,
+                              weights, len(self.vertices))
+        unused = _norm(normals) < EPSILON
+        normals[unused] = (0.0, 0.0, 1.0)
+        return _normalized(normals).astype(np.float32)
+
+    def _synthesize_missing_normals(self):
+        """
+        Points face corners without a normal index at generated per-vertex
+        normals.
+        """
+        missing = self.face_normals < 0
+        if not np.any(missing):
+            return
+        offset = len(self.normals)
+        self.normals = np.concatenate((self.normals,
+                                       self.compute_vertex_normals()))
+        self.face_normals[missing] = self.face_vertices[missing] + offset
+
+    @traced('Mesh.expand_face_vertices')
     def expand_face_vertices(self, filter=None):
-        out_vertices = []
-        for face in self.get_faces(filter):
-            face_vertex_indices = [v for v in face['vertices']]
-            face_vertices = [self.vertices[i - 1, :]
-                             for i in face_vertex_indices]
-            out_vertices.extend(face_vertices)
-        return np.array(out_vertices)
+        return _expand(self.vertices,
+                       self._select(self.face_vertices, filter))
 
+    @traced('Mesh.expand_face_uvs')
     def expand_face_uvs(self, filter=None):
-        out_uvs = []
-        for face in self.get_faces(filter):
-            face_uv_indices = [v for v in face['uvs']]
-            if None not in face_uv_indices:
-                face_uvs = [self.uvs[i - 1, :]
-                            for i in face_uv_indices]
-            else:
-                # Add placeholder UVs if not available.
-                zero = np.array([0.0, 0.0], dtype=np.float32)
-                face_uvs = [zero] * 3
-            out_uvs.extend(face_uvs)
-        return np.array(out_uvs)
+        return self._expand_uvs(self._select(self.face_uvs, filter))
+
+    def _expand_uvs(self, face_uvs):
+        out_uvs = np.zeros((face_uvs.size, 2), dtype=np.float32)
+        # Add placeholder UVs if not available.
+        has_uvs = np.repeat(np.all(face_uvs >= 0, axis=1), 3)
+        if np.any(has_uvs):
+            out_uvs[has_uvs] = self.uvs[face_uvs.ravel()[has_uvs]]
+        return out_uvs
 
+    @traced('Mesh.expand_face_normals')
     def expand_face_normals(self, filter=None):
-        out_normals = []
-        for face in self.get_faces(filter):
-            face_vertex_indices = [v for v in face['normals']]
-            face_normals = [self.normals[i - 1, :]
-                            for i in face_vertex_indices]
-            out_normals.extend(face_normals)
-        return np.array(out_normals)
+        return _expand(self.normals, self._select(self.face_normals, filter))
 
     def bounding_size(self):
         max = self.vertices.max(axis=0)
@@ -116,6 +381,55 @@ class Mesh:
         return str
 
 
+def _as_index_array(array):
+    return np.ascontiguousarray(array, dtype=np.int32)
+
+
+def _expand(values, face_indices):
+    return np.ascontiguousarray(values[face_indices.ravel()],
+                                dtype=np.float32)
+
+
+def _norm(vectors):
+    return np.sqrt(np.sum(vectors * vectors, axis=-1))
+
+
+def _normalized(vectors):
+    norm = _norm(vectors)[..., None]
+    return vectors / np.where(norm < EPSILON, 1.0, norm)
+
+
+def _orthonormal_frame(normals):
+    """
+    Returns arbitrary unit tangents and bitangents orthogonal to the normals.
+    """
+    axis = np.zeros_like(normals)
+    axis[np.arange(len(normals)), np.argmin(np.abs(normals), axis=1)] = 1.0
+    tangents = _normalized(np.cross(normals, axis))
+    return tangents, np.cross(normals, tangents)
+
+
+def _corner_angles(positions):
+    """
+    Computes the interior angle at each corner of (F, 3, 3) triangles.
+    :return: (3F,) array of angles in radians.
+    """
+    edges_out = _normalized(np.roll(positions, -1, axis=1) - positions)
+    edges_in = _normalized(np.roll(positions, 1, axis=1) - positions)
+    cosines = np.clip(np.sum(edges_out * edges_in, axis=2), -1.0, 1.0)
+    return np.arccos(cosines).ravel()
+
+
+def _accumulate(ids, face_vectors, weights, size):
+    """
+    Sums per-face vectors, repeated for each corner and weighted per corner,
+    into the buckets given by the per-corner ids.
+    """
+    vectors = np.repeat(face_vectors, 3, axis=0) * weights[:, None]
+    return np.stack([np.bincount(ids, vectors[:, i], minlength=size)
+                     for i in range(3)], axis=1)
+
+
 class Material:
     def __init__(self, name, index):
         self.name = name
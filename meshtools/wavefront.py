@@ -1,10 +1,13 @@
 import logging
+import os
 import re
 from collections import OrderedDict
 
 import numpy as np
 
+from meshtools.cache import MeshCache
 from meshtools.mesh import Material, Mesh
+from proftools import count, span
 
 OBJ_COMMENT_MARKER = '#'
 OBJ_VERTEX_MARKER = 'v'
@@ -24,6 +27,9 @@ MTL_DIFFUSE_COLOR_MARKER = 'Kd'
 MTL_AMBIENT_COLOR_MARKER = 'Ka'
 MTL_EMMISSIVE_COLOR_MARKER = 'Ke'
 
+# Number of bytes of lines handed to the bulk parser at a time.
+BULK_CHUNK_SIZE = 64 * 1024 * 1024
+
 logger = logging.getLogger(__name__)
 
 
@@ -55,7 +61,34 @@ def __parse_face(parts, material_id, group_id, object_id):
     }
 
 
-def read_obj_file(path):
+def read_obj_file(path, bulk=False, chunk_size=BULK_CHUNK_SIZE, cache=None):
+    """
+    Reads a Wavefront OBJ file.
+    :param path: path to the OBJ file.
+    :param bulk: if True, parse records in large chunks straight into NumPy
+                 arrays instead of line by line. Produces the same mesh.
+    :param chunk_size: approximate number of bytes per chunk in bulk mode.
+    :param cache: optional MeshCache, or cache directory, to load the parsed
+                  mesh from and store it to.
+    :return: the parsed Mesh.
+    """
+    if cache is not None:
+        if not isinstance(cache, MeshCache):
+            cache = MeshCache(cache)
+        mesh = cache.load(path)
+        if mesh is None:
+            mesh = read_obj_file(path, bulk=bulk, chunk_size=chunk_size)
+            cache.store(path, mesh)
+        return mesh
+
+    with span('read_obj_file', path=path, bulk=bulk):
+        if bulk:
+            return _read_obj_file_bulk(path, chunk_size)
+        return _read_obj_file_lines(path)
+
+
+def _read_obj_file_lines(path):
+    count('bytes_read', os.path.getsize(path))
     vertices = []
     faces = []
     normals = []
@@ -127,6 +160,263 @@ def read_obj_file(path):
                 object_ids)
 
 
+class _BulkParseState:
+    """
+    Name tables and current ids carried across chunks by the bulk parser.
+    """
+
+    def __init__(self):
+        self.material_ids = OrderedDict([])
+        self.group_ids = {}
+        self.object_ids = {}
+        self.current_material_id = -1
+        self.current_group_id = -1
+        self.current_object_id = -1
+
+    def update(self, line):
+        parts = line.decode().split()
+        if parts[0] == OBJ_MTL_USE_MARKER:
+            self.current_material_id = self.material_ids.setdefault(
+                parts[1], len(self.material_ids))
+        elif parts[0] == OBJ_GROUP_NAME_MARKER:
+            self.current_group_id = self.group_ids.setdefault(
+                parts[1], len(self.group_ids))
+        elif parts[0] == OBJ_OBJECT_NAME_MARKER:
+            self.current_object_id = self.object_ids.setdefault(
+                parts[1], len(self.object_ids))
+
+    @property
+    def current_ids(self):
+        return (self.current_material_id, self.current_group_id,
+                self.current_object_id)
+
+
+_TAG_OTHER = 0
+_TAG_VERTEX = 1
+_TAG_NORMAL = 2
+_TAG_UV = 3
+_TAG_FACE = 4
+_TAG_STATE = 5
+
+_SPACE = ord(' ')
+_TAB = ord('\t')
+_NEWLINE = ord('\n')
+_CARRIAGE_RETURN = ord('\r')
+_SLASH = ord('/')
+
+
+def _is_blank(chars):
+    return (chars == _SPACE) | (chars == _TAB)
+
+
+def _is_whitespace(chars):
+    return (_is_blank(chars) | (chars == _NEWLINE)
+            | (chars == _CARRIAGE_RETURN))
+
+
+def _classify_lines(buf, starts):
+    """
+    Tags each line of the chunk by its record type using only the first three
+    characters of the line.
+    """
+    padded = np.concatenate((buf, np.full(3, _NEWLINE, dtype=np.uint8)))
+    c0 = padded[starts]
+    c1 = padded[starts + 1]
+    c2 = padded[starts + 2]
+
+    tags = np.full(len(starts), _TAG_OTHER, dtype=np.int8)
+    is_v = c0 == ord(OBJ_VERTEX_MARKER)
+    tags[is_v & _is_blank(c1)] = _TAG_VERTEX
+    tags[is_v & (c1 == ord('n')) & _is_blank(c2)] = _TAG_NORMAL
+    tags[is_v & (c1 == ord('t')) & _is_blank(c2)] = _TAG_UV
+    tags[(c0 == ord(OBJ_FACE_MARKER)) & _is_blank(c1)] = _TAG_FACE
+    tags[(c0 == ord('u'))
+         | (((c0 == ord(OBJ_GROUP_NAME_MARKER))
+             | (c0 == ord(OBJ_OBJECT_NAME_MARKER))) & _is_blank(c1))
+         ] = _TAG_STATE
+    return tags
+
+
+def _parse_float_run(text, num_records, marker):
+    """
+    Converts a run of 'v', 'vt' or 'vn' lines into a 2D float32 array.
+    """
+    num_cols = len(text.split(b'\n', 1)[0].split()) - 1
+    text = text.replace(marker.encode(), b' ' * len(marker))
+    # Parse as double and round once, exactly like the line parser does.
+    values = np.fromstring(text, dtype=np.float64, sep=' ')
+    if values.size != num_cols * num_records:
+        raise ValueError('Records have inconsistent number of components.')
+    return values.reshape(-1, num_cols).astype(np.float32)
+
+
+def _parse_face_corners(corners):
+    """
+    Converts 'v', 'v/vt', 'v//vn' or 'v/vt/vn' corner tokens into an (N, 3)
+    array of (vertex, uv, normal) indices where 0 marks a missing index.
+    """
+    corners = np.char.replace(np.array(corners), b'//', b'/0/')
+    num_slashes = np.char.count(corners, b'/')
+    out = np.zeros((len(corners), 3), dtype=np.int64)
+    for k in np.unique(num_slashes):
+        if k > 2:
+            raise ValueError('Invalid face corner {}'.format(
+                corners[num_slashes == k][0].decode()))
+        mask = num_slashes == k
+        text = b' '.join(corners[mask].tolist()).replace(b'/', b' ')
+        values = np.fromstring(text, dtype=np.int64, sep=' ')
+        out[mask, :k + 1] = values.reshape(-1, k + 1)
+    return out
+
+
+def _parse_face_run(text, buf, starts, ends):
+    """
+    Parses a run of face lines into an (F, 3, 3) array of 1-based indices
+    indexed by face, corner and (vertex, uv, normal), with 0 marking a
+    missing index. Only the first three corners of each face are used.
+    """
+    is_slash = buf == _SLASH
+    slash_counts = np.concatenate(([0], np.cumsum(is_slash)))
+    num_slashes = slash_counts[ends] - slash_counts[starts]
+    is_double = np.concatenate((is_slash[:-1] & is_slash[1:], [False]))
+    double_counts = np.concatenate(([0], np.cumsum(is_double)))
+    num_doubles = double_counts[ends] - double_counts[starts]
+    is_token_start = ~_is_whitespace(buf) & _is_whitespace(
+        np.concatenate(([_SPACE], buf[:-1])))
+    token_counts = np.concatenate(([0], np.cumsum(is_token_start)))
+    num_tokens = token_counts[ends] - token_counts[starts]
+
+    num_faces = len(starts)
+    homogeneous = (np.all(num_tokens == 4)
+                   and np.all(num_slashes == num_slashes[0])
+                   and np.all(num_doubles == num_doubles[0])
+                   and num_slashes[0] in (0, 3, 6)
+                   and num_doubles[0] in (0, 3))
+    if not homogeneous:
+        lines = text.split(b'\n')
+        corners = [c for line in lines for c in line.split()[1:4]]
+        return _parse_face_corners(corners).reshape(-1, 3, 3)
+
+    num_components = num_slashes[0] // 3 + 1
+    text = text.replace(OBJ_FACE_MARKER.encode(), b' ')
+    if num_doubles[0] > 0:
+        text = text.replace(b'//', b'/0/')
+    text = text.replace(b'/', b' ')
+    values = np.fromstring(text, dtype=np.int64, sep=' ')
+    if values.size != num_faces * 3 * num_components:
+        raise ValueError('Could not parse face records.')
+    out = np.zeros((num_faces, 3, 3), dtype=np.int64)
+    out[:, :, :num_components] = values.reshape(num_faces, 3,
+                                                num_components)
+    return out
+
+
+def _face_arrays(face_indices, face_ids):
+    """
+    Builds the face arrays consumed by Mesh from bulk parsed indices.
+    """
+    face_indices = face_indices - 1
+    return {
+        'vertices': face_indices[:, :, 0],
+        'uvs': face_indices[:, :, 1],
+        'normals': face_indices[:, :, 2],
+        'material': face_ids[:, 0],
+        'group': face_ids[:, 1],
+        'object': face_ids[:, 2],
+    }
+
+
+def _read_chunks(f, chunk_size):
+    """
+    Yields chunks of whole lines with surrounding whitespace stripped from
+    every line.
+    """
+    while True:
+        chunk = f.read(chunk_size)
+        if len(chunk) == 0:
+            return
+        chunk += f.readline()
+        count('bytes_read', len(chunk))
+        buf = np.frombuffer(chunk, dtype=np.uint8)
+        line_starts = np.concatenate(([0], np.flatnonzero(buf == _NEWLINE)
+                                      + 1))
+        line_starts = line_starts[line_starts < len(buf)]
+        if np.any(_is_blank(buf[line_starts])):
+            chunk = b'\n'.join([l.strip() for l in chunk.split(b'\n')])
+        yield chunk
+
+
+def _read_obj_file_bulk(path, chunk_size):
+    vertex_chunks = []
+    normal_chunks = []
+    uv_chunks = []
+    face_chunks = []
+    face_id_chunks = []
+    state = _BulkParseState()
+
+    with open(path, 'rb') as f:
+        for chunk in _read_chunks(f, chunk_size):
+            buf = np.frombuffer(chunk, dtype=np.uint8)
+            newlines = np.flatnonzero(buf == _NEWLINE)
+            starts = np.concatenate(([0], newlines + 1))
+            ends = np.concatenate((newlines, [len(buf)]))
+            tags = _classify_lines(buf, starts)
+
+            # Split lines into runs of consecutive records of the same type.
+            run_starts = np.flatnonzero(np.diff(tags, prepend=-1))
+            run_ends = np.append(run_starts[1:], len(tags))
+            for run_start, run_end in zip(run_starts, run_ends):
+                tag = tags[run_start]
+                text = chunk[starts[run_start]:ends[run_end - 1]]
+                num_records = run_end - run_start
+                if tag == _TAG_VERTEX:
+                    vertex_chunks.append(_parse_float_run(
+                        text, num_records, OBJ_VERTEX_MARKER))
+                elif tag == _TAG_NORMAL:
+                    normal_chunks.append(_parse_float_run(
+                        text, num_records, OBJ_NORMAL_MARKER))
+                elif tag == _TAG_UV:
+                    uv_chunks.append(_parse_float_run(
+                        text, num_records, OBJ_UV_MARKER))
+                elif tag == _TAG_FACE:
+                    offset = starts[run_start]
+                    run_buf = buf[offset:ends[run_end - 1]]
+                    face_chunks.append(_parse_face_run(
+                        text, run_buf,
+                        starts[run_start:run_end] - offset,
+                        ends[run_start:run_end] - offset))
+                    face_ids = np.empty((num_records, 3), dtype=np.int64)
+                    face_ids[:] = state.current_ids
+                    face_id_chunks.append(face_ids)
+                elif tag == _TAG_STATE:
+                    for line in text.split(b'\n'):
+                        state.update(line)
+
+    def _concatenate(chunks, num_cols):
+        if len(chunks) == 0:
+            return np.zeros((0, num_cols), dtype=np.float32)
+        return np.concatenate(chunks)
+
+    if len(face_chunks) > 0:
+        faces = _face_arrays(np.concatenate(face_chunks),
+                             np.concatenate(face_id_chunks))
+    else:
+        faces = _face_arrays(np.zeros((0, 3, 3), dtype=np.int64),
+                             np.zeros((0, 3), dtype=np.int64))
+
+    materials = OrderedDict([])
+    for name in state.material_ids:
+        materials[name] = Material(name, state.material_ids[name])
+
+    return Mesh(_concatenate(vertex_chunks, 3),
+                faces,
+                _concatenate(normal_chunks, 3),
+                _concatenate(uv_chunks, 2),
+                materials,
+                state.group_ids,
+                state.object_ids)
+
+
 def read_mtl_file(path, model):
     materials = {}
     with open(path, 'r') as f:
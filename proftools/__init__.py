@@ -0,0 +1,2 @@
+from .trace import (span, traced, count, enable, disable, is_enabled, reset,
+                    counters, chrome_trace, write_chrome_trace, summary)
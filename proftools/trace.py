@@ -0,0 +1,231 @@
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+# Recording is off unless enabled, so instrumented code only pays for a
+# flag check and, for spans, returning a shared no-op context manager.
+_enabled = False
+_track_memory = False
+_started_tracemalloc = False
+
+_lock = threading.Lock()
+_local = threading.local()
+_origin = time.perf_counter()
+# Finished spans as (name, start, duration, thread id, depth, args, bytes
+# allocated), times in seconds since _origin.
+_spans = []
+_counters = OrderedDict()
+# Counter samples as (name, time, running total).
+_counter_samples = []
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+class _Span:
+    __slots__ = ('name', 'args', 'start', 'depth', 'alloc_start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        stack = _stack()
+        self.depth = len(stack)
+        stack.append(self)
+        self.alloc_start = (tracemalloc.get_traced_memory()[0]
+                            if _track_memory else None)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        allocated = None
+        if self.alloc_start is not None and tracemalloc.is_tracing():
+            allocated = tracemalloc.get_traced_memory()[0] - self.alloc_start
+        stack = _stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        with _lock:
+            _spans.append((self.name, self.start - _origin,
+                           end - self.start, threading.get_ident(),
+                           self.depth, self.args, allocated))
+        return False
+
+
+def span(name, **args):
+    """
+    Times a block as a named span, nested in any span open on the same
+    thread:
+
+        with span('read_obj_file', path=path):
+            ...
+
+    :param args: values attached to the span in the trace.
+    :return: a context manager, a shared no-op one when disabled.
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def traced(name=None):
+    """
+    Decorator running every call of a function in a span, named after the
+    function's qualified name by default.
+    """
+    def decorator(func):
+        span_name = func.__qualname__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Span(span_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    """
+    Adds value to a named counter, e.g. 'bytes_read'.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        total = _counters.get(name, 0) + value
+        _counters[name] = total
+        _counter_samples.append((name, time.perf_counter() - _origin, total))
+
+
+def enable(track_memory=False):
+    """
+    Starts recording spans and counters.
+    :param track_memory: if True, also record the bytes allocated during
+                         each span with tracemalloc, which slows down
+                         allocation heavy code.
+    """
+    global _enabled, _track_memory, _started_tracemalloc
+    if track_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+    _track_memory = track_memory
+    _enabled = True
+
+
+def disable():
+    """
+    Stops recording. Recorded data is kept until reset().
+    """
+    global _enabled, _track_memory, _started_tracemalloc
+    _enabled = False
+    _track_memory = False
+    if _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """
+    Drops all recorded spans and counters.
+    """
+    with _lock:
+        del _spans[:]
+        del _counter_samples[:]
+        _counters.clear()
+
+
+def counters():
+    """
+    :return: dict of counter totals.
+    """
+    with _lock:
+        return dict(_counters)
+
+
+def chrome_trace():
+    """
+    :return: the recorded spans and counters in the Chrome trace event
+             format, viewable in chrome://tracing or Perfetto.
+    """
+    pid = os.getpid()
+    with _lock:
+        spans = list(_spans)
+        samples = list(_counter_samples)
+    events = []
+    for name, start, duration, tid, depth, args, allocated in spans:
+        args = {k: v if isinstance(v, (int, float, bool)) else str(v)
+                for k, v in args.items()}
+        if allocated is not None:
+            args['allocated_bytes'] = allocated
+        events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                       'ts': start * 1e6, 'dur': duration * 1e6,
+                       'args': args})
+    for name, timestamp, total in samples:
+        events.append({'name': name, 'ph': 'C', 'pid': pid,
+                       'ts': timestamp * 1e6, 'args': {name: total}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_chrome_trace(path):
+    with open(path, 'w') as f:
+        json.dump(chrome_trace(), f)
+
+
+def summary():
+    """
+    :return: a table of the calls, total, mean and maximum time and the
+             allocated bytes of every span name, followed by the counters.
+    """
+    rows = OrderedDict()
+    with _lock:
+        spans = list(_spans)
+        totals = dict(_counters)
+    for name, _, duration, _, _, _, allocated in spans:
+        row = rows.setdefault(name, [0, 0.0, 0.0, None])
+        row[0] += 1
+        row[1] += duration
+        row[2] = max(row[2], duration)
+        if allocated is not None:
+            row[3] = (row[3] or 0) + allocated
+
+    lines = ['{:<32} {:>7} {:>11} {:>10} {:>10} {:>11}'.format(
+        'span', 'calls', 'total ms', 'mean ms', 'max ms', 'alloc MB')]
+    for name, (calls, total, longest, allocated) in sorted(
+            rows.items(), key=lambda item: -item[1][1]):
+        lines.append('{:<32} {:>7} {:>11.2f} {:>10.3f} {:>10.3f} {:>11}'.format(
+            name, calls, total * 1e3, total / calls * 1e3, longest * 1e3,
+            '-' if allocated is None
+            else '{:.2f}'.format(allocated / 2 ** 20)))
+    if totals:
+        lines.append('')
+        lines.append('{:<32} {:>15}'.format('counter', 'total'))
+        for name, total in totals.items():
+            lines.append('{:<32} {:>15}'.format(name, total))
+    return '\n'.join(lines)
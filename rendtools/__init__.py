@@ -1,3 +1,5 @@
 from .camera import *
+from .camera_set import CameraSet
 from .core import *
+from .headless import HeadlessRenderer
 from .materials import *
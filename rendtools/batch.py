@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from skimage import io as imio
+
+from .gsd import (GSDScene, create_camera, create_camera_set,
+                  create_lights)
+from .headless import HeadlessRenderer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZE = (800, 600)
+DEFAULT_CLEAR_COLOR = (1.0, 1.0, 1.0)
+MAX_CACHED_SCENES = 2
+
+# Scenes loaded by this worker process, keyed by scene_key.
+_scenes = OrderedDict()
+
+
+def load_manifest(path):
+    """
+    Reads a job manifest. A manifest is a JSON object with a list of 'jobs'
+    and optional 'defaults' merged into every job. Each job is a GSD scene
+    dict (mesh, materials, lights) plus a 'camera' dict (see
+    gsd.create_camera), and optionally an 'id' and an image 'size'. A job
+    with a 'camera_path' dict (see gsd.create_camera_set) instead expands
+    into one job per camera of the path.
+    :return: list of job dicts with an 'id' each.
+    """
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    defaults = manifest.get('defaults', {})
+    jobs = []
+    for i, job in enumerate(manifest['jobs']):
+        job = {**defaults, **job}
+        job.setdefault('id', 'job_{:06d}'.format(i))
+        if 'camera_path' not in job:
+            jobs.append(job)
+            continue
+        # Expand a camera path into one job per camera.
+        path_dict = job.pop('camera_path')
+        cameras = create_camera_set(path_dict,
+                                    tuple(job.get('size', DEFAULT_SIZE)))
+        for j in range(len(cameras)):
+            jobs.append(dict(job, id='{}_{:05d}'.format(job['id'], j),
+                             camera=cameras.camera_dict(j)))
+    return jobs
+
+
+def scene_key(job):
+    """
+    Identifies the loaded assets a job needs.
+    """
+    return json.dumps([job['mesh'], job['materials'],
+                       job.get('indexed', False), job.get('lod', False)],
+                      sort_keys=True)
+
+
+def output_path(output_dir, job):
+    return os.path.join(output_dir, '{}.png'.format(job['id']))
+
+
+def _get_scene(job):
+    key = scene_key(job)
+    scene = _scenes.pop(key, None)
+    if scene is None:
+        # Workers have no GL context, so GL objects would only queue copies
+        # of the data that are never sent.
+        scene = GSDScene(job, gl=False)
+        while len(_scenes) >= MAX_CACHED_SCENES:
+            _scenes.popitem(last=False)
+    _scenes[key] = scene
+    return scene
+
+
+def _save_atomic(path, save_func, data):
+    root, ext = os.path.splitext(path)
+    tmp_path = '{}.tmp-{}{}'.format(root, uuid.uuid4().hex, ext)
+    save_func(tmp_path, data)
+    os.replace(tmp_path, path)
+
+
+def render_job(job, output_dir, save_aovs=False):
+    """
+    Renders a job in the current process and writes its image.
+    :return: (job id, seconds spent rendering).
+    """
+    start_time = time.perf_counter()
+    scene = _get_scene(job)
+    size = tuple(job.get('size', DEFAULT_SIZE))
+    camera = create_camera(job['camera'], size)
+    renderer = HeadlessRenderer(
+        size, camera.near, camera.far, camera,
+        scene.select_lods(camera, size),
+        create_lights(job),
+        clear_color=job.get('clear_color', DEFAULT_CLEAR_COLOR))
+    buffers = renderer.render()
+
+    path = output_path(output_dir, job)
+    if save_aovs:
+        aovs = {k: v for k, v in buffers.items() if k != 'color'}
+        _save_atomic(os.path.splitext(path)[0] + '.npz',
+                     lambda p, d: np.savez(p, **d), aovs)
+    image = (buffers['color'] * 255 + 0.5).astype(np.uint8)
+    # The image is written last, so its presence marks a finished job.
+    _save_atomic(path, imio.imsave, image)
+    return job['id'], time.perf_counter() - start_time
+
+
+def assign_jobs(jobs, num_workers):
+    """
+    Assigns jobs to workers so jobs sharing a mesh run in the same process
+    and reuse its loaded assets. Groups larger than an even share are split,
+    and groups are assigned largest first to the least loaded worker.
+    :return: list of job lists, one per worker.
+    """
+    groups = OrderedDict()
+    for job in sorted(jobs, key=scene_key):
+        groups.setdefault(job['mesh'], []).append(job)
+
+    share = max(1, -(-len(jobs) // num_workers))
+    pieces = []
+    for group in groups.values():
+        for start in range(0, len(group), share):
+            pieces.append(group[start:start + share])
+
+    assignments = [[] for _ in range(num_workers)]
+    for piece in sorted(pieces, key=len, reverse=True):
+        min(assignments, key=len).extend(piece)
+    return assignments
+
+
+def run_batch(jobs, output_dir, num_workers=4, overwrite=False,
+              save_aovs=False):
+    """
+    Renders jobs over a pool of worker processes, writing images to
+    output_dir as they finish. Jobs whose image already exists are skipped
+    unless overwrite is set, so interrupted runs can be resumed. A failing
+    job is logged with its traceback and does not stop the others.
+    :return: (number of images rendered, list of ids of failed jobs).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    pending = [job for job in jobs
+               if overwrite or not os.path.exists(
+                   output_path(output_dir, job))]
+    logger.info('Rendering %d of %d jobs (%d already done).', len(pending),
+                len(jobs), len(jobs) - len(pending))
+    if len(pending) == 0:
+        return 0, []
+
+    # One single-process executor per worker pins each job to the process
+    # holding its assets.
+    assignments = [a for a in assign_jobs(pending, num_workers) if a]
+    executors = [ProcessPoolExecutor(max_workers=1) for _ in assignments]
+    start_time = time.perf_counter()
+    num_done = 0
+    failed = []
+    futures = {}
+    try:
+        for executor, worker_jobs in zip(executors, assignments):
+            for job in worker_jobs:
+                futures[executor.submit(render_job, job, output_dir,
+                                        save_aovs)] = job['id']
+        for future in as_completed(futures):
+            try:
+                job_id, render_time = future.result()
+            except Exception as e:
+                failed.append(futures[future])
+                logger.error('Job %s failed.', futures[future], exc_info=e)
+                continue
+            num_done += 1
+            elapsed = time.perf_counter() - start_time
+            logger.info('[%d/%d] Rendered %s in %.2fs (%.2f images/s)',
+                        num_done, len(pending), job_id, render_time,
+                        num_done / elapsed)
+    finally:
+        for future in futures:
+            future.cancel()
+        for executor in executors:
+            executor.shutdown()
+
+    elapsed = time.perf_counter() - start_time
+    logger.info('Rendered %d images in %.2fs (%.2f images/s)', num_done,
+                elapsed, num_done / elapsed)
+    if failed:
+        logger.error('%d of %d jobs failed: %s', len(failed), len(pending),
+                     ', '.join(sorted(failed)))
+    return num_done, failed
@@ -1,4 +1,5 @@
 import numpy as np
+from numpy import linalg
 from vispy import util
 from vispy.util.quaternion import Quaternion
 
@@ -7,11 +8,42 @@ from . import vector_utils
 
 
 class BaseCamera:
+    """
+    Base class of cameras. Matrices are computed by compute_perspective_mat
+    and compute_view_mat and cached until the camera changes. Assigning any
+    public attribute increments version and drops the cached matrices; call
+    touch() after changing an array attribute in place.
+    """
+
     def __init__(self, size, near, far):
         self.size = size
         self.near = near
         self.far = far
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if not name.startswith('_'):
+            self.touch()
+
+    def touch(self):
+        """
+        Marks the camera as changed.
+        """
+        self._version = getattr(self, '_version', 0) + 1
+        self._matrices = {}
+
+    @property
+    def version(self):
+        return self._version
+
+    def _cached(self, name, compute):
+        matrix = self._matrices.get(name)
+        if matrix is None:
+            matrix = np.array(compute())
+            matrix.flags.writeable = False
+            self._matrices[name] = matrix
+        return matrix
+
     @property
     def size(self):
         return self._size
@@ -24,36 +56,119 @@ class BaseCamera:
         self.top = self.size[1] / 2
         self.bottom = -self.size[1] / 2
 
-    def perspective_mat(self):
+    def compute_perspective_mat(self):
         raise NotImplementedError
 
-    def view_mat(self):
+    def compute_view_mat(self):
         raise NotImplementedError
 
+    def perspective_mat(self):
+        return self._cached('perspective', self.compute_perspective_mat)
+
+    def view_mat(self):
+        return self._cached('view', self.compute_view_mat)
+
+    def inv_view_mat(self):
+        return self._cached('inv_view',
+                            lambda: linalg.inv(self.view_mat()))
+
+    def cam_pos(self):
+        """
+        :return: position of the camera in world space, (N, 3) positions
+                 for a stack of cameras.
+        """
+        return self._cached('cam_pos',
+                            lambda: self.inv_view_mat()[..., :3, 3])
+
+    @property
+    def is_stacked(self):
+        return False
+
+    def _check_single(self, method):
+        if self.is_stacked:
+            raise ValueError(
+                '{} needs a single camera, index the stack of {} cameras '
+                'first.'.format(method, len(self)))
+
     def handle_mouse(self):
         pass
 
     def unproject(self, x: np.ndarray, y: np.ndarray, depth: np.ndarray):
+        self._check_single('unproject')
         return graphics_utils.unproject(*self.size,
                                         self.perspective_mat(),
                                         self.view_mat(),
                                         x, y, depth)
 
+    def pixel_rays(self, x, y):
+        """
+        Rays through window positions, in pixels from the top left corner.
+        :return: (N, 3) ray origins on the near plane and (N, 3) unit
+                 directions, in world space.
+        """
+        self._check_single('pixel_rays')
+        x = np.asarray(x, dtype=np.float64).ravel()
+        y = np.asarray(y, dtype=np.float64).ravel()
+        near = self.unproject(x, y, np.zeros_like(x))
+        far = self.unproject(x, y, np.ones_like(x))
+        directions = far - near
+        return near, directions / linalg.norm(directions, axis=1)[:, None]
+
+    def unproject_depth_map(self, depth, mask=None, **kwargs):
+        """
+        Unprojects a whole depth map in chunks, see
+        graphics_utils.unproject_depth_map.
+        """
+        self._check_single('unproject_depth_map')
+        return graphics_utils.unproject_depth_map(*self.size,
+                                                  self.perspective_mat(),
+                                                  self.view_mat(),
+                                                  depth, mask, **kwargs)
+
 
 class CalibratedCamera(BaseCamera):
     def __init__(self, extrinsic: np.ndarray, intrinsic: np.ndarray,
                  *args, **kwargs):
+        """
+        :param extrinsic: 3x4 extrinsic matrix, or an (N, 3, 4) stack for a
+                          set of cameras.
+        :param intrinsic: 3x3 intrinsic matrix, or an (N, 3, 3) stack. A
+                          single intrinsic is shared by stacked extrinsics.
+        With stacks, view_mat and perspective_mat return (N, 4, 4) stacks.
+        """
         super().__init__(*args, **kwargs)
         self.extrinsic = extrinsic
         self.intrinsic = intrinsic
 
-    def perspective_mat(self):
+    @property
+    def is_stacked(self):
+        return np.ndim(self.extrinsic) == 3 or np.ndim(self.intrinsic) == 3
+
+    def __len__(self):
+        if not self.is_stacked:
+            return 1
+        return max(len(m) for m in (self.extrinsic, self.intrinsic)
+                   if np.ndim(m) == 3)
+
+    def __getitem__(self, index):
+        """
+        :return: the single CalibratedCamera at index of a stack.
+        """
+        def _pick(mat):
+            return mat[index] if np.ndim(mat) == 3 else mat
+        return CalibratedCamera(_pick(self.extrinsic), _pick(self.intrinsic),
+                                self.size, self.near, self.far)
+
+    def compute_perspective_mat(self):
+        intrinsic = self.intrinsic
+        if self.is_stacked and np.ndim(intrinsic) == 2:
+            intrinsic = np.broadcast_to(intrinsic, (len(self), 3, 3))
         return graphics_utils.intrinsic_to_opengl_projection(
-            self.intrinsic,
+            intrinsic,
             self.left, self.right, self.top, self.bottom,
             self.near, self.far)
 
-    def view_mat(self):
+    def compute_view_mat(self):
         return graphics_utils.extrinsic_to_opengl_modelview(self.extrinsic)
 
 
@@ -70,12 +185,12 @@ class PerspectiveCamera(BaseCamera):
     def forward(self):
         return vector_utils.normalized(self.lookat - self.position)
 
-    def perspective_mat(self):
+    def compute_perspective_mat(self):
         mat = util.transforms.perspective(
             self.fov, self.size[0] / self.size[1], self.near, self.far).T
         return mat
 
-    def view_mat(self):
+    def compute_view_mat(self):
         forward = self.forward()
         rotation_mat = np.eye(3)
         rotation_mat[0, :] = vector_utils.normalized(
@@ -0,0 +1,217 @@
+import numpy as np
+
+from .camera import PerspectiveCamera
+
+
+def _normalized(vectors):
+    norm = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norm == 0, 1.0, norm)
+
+
+def look_at_view_mats(positions, lookats, ups):
+    """
+    Computes view matrices like PerspectiveCamera.view_mat for many cameras
+    at once.
+    :param positions, lookats, ups: (N, 3) arrays, or (3,) broadcast to all.
+    :return: (N, 4, 4) view matrices.
+    """
+    positions = np.atleast_2d(np.asarray(positions, dtype=np.float64))
+    lookats = np.broadcast_to(np.asarray(lookats, dtype=np.float64),
+                              positions.shape)
+    ups = np.broadcast_to(np.asarray(ups, dtype=np.float64), positions.shape)
+
+    forward = _normalized(lookats - positions)
+    right = np.cross(forward, ups)
+    # Cameras looking along their up vector get an arbitrary orthogonal one.
+    degenerate = np.linalg.norm(right, axis=1) < 1e-8
+    if degenerate.any():
+        right[degenerate] = np.cross(forward[degenerate], [1.0, 0.0, 0.0])
+    right = _normalized(right)
+    back = -forward
+    up = np.cross(back, right)
+
+    view_mats = np.zeros((len(positions), 4, 4))
+    view_mats[:, 0, :3] = right
+    view_mats[:, 1, :3] = up
+    view_mats[:, 2, :3] = back
+    view_mats[:, :3, 3] = -np.einsum('nij,nj->ni', view_mats[:, :3, :3],
+                                     positions)
+    view_mats[:, 3, 3] = 1.0
+    return view_mats
+
+
+def perspective_mats(fovs, aspect, near, far):
+    """
+    Computes perspective matrices like PerspectiveCamera.perspective_mat for
+    many fields of view at once.
+    :param fovs: (N,) vertical fields of view in degrees.
+    :return: (N, 4, 4) perspective matrices.
+    """
+    fovs = np.atleast_1d(np.asarray(fovs, dtype=np.float64))
+    cot = 1.0 / np.tan(fovs / 360.0 * np.pi)
+    mats = np.zeros((len(fovs), 4, 4))
+    mats[:, 0, 0] = cot / aspect
+    mats[:, 1, 1] = cot
+    mats[:, 2, 2] = -(far + near) / (far - near)
+    mats[:, 2, 3] = -2.0 * near * far / (far - near)
+    mats[:, 3, 2] = -1.0
+    return mats
+
+
+def orbit_positions(num, radius, elevation=0.0, center=(0, 0, 0),
+                    start_angle=0.0):
+    """
+    Positions evenly spaced on a horizontal circle around center.
+    :param elevation: angle above the horizontal plane in degrees.
+    :return: (num, 3) positions.
+    """
+    azimuths = (np.radians(start_angle)
+                + np.arange(num) * (2 * np.pi / num))
+    elevation = np.radians(elevation)
+    positions = radius * np.stack((np.cos(elevation) * np.sin(azimuths),
+                                   np.full(num, np.sin(elevation)),
+                                   np.cos(elevation) * np.cos(azimuths)),
+                                  axis=1)
+    return positions + np.asarray(center, dtype=np.float64)
+
+
+def hemisphere_positions(num, radius, center=(0, 0, 0), min_elevation=0.0):
+    """
+    Positions spread evenly over the upper (+y) hemisphere with a Fibonacci
+    spiral.
+    :param min_elevation: lowest elevation in degrees.
+    :return: (num, 3) positions.
+    """
+    min_height = np.sin(np.radians(min_elevation))
+    heights = 1.0 - (np.arange(num) + 0.5) / num * (1.0 - min_height)
+    azimuths = np.arange(num) * np.pi * (3.0 - np.sqrt(5.0))
+    rings = np.sqrt(1.0 - heights * heights)
+    positions = radius * np.stack((rings * np.sin(azimuths), heights,
+                                   rings * np.cos(azimuths)), axis=1)
+    return positions + np.asarray(center, dtype=np.float64)
+
+
+def spline_positions(control_points, num, closed=False):
+    """
+    Samples a Catmull-Rom spline through control points at num parameters
+    evenly spaced over its segments.
+    :param control_points: (K, 3) points, K >= 2.
+    :return: (num, 3) positions.
+    """
+    points = np.asarray(control_points, dtype=np.float64)
+    if closed:
+        padded = np.concatenate((points[-1:], points, points[:2]))
+        num_segments = len(points)
+    else:
+        padded = np.concatenate((2 * points[:1] - points[1:2], points,
+                                 2 * points[-1:] - points[-2:-1]))
+        num_segments = len(points) - 1
+
+    params = np.arange(num) * (num_segments / (num if closed
+                                               else max(num - 1, 1)))
+    segments = np.minimum(params.astype(np.int64), num_segments - 1)
+    t = (params - segments)[:, None]
+    p0, p1, p2, p3 = (padded[segments + k] for k in range(4))
+    return 0.5 * (2 * p1 + (p2 - p0) * t
+                  + (2 * p0 - 5 * p1 + 4 * p2 - p3) * t ** 2
+                  + (3 * p1 - p0 - 3 * p2 + p3) * t ** 3)
+
+
+class CameraSet:
+    """
+    A set of perspective cameras sharing an image size and clipping planes,
+    whose matrices are computed for all cameras in one vectorized pass.
+    """
+
+    def __init__(self, size, near, far, fov, positions, lookats=(0, 0, 0),
+                 ups=(0, 1, 0)):
+        """
+        :param fov: field of view in degrees, one or one per camera.
+        :param positions: (N, 3) camera positions.
+        :param lookats, ups: (N, 3) or (3,) for all cameras.
+        """
+        self.size = size
+        self.near = near
+        self.far = far
+        self.positions = np.atleast_2d(np.asarray(positions,
+                                                  dtype=np.float64))
+        shape = self.positions.shape
+        self.lookats = np.broadcast_to(
+            np.asarray(lookats, dtype=np.float64), shape).copy()
+        self.ups = np.broadcast_to(
+            np.asarray(ups, dtype=np.float64), shape).copy()
+        self.fovs = np.broadcast_to(
+            np.asarray(fov, dtype=np.float64), shape[:1]).copy()
+
+    @classmethod
+    def orbit(cls, size, near, far, fov, num, radius, elevation=0.0,
+              center=(0, 0, 0), start_angle=0.0):
+        """
+        Turntable cameras looking at center, see orbit_positions.
+        """
+        return cls(size, near, far, fov,
+                   orbit_positions(num, radius, elevation, center,
+                                   start_angle),
+                   lookats=center)
+
+    @classmethod
+    def hemisphere(cls, size, near, far, fov, num, radius, center=(0, 0, 0),
+                   min_elevation=0.0):
+        """
+        Cameras spread over the upper hemisphere looking at center, see
+        hemisphere_positions.
+        """
+        return cls(size, near, far, fov,
+                   hemisphere_positions(num, radius, center, min_elevation),
+                   lookats=center)
+
+    @classmethod
+    def spline(cls, size, near, far, fov, num, control_points,
+               lookat=(0, 0, 0), closed=False):
+        """
+        Cameras along a Catmull-Rom spline looking at lookat, see
+        spline_positions.
+        """
+        return cls(size, near, far, fov,
+                   spline_positions(control_points, num, closed),
+                   lookats=lookat)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, index):
+        """
+        :return: the PerspectiveCamera at index.
+        """
+        return PerspectiveCamera(self.size, self.near, self.far,
+                                 float(self.fovs[index]),
+                                 self.positions[index], self.lookats[index],
+                                 self.ups[index])
+
+    def view_mats(self):
+        """
+        :return: (N, 4, 4) view matrices.
+        """
+        return look_at_view_mats(self.positions, self.lookats, self.ups)
+
+    def perspective_mats(self):
+        """
+        :return: (N, 4, 4) perspective matrices.
+        """
+        return perspective_mats(self.fovs, self.size[0] / self.size[1],
+                                self.near, self.far)
+
+    def camera_dict(self, index):
+        """
+        :return: the camera at index as a GSD camera dict, see
+                 gsd.create_camera.
+        """
+        return {
+            'type': 'perspective',
+            'fov': float(self.fovs[index]),
+            'position': self.positions[index].tolist(),
+            'lookat': self.lookats[index].tolist(),
+            'up': self.ups[index].tolist(),
+            'near': self.near,
+            'far': self.far,
+        }
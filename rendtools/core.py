@@ -1,33 +1,264 @@
+import hashlib
+
 import numpy as np
 from numpy import linalg
 from vispy import gloo, app
+
+import proftools
 from . import vector_utils
 
+# Counts of GL work issued through ProgramCache programs and Renderables:
+# programs compiled, uniform values set, attributes bound to programs and
+# vertex buffer uploads. See reset_stats.
+stats = {
+    'compilations': 0,
+    'uniform_uploads': 0,
+    'attribute_binds': 0,
+    'buffer_uploads': 0,
+}
+
+
+def reset_stats():
+    for key in stats:
+        stats[key] = 0
+
+
+# Values compared by content rather than identity when rebinding.
+_VALUE_TYPES = (np.ndarray, np.generic, int, float, tuple, list)
+
+
+def _same_value(a, b):
+    if a is b:
+        return True
+    if isinstance(a, _VALUE_TYPES) and isinstance(b, _VALUE_TYPES):
+        return np.array_equal(a, b)
+    return False
+
+
+class TrackedProgram:
+    """
+    Wraps a gloo.Program and only forwards variable assignments whose value
+    differs from the one last set, so rebinding unchanged uniforms, textures
+    or buffers costs no GL commands.
+    """
+
+    def __init__(self, program):
+        self.program = program
+        self._values = {}
+
+    def __setitem__(self, name, value):
+        if name in self._values and _same_value(self._values[name], value):
+            return
+        if isinstance(value, np.ndarray):
+            # Keep a snapshot so in-place changes are detected.
+            self._values[name] = value.copy()
+        else:
+            self._values[name] = value
+        if name.startswith('a_'):
+            stats['attribute_binds'] += 1
+        else:
+            stats['uniform_uploads'] += 1
+        self.program[name] = value
+
+    def __getitem__(self, name):
+        return self.program[name]
+
+    def __getattr__(self, name):
+        return getattr(self.program, name)
+
+    def draw(self, *args, **kwargs):
+        self.program.draw(*args, **kwargs)
+
+
+class ProgramCache:
+    """
+    Compiled programs keyed by the hash of their shader sources and the
+    number of lights, shared by all renderables using the same shaders.
+    """
+
+    def __init__(self):
+        self._programs = {}
+
+    def get(self, vert_source, frag_source, num_lights):
+        """
+        :return: the TrackedProgram for the given sources.
+        """
+        digest = hashlib.sha1(
+            (vert_source + '\0' + frag_source).encode()).hexdigest()
+        key = (digest, num_lights)
+        program = self._programs.get(key)
+        if program is None:
+            with proftools.span('compile_program', num_lights=num_lights):
+                program = TrackedProgram(gloo.Program(vert_source,
+                                                      frag_source))
+            stats['compilations'] += 1
+            self._programs[key] = program
+        return program
+
+    def clear(self):
+        self._programs.clear()
+
+    def __len__(self):
+        return len(self._programs)
+
+
+program_cache = ProgramCache()
+
 
 class Program:
     def __init__(self, vert_shader, frag_shader):
         self._vert_shader = vert_shader
         self._frag_shader = frag_shader
 
-    def compile(self, num_lights):
-        vs = self._vert_shader.substitute()
-        fs = self._frag_shader.substitute(num_lights=num_lights)
-        return gloo.Program(vs, fs)
+    def sources(self, num_lights, **params):
+        """
+        :param params: extra template substitutions for the shaders.
+        :return: vertex and fragment shader sources.
+        """
+        vs = self._vert_shader.substitute(**params)
+        fs = self._frag_shader.substitute(num_lights=num_lights, **params)
+        return vs, fs
+
+    def compile(self, num_lights, **params):
+        """
+        :param params: extra template substitutions for the shaders.
+        """
+        with proftools.span('compile_program', num_lights=num_lights):
+            return gloo.Program(*self.sources(num_lights, **params))
 
 
 class Renderable:
-    def __init__(self, material, attributes, num_lights):
+    def __init__(self, material, attributes, num_lights, cache=None,
+                 indices=None, gl=True):
+        """
+        :param cache: ProgramCache to take programs from, the shared
+                      program_cache by default.
+        :param indices: optional (F, 3) vertex indices of the triangles, see
+                        meshtools.indexing. Without them every three
+                        vertices form a triangle.
+        :param gl: if False, keep the attributes on the host only, for
+                   HeadlessRenderer. No program or buffers are created and
+                   the renderable cannot be bound.
+        """
         self.num_lights = num_lights
         self.material = material
-        self.program = material.compile(self.num_lights)
         self.attributes = attributes
+        self.indices = None if indices is None else np.asarray(
+            indices, dtype=np.uint32).reshape(-1, 3)
+        self.index_buffer = None
+        self._indices_dirty = indices is not None
+        self.cache = program_cache if cache is None else cache
+        self.gl = gl
+        self.program = None
+        # Whole-mesh uv transform applied in the vertex shader, so it can be
+        # changed without touching the vertex buffers.
+        self.uv_scale = np.ones(2, dtype=np.float32)
+        self.uv_offset = np.zeros(2, dtype=np.float32)
+        self._buffers = {}
+        self._dirty = set(attributes)
+        # Incremented whenever attribute data is uploaded, so caches of the
+        # geometry can tell when attributes changed in place.
+        self.version = 0
         self.update()
 
-    def update(self):
-        self.program = self.material.compile(self.num_lights)
-        for k, v in self.attributes.items():
-            self.program[k] = v
+    def set_attribute(self, name, values):
+        """
+        Replaces an attribute array, uploaded on the next update().
+        """
+        self.attributes[name] = values
+        self._dirty.add(name)
+
+    def set_indices(self, indices):
+        """
+        Replaces the triangle indices, uploaded on the next update().
+        """
+        self.indices = np.asarray(indices, dtype=np.uint32).reshape(-1, 3)
+        self._indices_dirty = True
+
+    def mark_dirty(self, *names):
+        """
+        Marks attributes changed in place, uploaded on the next update().
+        """
+        self._dirty.update(names)
+
+    def update_range(self, name, start, values):
+        """
+        Writes values into an attribute from vertex start on and uploads
+        just that range.
+        """
+        host = self.attributes[name]
+        host[start:start + len(values)] = values
+        if name in self._dirty or name not in self._buffers:
+            if not self.gl:
+                self.version += 1
+            return
+        self._buffers[name].set_subdata(
+            np.ascontiguousarray(host[start:start + len(values)],
+                                 dtype=np.float32), offset=start)
+        stats['buffer_uploads'] += 1
+        self.version += 1
+
+    def update(self, *names):
+        """
+        Takes the program for the material's current shaders from the cache
+        and uploads the attributes marked dirty, see set_attribute and
+        mark_dirty. Called with names, those attributes are marked dirty
+        first. If nothing is marked, all attributes are uploaded, as
+        callers that changed arrays in place expect. Without GL only the
+        version is incremented.
+        """
+        if not self.gl:
+            self._dirty = set()
+            self._indices_dirty = False
+            self.version += 1
+            return
+        self.program = self.material.compile(self.num_lights, self.cache)
+        self._dirty.update(names)
+        dirty = self._dirty if self._dirty else set(self.attributes)
+        for name in dirty:
+            values = np.ascontiguousarray(self.attributes[name],
+                                          dtype=np.float32)
+            if name in self._buffers:
+                self._buffers[name].set_data(values)
+            else:
+                self._buffers[name] = gloo.VertexBuffer(values)
+            stats['buffer_uploads'] += 1
+            proftools.count('buffer_upload_bytes', values.nbytes)
+        if self._indices_dirty:
+            self.index_buffer = gloo.IndexBuffer(self.indices)
+            stats['buffer_uploads'] += 1
+            proftools.count('buffer_upload_bytes', self.indices.nbytes)
+            self._indices_dirty = False
+        self._dirty = set()
+        self.version += 1
+
+    def buffer(self, name):
+        """
+        :return: the vertex buffer of an attribute, or None.
+        """
+        return self._buffers.get(name)
 
+    def bind(self):
+        """
+        Binds this renderable's attribute buffers, uv transform and material
+        uniforms to its (possibly shared) program. Only changed values are
+        sent.
+        :return: the program, ready for the per-frame uniforms and drawing.
+        """
+        for name, buffer in self._buffers.items():
+            self.program[name] = buffer
+        self.program['u_uv_scale'] = self.uv_scale
+        self.program['u_uv_offset'] = self.uv_offset
+        return self.material.update_uniforms(self.program)
+
+    def draw(self, program=None):
+        """
+        Draws the triangles of this renderable, indexed if it has indices.
+        :param program: program to draw with, the bound one by default.
+        """
+        program = self.program if program is None else program
+        with proftools.span('draw'):
+            program.draw('triangles', self.index_buffer)
 
 
 class Light:
@@ -36,6 +267,36 @@ class Light:
         self.intensity = intensity
         self.color = color
 
+    def __setattr__(self, name, value):
+        # Assigning an attribute marks the light as changed, see
+        # light_arrays.
+        super().__setattr__(name, value)
+        if name != 'version':
+            self.version = getattr(self, 'version', 0) + 1
+
+
+def lights_key(lights):
+    """
+    Identifies the current state of a list of lights.
+    """
+    return tuple((id(light), light.version) for light in lights)
+
+
+def light_arrays(lights):
+    """
+    Packs lights into the uniform arrays of the shaders, for uploading all
+    lights at once.
+    :return: dict of uniform name to (num_lights, n) float32 array.
+    """
+    return {
+        'light_position': np.array([l.position for l in lights],
+                                   dtype=np.float32).reshape(-1, 3),
+        'light_intensity': np.array([l.intensity for l in lights],
+                                    dtype=np.float32).reshape(-1, 1),
+        'light_color': np.array([l.color for l in lights],
+                                dtype=np.float32).reshape(-1, 3),
+    }
+
 
 class Renderer(app.Canvas):
     def __init__(self, size, near, far, camera, *args, **kwargs):
@@ -57,6 +318,15 @@ class Renderer(app.Canvas):
         self.model_mat = np.eye(4)
 
         self.mesh = None
+        # BVH of the scene triangles in model space, see meshtools.bvh. When
+        # set, the surface under the mouse is picked as it moves.
+        self.bvh = None
+        # (face index, model space position) picked last, or None.
+        self.picked = None
+        # State of the scene uniforms last uploaded to each program, and the
+        # packed arrays of the last lights, see upload_scene_uniforms.
+        self._uploaded_state = {}
+        self._light_arrays = (None, None)
 
     def set_program(self, vertex_shader, fragment_shader):
         self.program = gloo.Program(vertex_shader, fragment_shader)
@@ -69,6 +339,28 @@ class Renderer(app.Canvas):
         self.program['u_model'] = self.model_mat
         self.program['u_perspective'] = self.camera.perspective_mat().T
 
+    def upload_scene_uniforms(self, program, lights):
+        """
+        Uploads the camera, model matrix and light uniforms to a program,
+        unless it already holds them for the current camera version and
+        lights.
+        """
+        lights_state = lights_key(lights)
+        state = (self.camera.version, lights_state,
+                 np.asarray(self.model_mat).tobytes())
+        if self._uploaded_state.get(id(program)) == state:
+            return
+        if self._light_arrays[0] != lights_state:
+            self._light_arrays = (lights_state, light_arrays(lights))
+
+        program['cam_pos'] = self.camera.cam_pos()
+        program['u_view_mat'] = self.camera.view_mat().T
+        program['u_model_mat'] = self.model_mat
+        program['u_perspective_mat'] = self.camera.perspective_mat().T
+        for name, values in self._light_arrays[1].items():
+            program[name] = values
+        self._uploaded_state[id(program)] = state
+
     def draw(self):
         """
         Override and implement drawing logic here. e.g. gloo.clear_color
@@ -78,12 +370,11 @@ class Renderer(app.Canvas):
     def render_to_image(self):
         """
         Renders to an image.
-        :return: image of rendered scene.
+        :return: (H, W, 3) image of rendered scene.
         """
         with self._fbo:
             self.draw()
-            pixels = gloo.util.read_pixels(out_type=np.float32,
-                                           alpha=False)[:, :, 0]
+            pixels = gloo.util.read_pixels(out_type=np.float32, alpha=False)
         return pixels
 
     def on_resize(self, event):
@@ -99,11 +390,28 @@ class Renderer(app.Canvas):
         if event.key == 'Escape':
             self.app.quit()
 
+    def pick(self, x, y):
+        """
+        Casts a ray through a window position into bvh.
+        :return: (face index, model space position) of the closest hit, or
+                 None.
+        """
+        origins, directions = self.camera.pixel_rays(x, y)
+        inv_model_mat = linalg.inv(self.model_mat)
+        origins = origins @ inv_model_mat[:3, :3].T + inv_model_mat[:3, 3]
+        directions = directions @ inv_model_mat[:3, :3].T
+        t, faces, _ = self.bvh.intersect(origins, directions)
+        if faces[0] < 0:
+            return None
+        return int(faces[0]), origins[0] + t[0] * directions[0]
+
     def on_mouse_move(self, event):
         if event.is_dragging:
             self.camera.handle_mouse(event.last_event.pos, event.pos)
             self.update_uniforms()
             self.update()
+        elif self.bvh is not None:
+            self.picked = self.pick(*event.pos)
 
     def on_mouse_wheel(self, event):
         cur_dist = linalg.norm(self.camera.position)
@@ -0,0 +1,179 @@
+import re
+
+import numpy as np
+from vispy import gloo
+
+import proftools
+from .core import light_arrays
+from .headless import ATTRIBUTE_SIZES, gbuffer_key, renderable_attribute
+from .materials import _load_shader
+
+# G-buffer channels in the order of u_channel in gbuffer.frag.glsl. The
+# material id (renderable index + 1, 0 for background) is stored in the
+# third component of 'uv'.
+GBUFFER_CHANNELS = ('position', 'normal', 'tangent', 'bitangent', 'uv')
+
+# Source of each material shader varying in the G-buffer.
+_VARYING_LOOKUPS = {
+    'v_position': 'texture2D(g_position, v_screen_uv).xyz',
+    'v_normal': 'texture2D(g_normal, v_screen_uv).xyz',
+    'v_tangent': 'texture2D(g_tangent, v_screen_uv).xyz',
+    'v_bitangent': 'texture2D(g_bitangent, v_screen_uv).xyz',
+    'v_uv': 'material.xy * u_uv_scale + u_uv_offset',
+}
+
+_VARYING_RE = re.compile(r'^(\s*)varying\s+(\w+\s+(\w+)\s*;)',
+                         re.MULTILINE)
+_MAIN_RE = re.compile(r'\bvoid\s+main\s*\(\s*\)')
+
+_DEFERRED_MAIN = '''
+uniform sampler2D g_position;
+uniform sampler2D g_normal;
+uniform sampler2D g_tangent;
+uniform sampler2D g_bitangent;
+uniform sampler2D g_uv;
+uniform float u_material_id;
+uniform vec2 u_uv_scale;
+uniform vec2 u_uv_offset;
+varying vec2 v_screen_uv;
+
+void main() {
+    vec4 material = texture2D(g_uv, v_screen_uv);
+    if (abs(material.z - u_material_id) > 0.5) {
+        discard;
+    }
+$assignments
+    shade_main();
+}
+'''
+
+
+def deferred_fragment_shader(source):
+    """
+    Turns a material fragment shader into a full screen shading pass over
+    the G-buffer: its varyings become globals filled from the G-buffer
+    textures and its main() is only run for pixels of u_material_id.
+    """
+    names = [m.group(3) for m in _VARYING_RE.finditer(source)]
+    source = _VARYING_RE.sub(r'\1\2', source)
+    source = _MAIN_RE.sub('void shade_main()', source)
+    assignments = '\n'.join('    {} = {};'.format(name,
+                                                   _VARYING_LOOKUPS[name])
+                            for name in names)
+    return source + _DEFERRED_MAIN.replace('$assignments', assignments)
+
+
+class GBuffer:
+    """
+    GPU G-buffer for deferred shading. The scene is rasterized into float
+    textures once per camera and geometry state, then each material shades
+    the pixels it covers in a full screen pass. Changing lights or material
+    uniforms (e.g. alpha) only reruns the shading pass.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        shape = (size[1], size[0], 4)
+        self.textures = {
+            name: gloo.Texture2D(shape=shape, format='rgba',
+                                 internalformat='rgba32f')
+            for name in GBUFFER_CHANNELS
+        }
+        depth = gloo.RenderBuffer(shape=(size[1], size[0]))
+        self._fbos = {name: gloo.FrameBuffer(texture, depth)
+                      for name, texture in self.textures.items()}
+        self._quad = gloo.VertexBuffer(np.array(
+            [[-1, -1], [1, -1], [-1, 1], [1, 1]], dtype=np.float32))
+        self._gbuffer_programs = {}
+        self._shading_programs = {}
+        self._key = None
+        self.num_rasterizations = 0
+
+    def invalidate(self):
+        self._key = None
+
+    def _gbuffer_program(self, renderable):
+        version, program = self._gbuffer_programs.get(id(renderable),
+                                                      (None, None))
+        if version != renderable.version:
+            program = gloo.Program(
+                _load_shader('default.vert.glsl').substitute(),
+                _load_shader('gbuffer.frag.glsl').substitute())
+            for name, size in ATTRIBUTE_SIZES:
+                buffer = renderable.buffer(name)
+                program[name] = (renderable_attribute(renderable, name, size)
+                                 if buffer is None else buffer)
+            # The G-buffer holds mesh uvs, the uv transform is applied when
+            # shading.
+            program['u_uv_scale'] = (1.0, 1.0)
+            program['u_uv_offset'] = (0.0, 0.0)
+            self._gbuffer_programs[id(renderable)] = (renderable.version,
+                                                      program)
+        return program
+
+    def _shading_program(self, renderable):
+        material = renderable.material
+        vs, fs = material.program_tmpl.sources(renderable.num_lights,
+                                               **material.shader_params())
+        key = (id(material), fs)
+        program = self._shading_programs.get(key)
+        if program is None:
+            program = gloo.Program(
+                _load_shader('deferred.vert.glsl').substitute(),
+                deferred_fragment_shader(fs))
+            program['a_screen'] = self._quad
+            for name, texture in self.textures.items():
+                program['g_' + name] = texture
+            self._shading_programs[key] = program
+        return program
+
+    @proftools.traced('GBuffer.update')
+    def update(self, renderables, camera, model_mat):
+        """
+        Rasterizes the renderables into the G-buffer unless the camera and
+        geometry are unchanged since the last update.
+        :return: True if the G-buffer was rasterized.
+        """
+        key = gbuffer_key(self.size, camera, model_mat, renderables)
+        if key == self._key:
+            return False
+
+        programs = [self._gbuffer_program(r) for r in renderables]
+        for i, program in enumerate(programs):
+            program['u_view_mat'] = camera.view_mat().T
+            program['u_model_mat'] = model_mat
+            program['u_perspective_mat'] = camera.perspective_mat().T
+            program['u_material_id'] = i + 1
+        for channel, name in enumerate(GBUFFER_CHANNELS):
+            with self._fbos[name]:
+                gloo.clear(color=(0, 0, 0, 0), depth=True)
+                for renderable, program in zip(renderables, programs):
+                    program['u_channel'] = channel
+                    renderable.draw(program)
+
+        # Drop programs of renderables that are gone.
+        ids = set(id(r) for r in renderables)
+        for renderable_id in list(self._gbuffer_programs):
+            if renderable_id not in ids:
+                del self._gbuffer_programs[renderable_id]
+        self._key = key
+        self.num_rasterizations += 1
+        return True
+
+    @proftools.traced('GBuffer.shade')
+    def shade(self, renderables, lights, cam_pos):
+        """
+        Shades the G-buffer into the current frame buffer. Depth testing
+        should be disabled.
+        """
+        arrays = light_arrays(lights)
+        for i, renderable in enumerate(renderables):
+            program = self._shading_program(renderable)
+            renderable.material.update_uniforms(program)
+            program['u_material_id'] = i + 1
+            program['u_uv_scale'] = renderable.uv_scale
+            program['u_uv_offset'] = renderable.uv_offset
+            program['cam_pos'] = cam_pos
+            for name, values in arrays.items():
+                program[name] = values
+            program.draw('triangle_strip')
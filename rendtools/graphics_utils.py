@@ -2,6 +2,8 @@ import numpy as np
 from numpy import linalg
 from vispy.util.transforms import ortho
 
+DEFAULT_UNPROJECT_CHUNK_SIZE = 1024 * 1024
+
 
 def euclidean_to_homogeneous(points):
     """
@@ -22,37 +24,42 @@ def homogeneous_to_euclidean(points):
     :param points: points to convert
     :return: points in euclidean coordinates divided by the projective factor
     """
-    ndims = points.shape[1]
-    euclidean_points = np.array(points[:, 0:ndims - 1]) / points[:, -1, None]
-    return euclidean_points
+    return points[:, :-1] / points[:, -1, None]
 
 
 def extrinsic_to_opengl_modelview(extrinsic_mat):
     """
     Converts extrinsic matrix to OpenGL format.
-    :param extrinsic_mat: Extrinsic matrix in row-major order.
-    :return: OpenGL view matrix in column-major order.
+    :param extrinsic_mat: Extrinsic matrix in row-major order, or a stack of
+                          them.
+    :return: OpenGL view matrix in column-major order, or a stack of them.
     """
-    return np.vstack((extrinsic_mat, [0, 0, 0, 1]))
+    extrinsic_mat = np.asarray(extrinsic_mat)
+    view_mat = np.zeros(extrinsic_mat.shape[:-2] + (4, 4))
+    view_mat[..., :3, :] = extrinsic_mat
+    view_mat[..., 3, 3] = 1
+    return view_mat
 
 
 def intrinsic_to_opengl_projection(intrinsic_mat, left, right, top, bottom,
                                    near, far):
     """
     Converts intrinsic matrix to OpenGL format.
-    :param intrinsic_mat: Intrinsic matrix in row-major order.
+    :param intrinsic_mat: Intrinsic matrix in row-major order, or a stack of
+                          them.
     :return: OpenGL perspective mat (including NDC matrix) in column-major
-             format.
+             format, or a stack of them.
     """
-    perspective_mat = np.vstack((
-        np.hstack((intrinsic_mat[0, :], 0)),
-        np.hstack((intrinsic_mat[1, :], 0)),
-        [0, 0, near + far, near * far],
-        np.hstack((intrinsic_mat[2, :], 0))
-    ))
+    intrinsic_mat = np.asarray(intrinsic_mat)
+    perspective_mat = np.zeros(intrinsic_mat.shape[:-2] + (4, 4))
+    perspective_mat[..., 0, :3] = intrinsic_mat[..., 0, :]
+    perspective_mat[..., 1, :3] = intrinsic_mat[..., 1, :]
+    perspective_mat[..., 2, 2] = near + far
+    perspective_mat[..., 2, 3] = near * far
+    perspective_mat[..., 3, :3] = intrinsic_mat[..., 2, :]
     ndc_mat = ortho(left, right, bottom, top, near, far).T
 
-    return ndc_mat.dot(perspective_mat)
+    return np.matmul(ndc_mat, perspective_mat)
 
 
 def unproject(width, height, projection_mat, modelview_mat,
@@ -73,6 +80,119 @@ def unproject(width, height, projection_mat, modelview_mat,
     return unprojected
 
 
+def _output_array(out, shape, dtype):
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if isinstance(out, str):
+        return np.lib.format.open_memmap(out, mode='w+', dtype=dtype,
+                                         shape=shape)
+    if out.shape != shape:
+        raise ValueError('Output must have shape {} but has {}.'.format(
+            shape, out.shape))
+    return out
+
+
+def _row_chunks(height, width, chunk_size):
+    rows = max(1, chunk_size // width)
+    for y0 in range(0, height, rows):
+        yield y0, min(y0 + rows, height)
+
+
+def _depth_mask(depth, mask, y0, y1):
+    if mask is None:
+        return depth[y0:y1] < 1.0
+    return np.asarray(mask[y0:y1], dtype=bool)
+
+
+def count_depth_points(depth, mask=None,
+                       chunk_size=DEFAULT_UNPROJECT_CHUNK_SIZE):
+    """
+    Counts the pixels unproject_depth_map would return.
+    """
+    height, width = depth.shape
+    return sum(int(np.count_nonzero(_depth_mask(depth, mask, y0, y1)))
+               for y0, y1 in _row_chunks(height, width, chunk_size))
+
+
+def unproject_depth_map(width, height, projection_mat, modelview_mat, depth,
+                        mask=None, chunk_size=DEFAULT_UNPROJECT_CHUNK_SIZE,
+                        out=None, pixel_offset=0.5, dtype=np.float32):
+    """
+    Unprojects a depth map to a point cloud in chunks of rows, so memory use
+    is bounded by chunk_size rather than the image size.
+    :param depth: (height, width) window depth in [0, 1], e.g. from
+                  HeadlessRenderer.
+    :param mask: (height, width) bool array of pixels to unproject, by
+                 default those with depth < 1 (not background).
+    :param chunk_size: approximate number of pixels processed at once.
+    :param out: preallocated (N, 3) array or path of a .npy file to
+                memory-map, N being count_depth_points.
+    :param pixel_offset: offset of the sampled position within a pixel,
+                         0.5 for pixel centers.
+    :return: (N, 3) points in row-major pixel order.
+    """
+    num_points = count_depth_points(depth, mask, chunk_size)
+    out = _output_array(out, (num_points, 3), dtype)
+    inv_mat = linalg.inv(np.dot(projection_mat, modelview_mat)).astype(dtype)
+    ndc_x = ((np.arange(width, dtype=dtype) + pixel_offset)
+             / width * 2.0 - 1.0)
+
+    start = 0
+    for y0, y1 in _row_chunks(height, width, chunk_size):
+        chunk_mask = _depth_mask(depth, mask, y0, y1)
+        ys, xs = np.nonzero(chunk_mask)
+        ndc = np.empty((len(xs), 4), dtype=dtype)
+        ndc[:, 0] = ndc_x[xs]
+        ndc[:, 1] = 1.0 - (ys + (y0 + pixel_offset)) / height * 2.0
+        ndc[:, 2] = depth[y0:y1][chunk_mask] * 2.0 - 1.0
+        ndc[:, 3] = 1.0
+        points = ndc @ inv_mat.T
+        out[start:start + len(xs)] = points[:, :3] / points[:, 3, None]
+        start += len(xs)
+    return out
+
+
+def fuse_depth_maps(cameras, depth_maps, masks=None,
+                    chunk_size=DEFAULT_UNPROJECT_CHUNK_SIZE, out=None,
+                    pixel_offset=0.5, dtype=np.float32):
+    """
+    Unprojects the depth maps of many views into one point cloud.
+    :param cameras: list of cameras, or a stacked CalibratedCamera.
+    :param depth_maps: one (height, width) depth map per camera.
+    :param masks: optional list of masks, see unproject_depth_map.
+    :param out: preallocated output or path of a .npy file to memory-map.
+    :return: (N, 3) points and (num_cameras + 1,) offsets of each view's
+             points.
+    """
+    if masks is None:
+        masks = [None] * len(depth_maps)
+    counts = [count_depth_points(depth, mask, chunk_size)
+              for depth, mask in zip(depth_maps, masks)]
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    out = _output_array(out, (int(offsets[-1]), 3), dtype)
+
+    stacked = getattr(cameras, 'is_stacked', False)
+    if stacked:
+        projection_mats = cameras.perspective_mat()
+        modelview_mats = np.broadcast_to(cameras.view_mat(),
+                                         projection_mats.shape)
+    for i, (depth, mask) in enumerate(zip(depth_maps, masks)):
+        if stacked:
+            size = cameras.size
+            projection_mat = projection_mats[i]
+            modelview_mat = modelview_mats[i]
+        else:
+            size = cameras[i].size
+            projection_mat = cameras[i].perspective_mat()
+            modelview_mat = cameras[i].view_mat()
+        unproject_depth_map(size[0], size[1], projection_mat, modelview_mat,
+                            depth, mask, chunk_size,
+                            out[offsets[i]:offsets[i + 1]], pixel_offset,
+                            dtype)
+    return out, offsets
+
+
 def compute_vertex_tight_clipping_planes(vertices, padding=0.1):
     near = np.abs(vertices[:, 2].max()) - padding
     far = np.abs(vertices[:, 2].min()) + padding
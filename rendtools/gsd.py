@@ -1,83 +1,218 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from numpy import linalg
 from vispy import gloo
-from vispy.gloo import gl
 
+import proftools
 from svbrdf import SVBRDF
+from svbrdf.cache import get_svbrdf
 from meshtools import wavefront
+from meshtools.indexing import index_attributes, indexing_report
+from meshtools.lod import DEFAULT_MAX_LEVELS, DEFAULT_MIN_FACES, get_lod_chain
 
+from .deferred import GBuffer
+from .lod import DEFAULT_PIXEL_ERROR, LODSet, bounding_sphere
 from . import (Renderer, Renderable, Light, SVBRDFMaterial, PhongMaterial,
-               SVBRDFColorTransferMaterial)
+               SVBRDFColorTransferMaterial, PerspectiveCamera,
+               CalibratedCamera, CameraSet)
+
+logger = logging.getLogger(__name__)
 
 
 class GSDRenderer(Renderer):
 
-    def __init__(self, gsd_dict, camera, size=(800, 600), *args, **kwargs):
+    def __init__(self, gsd_dict, camera, size=(800, 600), *args,
+                 deferred=False, **kwargs):
+        """
+        :param deferred: if True, rasterize into a G-buffer once per camera
+                         and only rerun shading when lights or material
+                         parameters change.
+        """
         super().__init__(size, 0, 1000, camera, *args, **kwargs)
         gloo.set_state(depth_test=True)
         gloo.set_viewport(0, 0, *self.size)
         self.scene = GSDScene(gsd_dict)
+        self.gbuffer = GBuffer(self.size) if deferred else None
 
     def update_uniforms(self):
-        self.program['cam_pos'] = linalg.inv(self.camera.view_mat())[:3, 3]
-        self.program['u_view_mat'] = self.camera.view_mat().T
-        self.program['u_model_mat'] = np.eye(4)
-        self.program['u_perspective_mat'] = self.camera.perspective_mat().T
-
-        for i, light in enumerate(self.scene.lights):
-            self.program['light_position[{}]'.format(i)] = light.position
-            self.program['light_intensity[{}]'.format(i)] = light.intensity
-            self.program['light_color[{}]'.format(i)] = light.color
+        self.upload_scene_uniforms(self.program, self.scene.lights)
 
     def update_alpha(self, alpha):
         for renderable in self.scene.renderables:
             if type(renderable.material) is SVBRDFMaterial:
+                # Applied as a uniform the next time it is bound.
                 renderable.material.alpha = alpha
-                renderable.update()
         self.update()
 
+    @proftools.traced('GSDRenderer.draw')
     def draw(self):
         gloo.clear(color=(1, 1, 1))
+        self.scene.select_lods(self.camera, self.size)
+        if self.gbuffer is not None:
+            self.gbuffer.update(self.scene.renderables, self.camera,
+                                self.model_mat)
+            gloo.set_state(depth_test=False)
+            self.gbuffer.shade(self.scene.renderables, self.scene.lights,
+                               self.camera.cam_pos())
+            gloo.set_state(depth_test=True)
+            return
         for renderable in self.scene.renderables:
-            self.program = renderable.program
+            self.program = renderable.bind()
             self.update_uniforms()
-            self.program.draw(gl.GL_TRIANGLES)
+            renderable.draw()
 
 
 class GSDScene(object):
 
-    def __init__(self, gsd_dict):
+    def __init__(self, gsd_dict, num_workers=4, indexed=None, lod=None,
+                 gl=True):
+        """
+        :param num_workers: number of threads reading the mesh and the
+                            material maps concurrently.
+        :param indexed: if True, merge corners with equal attributes into
+                        shared vertices and draw indexed triangles, see
+                        meshtools.indexing. Defaults to the 'indexed' key
+                        of gsd_dict, False if missing.
+        :param lod: True or a dict of options to draw every material at a
+                    level of detail picked by select_lods, see
+                    meshtools.lod. Options are 'max_levels', 'min_faces',
+                    'pixel_error' and 'cache_dir', by default a directory
+                    next to the mesh. Defaults to the 'lod' key of gsd_dict,
+                    False if missing.
+        :param gl: if False, build host-only materials and renderables for
+                   HeadlessRenderer, without any GL objects.
+        """
+        if indexed is None:
+            indexed = gsd_dict.get('indexed', False)
+        if lod is None:
+            lod = gsd_dict.get('lod', False)
+        self.gl = gl
         self.lights = create_lights(gsd_dict)
         self.materials = {}
-        for material_name in list_material_names(gsd_dict):
-            self.materials[material_name] = create_material(gsd_dict,
-                                                            material_name)
         self.renderables = []
+        # indexing_report of each renderable if indexed, keyed by material.
+        self.index_reports = {}
+        # One LODSet per renderable if the scene has LODs.
+        self.lod_sets = []
+        self.pixel_error = DEFAULT_PIXEL_ERROR
+        # Seconds spent loading each asset, keyed by 'mesh', material name or
+        # 'material/map' for individual SVBRDF maps.
+        self.load_times = {}
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            logger.info('Loading mesh %s', gsd_dict['mesh'])
+            mesh_future = executor.submit(_timed, load_mesh, gsd_dict)
+            # Materials load on this thread, which also creates their GL
+            # objects, while their maps are read on the pool next to the
+            # mesh, so num_workers bounds all reads of the scene.
+            for material_name in list_material_names(gsd_dict):
+                start_time = time.perf_counter()
+                data = load_material_data(gsd_dict, material_name,
+                                          executor=executor)
+                self.materials[material_name] = create_material(
+                    gsd_dict, material_name, data, gl=gl)
+                self.load_times[material_name] = (
+                    time.perf_counter() - start_time)
+                if isinstance(data, SVBRDF):
+                    for map_name, map_time in data.load_times.items():
+                        self.load_times['{}/{}'.format(
+                            material_name, map_name)] = map_time
+            mesh, self.load_times['mesh'] = mesh_future.result()
+
+        for name, load_time in self.load_times.items():
+            logger.info('Loaded %s in %.2fs', name, load_time)
 
-        print('Loading mesh {}'.format(gsd_dict['mesh']))
-        mesh = wavefront.read_obj_file(gsd_dict['mesh'])
-        mesh.resize(100)
+        # Flat tangents differ per face and would keep textured corners
+        # from merging, so indexed scenes use smooth tangent frames.
+        segments = mesh.expand_segments('material', smooth=indexed)
         for material_id, material_name in enumerate(mesh.materials.keys()):
-            filter = {'material': material_id}
-            vertex_positions = mesh.expand_face_vertices(filter)
-            vertex_normals = mesh.expand_face_normals(filter)
-            vertex_tangents, vertex_bitangents = mesh.expand_tangents(
-                filter)
-            vertex_uvs = mesh.expand_face_uvs(filter)
-            material = self.materials[material_name]
+            self.renderables.append(self._create_renderable(
+                material_name, segments[material_id], indexed))
+        if lod:
+            self._create_lod_sets(gsd_dict, mesh, segments, indexed,
+                                  {} if lod is True else lod)
+
+    def _create_renderable(self, material_name, segment, indexed,
+                           log_report=True):
+        material = self.materials[material_name]
+        attributes = {
+            'a_position': segment['vertices'],
+            'a_normal': segment['normals'],
+        }
+        if material.has_texture:
             attributes = {
-                'a_position': vertex_positions,
-                'a_normal': vertex_normals,
+                **attributes,
+                'a_tangent': segment['tangents'],
+                'a_bitangent': segment['bitangents'],
+                'a_uv': segment['uvs'],
             }
-            if material.has_texture:
-                attributes = {
-                    **attributes,
-                    'a_tangent': vertex_tangents,
-                    'a_bitangent': vertex_bitangents,
-                    'a_uv': vertex_uvs,
-                }
-            self.renderables.append(
-                Renderable(material, attributes, len(self.lights)))
+        if not indexed:
+            return Renderable(material, attributes, len(self.lights),
+                              gl=self.gl)
+        vertices, indices = index_attributes(attributes,
+                                             position_key='a_position')
+        if log_report:
+            report = indexing_report(attributes, vertices, indices)
+            logger.info('Indexed %s: %d corners -> %d vertices, %.1f MB -> '
+                        '%.1f MB (%.2fx smaller), ACMR %.3f', material_name,
+                        report['num_corners'], report['num_vertices'],
+                        report['expanded_bytes'] / 2 ** 20,
+                        report['indexed_bytes'] / 2 ** 20,
+                        report['memory_ratio'], report['acmr'])
+            self.index_reports[material_name] = report
+        return Renderable(material, vertices, len(self.lights),
+                          indices=indices, gl=self.gl)
+
+    def _create_lod_sets(self, gsd_dict, mesh, segments, indexed, options):
+        """
+        Builds a LODSet per material from the LOD chain of the mesh. Levels
+        in which a material lost all its faces draw the previous level.
+        """
+        cache_dir = options.get(
+            'cache_dir', os.path.splitext(gsd_dict['mesh'])[0] + '_lod')
+        chain = get_lod_chain(
+            mesh, cache_dir,
+            max_levels=options.get('max_levels', DEFAULT_MAX_LEVELS),
+            min_faces=options.get('min_faces', DEFAULT_MIN_FACES))
+        self.pixel_error = options.get('pixel_error', DEFAULT_PIXEL_ERROR)
+        logger.info('LOD chain of %s: %s faces', gsd_dict['mesh'],
+                    ', '.join(str(level.num_faces) for level in chain))
+        levels = [list(self.renderables)]
+        for level in chain.levels[1:]:
+            level_segments = level.expand_segments('material',
+                                                   smooth=indexed)
+            renderables = []
+            for material_id, material_name in enumerate(
+                    mesh.materials.keys()):
+                segment = level_segments[material_id]
+                if len(segment['vertices']) == 0:
+                    renderables.append(levels[-1][material_id])
+                    continue
+                renderables.append(self._create_renderable(
+                    material_name, segment, indexed, log_report=False))
+            levels.append(renderables)
+        for material_id in range(len(self.renderables)):
+            center, radius = bounding_sphere(
+                segments[material_id]['vertices'])
+            self.lod_sets.append(LODSet(
+                [renderables[material_id] for renderables in levels],
+                chain.errors, center, radius))
+
+    def select_lods(self, camera, size):
+        """
+        Sets renderables to the level of detail of each part suiting a
+        camera and image size, if the scene has LODs.
+        :param size: (width, height) of the image.
+        :return: the renderables.
+        """
+        if self.lod_sets:
+            self.renderables = [
+                lod_set.select(camera, size[1], self.pixel_error)
+                for lod_set in self.lod_sets]
+        return self.renderables
 
 
 def create_lights(gsd_dict):
@@ -89,16 +224,95 @@ def create_lights(gsd_dict):
     return lights
 
 
+def create_camera(camera_dict, size):
+    """
+    Creates a camera from a GSD camera dict. Perspective cameras take 'fov',
+    'position', 'lookat' and 'up', calibrated cameras take 'extrinsic' (3x4)
+    and 'intrinsic' (3x3).
+    :param size: (width, height) of the image.
+    """
+    near = camera_dict.get('near', 1.0)
+    far = camera_dict.get('far', 1000.0)
+    camera_type = camera_dict.get('type', 'perspective')
+    if camera_type == 'perspective':
+        return PerspectiveCamera(size, near, far,
+                                 camera_dict['fov'],
+                                 camera_dict['position'],
+                                 camera_dict.get('lookat', (0, 0, 0)),
+                                 camera_dict.get('up', (0, 1, 0)))
+    elif camera_type == 'calibrated':
+        return CalibratedCamera(np.array(camera_dict['extrinsic']),
+                                np.array(camera_dict['intrinsic']),
+                                size, near, far)
+    raise ValueError('Unknown camera type {}.'.format(camera_type))
+
+
+def create_camera_set(path_dict, size):
+    """
+    Creates a CameraSet from a GSD camera path dict. 'type' is 'orbit',
+    'hemisphere' or 'spline'; the other keys are the arguments of the
+    CameraSet constructor of that name.
+    :param size: (width, height) of the images.
+    """
+    path_dict = dict(path_dict)
+    path_type = path_dict.pop('type')
+    near = path_dict.pop('near', 1.0)
+    far = path_dict.pop('far', 1000.0)
+    constructors = {
+        'orbit': CameraSet.orbit,
+        'hemisphere': CameraSet.hemisphere,
+        'spline': CameraSet.spline,
+    }
+    if path_type not in constructors:
+        raise ValueError('Unknown camera path type {}.'.format(path_type))
+    return constructors[path_type](size, near, far, **path_dict)
+
+
 def list_material_names(gsd_dict):
     return [m for m in gsd_dict['materials'].keys()]
 
 
-def create_material(gsd_dict, material_name):
+def _timed(func, *args):
+    start_time = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start_time
+
+
+def load_mesh(gsd_dict):
+    mesh = wavefront.read_obj_file(gsd_dict['mesh'], bulk=True)
+    mesh.resize(100)
+    return mesh
+
+
+def load_material_data(gsd_dict, material_name, executor=None):
+    """
+    Reads the data a material needs from disk, without creating any GL
+    objects, so it can run on a worker thread.
+    :param executor: executor to read SVBRDF maps on, see SVBRDF.
+    """
+    material_dict = gsd_dict['materials'][material_name]
+    if material_dict['type'] in ('svbrdf', 'svbrdf_colortransfer'):
+        return get_svbrdf(material_dict['path'],
+                          compact=material_dict.get('compact', False),
+                          executor=executor)
+    return None
+
+
+def create_material(gsd_dict, material_name, data=None, gl=True):
+    """
+    SVBRDF materials with a true 'compact' key keep their maps in the
+    compact format of svbrdf.compact, on the host and on the GPU.
+    :param data: result of load_material_data, loaded here if not given.
+    :param gl: if False, create no textures, see SVBRDFMaterial.
+    """
     material_dict = gsd_dict['materials'][material_name]
+    if data is None:
+        data = load_material_data(gsd_dict, material_name)
+    compact = material_dict.get('compact', False)
     if material_dict['type'] == 'svbrdf':
-        return SVBRDFMaterial(SVBRDF(material_dict['path']))
+        return SVBRDFMaterial(data, compact=compact, gl=gl)
     elif material_dict['type'] == 'svbrdf_colortransfer':
-        return SVBRDFColorTransferMaterial(SVBRDF(material_dict['path']))
+        return SVBRDFColorTransferMaterial(data, compact=compact, gl=gl)
     elif material_dict['type'] == 'phong':
         return PhongMaterial(
             material_dict['diffuse'],
@@ -0,0 +1,470 @@
+import numpy as np
+from numpy import linalg
+
+import proftools
+
+DEFAULT_TILE_SIZE = 64
+DEFAULT_FRAGMENT_BUDGET = 4 * 1024 * 1024
+
+ATTRIBUTE_SIZES = (
+    ('a_position', 3),
+    ('a_normal', 3),
+    ('a_tangent', 3),
+    ('a_bitangent', 3),
+    ('a_uv', 2),
+)
+
+
+def renderable_attribute(renderable, name, size):
+    """
+    Returns an attribute of a renderable as an (N, size) float32 array,
+    zeros if the renderable does not have it.
+    """
+    num_vertices = len(renderable.attributes['a_position'])
+    values = renderable.attributes.get(name)
+    if values is None:
+        return np.zeros((num_vertices, size), dtype=np.float32)
+    return np.asarray(values, dtype=np.float32).reshape(-1, size)
+
+
+def triangle_corners(renderable, triangle_ids):
+    """
+    :return: (N, 3) vertex indices of triangles of a renderable, following
+             its index buffer if it has one.
+    """
+    if renderable.indices is not None:
+        return renderable.indices[triangle_ids]
+    return triangle_ids[:, None] * 3 + np.arange(3)[None, :]
+
+
+def gbuffer_key(size, camera, model_mat, renderables):
+    """
+    Identifies the state a G-buffer depends on: image size, camera and model
+    matrices and the renderables with their versions.
+    """
+    return (tuple(size),
+            camera.perspective_mat().tobytes(),
+            camera.view_mat().tobytes(),
+            np.asarray(model_mat).tobytes(),
+            tuple((id(r), r.version) for r in renderables))
+
+
+def _edge(ax, ay, bx, by, px, py):
+    return (bx - ax) * (py - ay) - (by - ay) * (px - ax)
+
+
+def _clip_near(clip, dist):
+    """
+    Clips triangles with one or two corners behind the near plane before
+    the perspective divide, as GL does.
+    :param clip: (N, 3, 4) clip-space corners of the triangles.
+    :param dist: (N, 3) signed distances z + w of the corners to the near
+                 plane, negative behind it.
+    :return: (K, 3, 4) clip-space corners of the pieces in front of the
+             plane, (K, 3, 3) weights of the source corners for every piece
+             corner and the (K,) source triangle of every piece.
+    """
+    inside = dist >= 0
+    num_inside = inside.sum(axis=1)
+    pieces, weights, sources = [], [], []
+    # One corner in front leaves a triangle, two leave a quad that is split
+    # in two. Corners are rotated so the lone corner comes first, which
+    # keeps the winding.
+    for count in (1, 2):
+        ids = np.flatnonzero(num_inside == count)
+        if len(ids) == 0:
+            continue
+        lone = np.argmax(inside[ids] == (count == 1), axis=1)
+        order = (lone[:, None] + np.arange(3)[None, :]) % 3
+        basis = np.eye(3, dtype=np.float32)[order]
+        d = np.take_along_axis(dist[ids], order, axis=1)
+
+        def _cut(p, q):
+            t = (d[:, p] / (d[:, p] - d[:, q]))[:, None]
+            return basis[:, p] + t * (basis[:, q] - basis[:, p])
+
+        a, b, c = basis[:, 0], basis[:, 1], basis[:, 2]
+        if count == 1:
+            corners = [(a, _cut(0, 1), _cut(0, 2))]
+        else:
+            ca, ba = _cut(2, 0), _cut(1, 0)
+            corners = [(b, c, ca), (b, ca, ba)]
+        for piece in corners:
+            piece = np.stack(piece, axis=1)
+            weights.append(piece)
+            pieces.append(piece @ clip[ids])
+            sources.append(ids)
+    if not pieces:
+        return (np.empty((0, 3, 4), np.float32),
+                np.empty((0, 3, 3), np.float32), np.empty(0, np.int64))
+    return (np.concatenate(pieces), np.concatenate(weights),
+            np.concatenate(sources))
+
+
+class _Triangles:
+    """
+    Screen-space triangles of all renderables, ready for binning. Triangles
+    fully in front of the near plane come first, followed by the pieces of
+    triangles clipped by it.
+    """
+
+    def __init__(self, width, height, matrix, renderables):
+        clips, owners, local_ids = [], [], []
+        piece_clips, piece_weights, piece_owners, piece_ids = [], [], [], []
+        for i, renderable in enumerate(renderables):
+            positions = renderable_attribute(renderable, 'a_position', 3)
+            clip = (np.hstack((positions,
+                               np.ones((len(positions), 1), np.float32)))
+                    @ matrix.T.astype(np.float32))
+            # Shared vertices are transformed once.
+            clip = (clip.reshape(-1, 3, 4) if renderable.indices is None
+                    else clip[renderable.indices])
+            dist = clip[:, :, 2] + clip[:, :, 3]
+            whole = np.flatnonzero(np.all(dist >= 0, axis=1))
+            clips.append(clip[whole])
+            owners.append(np.full(len(whole), i, dtype=np.int32))
+            local_ids.append(whole.astype(np.int32))
+
+            pieces, weights, sources = _clip_near(clip, dist)
+            piece_clips.append(pieces)
+            piece_weights.append(weights)
+            piece_owners.append(np.full(len(pieces), i, dtype=np.int32))
+            piece_ids.append(sources.astype(np.int32))
+
+        self.num_whole = sum(len(c) for c in clips)
+        clip = np.concatenate(clips + piece_clips) if clips else np.empty(
+            (0, 3, 4), np.float32)
+        self.owners = np.concatenate(owners + piece_owners) if owners \
+            else np.empty(0, np.int32)
+        self.local_ids = np.concatenate(local_ids + piece_ids) \
+            if local_ids else np.empty(0, np.int32)
+        # Weights of the source triangle corners for each corner of the
+        # clipped pieces.
+        self.piece_weights = np.concatenate(piece_weights) \
+            if piece_weights else np.empty((0, 3, 3), np.float32)
+
+        w = clip[:, :, 3]
+        ndc = clip[:, :, :3] / w[:, :, None]
+        self.screen = np.stack(((ndc[:, :, 0] * 0.5 + 0.5) * width,
+                                (0.5 - ndc[:, :, 1] * 0.5) * height), axis=2)
+        self.depth = ndc[:, :, 2] * 0.5 + 0.5
+        self.inv_w = 1.0 / w
+
+        x, y = self.screen[:, :, 0], self.screen[:, :, 1]
+        self.area = _edge(x[:, 0], y[:, 0], x[:, 1], y[:, 1],
+                          x[:, 2], y[:, 2])
+
+    def __len__(self):
+        return len(self.area)
+
+    def source_bary(self, triangle_ids, bary):
+        """
+        Converts barycentric coordinates within triangles to coordinates
+        within the source triangles of their renderables.
+        :param triangle_ids: (N,) indices of triangles.
+        :param bary: (N, 3) barycentric coordinates within them.
+        :return: (N, 3) barycentric coordinates.
+        """
+        pieces = np.flatnonzero(triangle_ids >= self.num_whole)
+        if len(pieces) == 0:
+            return bary
+        bary = bary.copy()
+        bary[pieces] = np.einsum(
+            'nk,nkc->nc', bary[pieces],
+            self.piece_weights[triangle_ids[pieces] - self.num_whole])
+        return bary
+
+
+class HeadlessRenderer:
+    """
+    CPU rasterizer that renders the same Renderables as Renderer without an
+    OpenGL context.
+
+    Triangles crossing the near plane are clipped against it like GL does
+    before the perspective divide. They are binned into screen tiles, tiles a triangle cannot touch are
+    rejected with its edge functions, and fragments are generated and
+    depth-resolved in bounded chunks of (triangle, tile) pairs. Attributes
+    are interpolated perspective-correctly into a G-buffer which is then
+    shaded by Material.shade. The G-buffer is cached, so relighting or
+    changing material parameters only reruns the shading pass.
+    """
+
+    def __init__(self, size, near, far, camera, renderables=None,
+                 lights=None, clear_color=(1.0, 1.0, 1.0),
+                 tile_size=DEFAULT_TILE_SIZE,
+                 fragment_budget=DEFAULT_FRAGMENT_BUDGET):
+        """
+        :param size: (width, height) of the image.
+        :param renderables: list of Renderable.
+        :param lights: list of Light.
+        :param fragment_budget: maximum number of candidate fragments
+                                processed at once.
+        """
+        self.size = size
+        self.near = near
+        self.far = far
+        self.camera = camera
+        self.model_mat = np.eye(4)
+        self.renderables = [] if renderables is None else renderables
+        self.lights = [] if lights is None else lights
+        self.clear_color = clear_color
+        self.tile_size = tile_size
+        self.fragment_budget = fragment_budget
+        self.invalidate()
+
+    def _bin(self, triangles):
+        """
+        Splits the screen-space bounding boxes of triangles into tiles.
+        :return: triangle index and inclusive pixel bounds per
+                 (triangle, tile) pair.
+        """
+        width, height = self.size
+        tile_size = self.tile_size
+        x, y = triangles.screen[:, :, 0], triangles.screen[:, :, 1]
+        # Pixel centers lie at +0.5.
+        x0 = np.maximum(np.ceil(x.min(axis=1) - 0.5), 0).astype(np.int64)
+        x1 = np.minimum(np.floor(x.max(axis=1) - 0.5),
+                        width - 1).astype(np.int64)
+        y0 = np.maximum(np.ceil(y.min(axis=1) - 0.5), 0).astype(np.int64)
+        y1 = np.minimum(np.floor(y.max(axis=1) - 0.5),
+                        height - 1).astype(np.int64)
+        valid = np.flatnonzero((x0 <= x1) & (y0 <= y1)
+                               & (np.abs(triangles.area) > 1e-12))
+        x0, x1, y0, y1 = x0[valid], x1[valid], y0[valid], y1[valid]
+
+        tx0, tx1 = x0 // tile_size, x1 // tile_size
+        ty0, ty1 = y0 // tile_size, y1 // tile_size
+        tiles_x = tx1 - tx0 + 1
+        counts = tiles_x * (ty1 - ty0 + 1)
+        pair_tri = np.repeat(np.arange(len(valid)), counts)
+        local = (np.arange(counts.sum())
+                 - np.repeat(np.cumsum(counts) - counts, counts))
+        tile_x = tx0[pair_tri] + local % tiles_x[pair_tri]
+        tile_y = ty0[pair_tri] + local // tiles_x[pair_tri]
+
+        px0 = np.maximum(x0[pair_tri], tile_x * tile_size)
+        px1 = np.minimum(x1[pair_tri], tile_x * tile_size + tile_size - 1)
+        py0 = np.maximum(y0[pair_tri], tile_y * tile_size)
+        py1 = np.minimum(y1[pair_tri], tile_y * tile_size + tile_size - 1)
+        pair_tri = valid[pair_tri]
+
+        # Reject tiles that lie entirely outside one of the edges.
+        sx = triangles.screen[pair_tri, :, 0]
+        sy = triangles.screen[pair_tri, :, 1]
+        sign = np.sign(triangles.area[pair_tri])
+        corners_x = np.stack((px0, px1, px0, px1), axis=1) + 0.5
+        corners_y = np.stack((py0, py0, py1, py1), axis=1) + 0.5
+        overlaps = np.ones(len(pair_tri), dtype=bool)
+        for a, b in ((1, 2), (2, 0), (0, 1)):
+            e = _edge(sx[:, a, None], sy[:, a, None],
+                      sx[:, b, None], sy[:, b, None],
+                      corners_x, corners_y) * sign[:, None]
+            overlaps &= e.max(axis=1) >= 0
+
+        # Process pairs tile by tile so chunks touch compact buffer regions.
+        tile_ids = tile_y * ((width + tile_size - 1) // tile_size) + tile_x
+        keep = np.flatnonzero(overlaps)
+        keep = keep[np.argsort(tile_ids[keep], kind='stable')]
+        return (pair_tri[keep], px0[keep], px1[keep], py0[keep], py1[keep])
+
+    def _rasterize_chunk(self, triangles, pair_tri, px0, px1, py0, py1,
+                         depth_buf, tri_buf, bary_buf):
+        width = self.size[0]
+        rect_w = px1 - px0 + 1
+        counts = rect_w * (py1 - py0 + 1)
+        frag_pair = np.repeat(np.arange(len(pair_tri)), counts)
+        local = (np.arange(counts.sum())
+                 - np.repeat(np.cumsum(counts) - counts, counts))
+        frag_x = px0[frag_pair] + local % rect_w[frag_pair]
+        frag_y = py0[frag_pair] + local // rect_w[frag_pair]
+        frag_tri = pair_tri[frag_pair]
+
+        sx = triangles.screen[frag_tri, :, 0]
+        sy = triangles.screen[frag_tri, :, 1]
+        cx = (frag_x + 0.5).astype(np.float32)
+        cy = (frag_y + 0.5).astype(np.float32)
+        area = triangles.area[frag_tri]
+        bary = np.stack((
+            _edge(sx[:, 1], sy[:, 1], sx[:, 2], sy[:, 2], cx, cy),
+            _edge(sx[:, 2], sy[:, 2], sx[:, 0], sy[:, 0], cx, cy),
+            _edge(sx[:, 0], sy[:, 0], sx[:, 1], sy[:, 1], cx, cy),
+        ), axis=1) / area[:, None]
+        depth = np.sum(bary * triangles.depth[frag_tri], axis=1)
+        inside = np.flatnonzero(np.all(bary >= 0, axis=1)
+                                & (depth >= 0) & (depth <= 1))
+        if len(inside) == 0:
+            return
+
+        pixels = frag_y[inside] * width + frag_x[inside]
+        depth = depth[inside]
+        # Keep the nearest fragment per pixel, then depth test it.
+        order = np.lexsort((depth, pixels))
+        pixels = pixels[order]
+        depth = depth[order]
+        first = np.ones(len(pixels), dtype=bool)
+        first[1:] = pixels[1:] != pixels[:-1]
+        order = order[first]
+        pixels = pixels[first]
+        depth = depth[first]
+        passed = depth < depth_buf[pixels]
+        pixels = pixels[passed]
+        frags = inside[order[passed]]
+
+        depth_buf[pixels] = depth[passed]
+        tri_buf[pixels] = frag_tri[frags]
+        # Perspective-correct barycentrics.
+        persp = bary[frags] * triangles.inv_w[frag_tri[frags]]
+        bary_buf[pixels] = persp / persp.sum(axis=1, keepdims=True)
+
+    @proftools.traced('HeadlessRenderer.rasterize')
+    def rasterize(self):
+        """
+        Rasterizes the renderables into visibility buffers.
+        :return: triangles, and per-pixel depth, triangle index and
+                 perspective-correct barycentric coordinates, all flattened.
+        """
+        width, height = self.size
+        matrix = (self.camera.perspective_mat() @ self.camera.view_mat()
+                  @ self.model_mat)
+        triangles = _Triangles(width, height, matrix, self.renderables)
+
+        num_pixels = width * height
+        depth_buf = np.ones(num_pixels, dtype=np.float32)
+        tri_buf = np.full(num_pixels, -1, dtype=np.int64)
+        bary_buf = np.zeros((num_pixels, 3), dtype=np.float32)
+
+        pair_tri, px0, px1, py0, py1 = self._bin(triangles)
+        counts = np.cumsum((px1 - px0 + 1) * (py1 - py0 + 1))
+        start = 0
+        while start < len(pair_tri):
+            budget = (counts[start - 1] if start > 0 else 0) \
+                + self.fragment_budget
+            end = max(int(np.searchsorted(counts, budget, side='right')),
+                      start + 1)
+            chunk = slice(start, end)
+            self._rasterize_chunk(triangles, pair_tri[chunk], px0[chunk],
+                                  px1[chunk], py0[chunk], py1[chunk],
+                                  depth_buf, tri_buf, bary_buf)
+            start = end
+        return triangles, depth_buf, tri_buf, bary_buf
+
+    def _gbuffer_key(self):
+        return gbuffer_key(self.size, self.camera, self.model_mat,
+                           self.renderables)
+
+    def invalidate(self):
+        """
+        Drops the cached G-buffer. Changes of the camera, the model matrix or
+        the renderables (see Renderable.update) are detected automatically.
+        """
+        self._gbuffer = None
+        self._gbuffer_key_cache = None
+
+    @proftools.traced('HeadlessRenderer.gbuffer')
+    def gbuffer(self):
+        """
+        Rasterizes the scene into a G-buffer, or returns the cached one if the
+        camera and geometry did not change since it was built.
+        :return: dict with the flat indices of covered 'pixels', sorted by
+                 renderable, the interpolated attributes of those pixels
+                 keyed by attribute name, per-renderable 'offsets' into them
+                 and read-only full frame 'aovs'.
+        """
+        key = self._gbuffer_key()
+        if self._gbuffer is not None and key == self._gbuffer_key_cache:
+            return self._gbuffer
+
+        width, height = self.size
+        triangles, depth_buf, tri_buf, bary_buf = self.rasterize()
+        num_pixels = width * height
+
+        covered = np.flatnonzero(tri_buf >= 0)
+        owners = triangles.owners[tri_buf[covered]]
+        order = np.argsort(owners, kind='stable')
+        pixels = covered[order]
+        owners = owners[order]
+        offsets = np.zeros(len(self.renderables) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(owners,
+                                            minlength=len(self.renderables)))
+
+        gbuffer = {'pixels': pixels, 'offsets': offsets}
+        for name, size in ATTRIBUTE_SIZES:
+            gbuffer[name] = np.empty((len(pixels), size), dtype=np.float32)
+        for i, renderable in enumerate(self.renderables):
+            chunk = slice(offsets[i], offsets[i + 1])
+            if chunk.start == chunk.stop:
+                continue
+            triangle_ids = tri_buf[pixels[chunk]]
+            corners = triangle_corners(
+                renderable, triangles.local_ids[triangle_ids])
+            bary = triangles.source_bary(triangle_ids,
+                                         bary_buf[pixels[chunk]])
+            for name, size in ATTRIBUTE_SIZES:
+                values = renderable_attribute(renderable, name, size)
+                gbuffer[name][chunk] = np.einsum('nk,nkc->nc', bary,
+                                                 values[corners])
+
+        def _frame(values, fill=0):
+            frame = np.full((num_pixels,) + values.shape[1:], fill,
+                            dtype=values.dtype)
+            frame[pixels] = values
+            frame = frame.reshape((height, width) + values.shape[1:])
+            frame.flags.writeable = False
+            return frame
+
+        normals = gbuffer['a_normal']
+        norms = linalg.norm(normals, axis=1, keepdims=True)
+        depth_buf = depth_buf.reshape(height, width)
+        depth_buf.flags.writeable = False
+        gbuffer['aovs'] = {
+            'depth': depth_buf,
+            'position': _frame(gbuffer['a_position']),
+            'normal': _frame(normals / np.where(norms == 0, 1.0, norms)),
+            'uv': _frame(gbuffer['a_uv']),
+            'mask': _frame(np.ones(len(pixels), dtype=bool), False),
+            'renderable': _frame(owners.astype(np.int32), -1),
+        }
+
+        self._gbuffer = gbuffer
+        self._gbuffer_key_cache = key
+        return gbuffer
+
+    @proftools.traced('HeadlessRenderer.render')
+    def render(self):
+        """
+        Renders the scene. Only the shading pass runs again when just the
+        lights or material parameters changed, see gbuffer.
+        :return: dict of (H, W, ...) buffers: 'color' in [0, 1], 'depth' as
+                 window depth (1 for background, see camera.unproject),
+                 interpolated world-space 'position' and 'normal', mesh
+                 'uv' (before the renderables' uv transforms),
+                 'mask' of covered pixels and 'renderable' index (-1 for
+                 background). All but 'color' are read-only.
+        """
+        width, height = self.size
+        gbuffer = self.gbuffer()
+        offsets = gbuffer['offsets']
+        cam_pos = self.camera.cam_pos()
+
+        shaded = np.empty((len(gbuffer['pixels']), 3), dtype=np.float32)
+        for i, renderable in enumerate(self.renderables):
+            chunk = slice(offsets[i], offsets[i + 1])
+            if chunk.start == chunk.stop:
+                continue
+            shaded[chunk] = renderable.material.shade(
+                gbuffer['a_position'][chunk], gbuffer['a_normal'][chunk],
+                gbuffer['a_tangent'][chunk], gbuffer['a_bitangent'][chunk],
+                gbuffer['a_uv'][chunk] * renderable.uv_scale
+                + renderable.uv_offset, self.lights, cam_pos)
+
+        color = np.empty((width * height, 3), dtype=np.float32)
+        color[:] = np.asarray(self.clear_color, dtype=np.float32)[:3]
+        color[gbuffer['pixels']] = np.clip(shaded, 0, 1)
+        return dict(gbuffer['aovs'], color=color.reshape(height, width, 3))
+
+    def render_to_image(self):
+        """
+        Renders to an image, like Renderer.render_to_image.
+        :return: (H, W, 3) image of rendered scene.
+        """
+        return self.render()['color']
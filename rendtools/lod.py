@@ -0,0 +1,67 @@
+import numpy as np
+
+# Largest geometric error of a selected level, in pixels.
+DEFAULT_PIXEL_ERROR = 1.0
+
+
+def bounding_sphere(vertices):
+    """
+    :return: (center, radius) of a sphere around the bounding box of
+             vertices.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+    if len(vertices) == 0:
+        return np.zeros(3), 0.0
+    center = (vertices.min(axis=0) + vertices.max(axis=0)) / 2
+    return center, float(np.sqrt(np.max(
+        np.sum((vertices - center) ** 2, axis=1))))
+
+
+def pixels_per_unit(camera, height, center, radius):
+    """
+    Upper bound of the on-screen size, in pixels, of a unit length inside a
+    bounding sphere, from its nearest distance to the camera.
+    :param height: image height in pixels.
+    """
+    focal = camera.perspective_mat()[1, 1] * height / 2
+    distance = np.linalg.norm(camera.cam_pos() - center) - radius
+    return abs(focal) / max(distance, camera.near, 1e-6)
+
+
+class LODSet:
+    """
+    Renderables of one scene part at decreasing levels of detail, see
+    meshtools.lod. All levels share the uv transform of level 0, so changes
+    to it apply whichever level is drawn.
+    """
+
+    def __init__(self, renderables, errors, center, radius):
+        """
+        :param renderables: one Renderable per level, finest first.
+        :param errors: geometric error of each level in world units.
+        :param center: center of the bounding sphere of the part.
+        :param radius: radius of the bounding sphere of the part.
+        """
+        self.renderables = renderables
+        self.errors = np.asarray(errors, dtype=np.float64)
+        self.center = np.asarray(center, dtype=np.float64)
+        self.radius = radius
+        self.level = 0
+        for renderable in renderables[1:]:
+            renderable.uv_scale = renderables[0].uv_scale
+            renderable.uv_offset = renderables[0].uv_offset
+
+    def __len__(self):
+        return len(self.renderables)
+
+    def select(self, camera, height, pixel_error=DEFAULT_PIXEL_ERROR):
+        """
+        Picks the coarsest level whose error projects to at most pixel_error
+        pixels for camera.
+        :param height: image height in pixels.
+        :return: the Renderable of that level.
+        """
+        scale = pixels_per_unit(camera, height, self.center, self.radius)
+        fine_enough = np.flatnonzero(self.errors * scale <= pixel_error)
+        self.level = int(fine_enough[-1]) if len(fine_enough) > 0 else 0
+        return self.renderables[self.level]
@@ -1,10 +1,17 @@
+import logging
 import os
 from string import Template
 
 import numpy as np
-from vispy.gloo import Texture2D
+from vispy.gloo import Texture2D, get_current_canvas
 
-from .core import Program
+import proftools
+from svbrdf.compact import COMPACT_DTYPE, compact_maps
+from svbrdf.lab import cached_lab_stats, normalized_lab
+from . import shading
+from .core import Program, program_cache
+
+logger = logging.getLogger(__name__)
 
 _package_dir = os.path.dirname(os.path.realpath(__file__))
 _shader_dir = os.path.join(_package_dir, 'shaders')
@@ -24,8 +31,28 @@ class Material:
     def update_uniforms(self, program):
         raise NotImplementedError
 
-    def compile(self, num_lights):
-        program = self.program_tmpl.compile(num_lights)
+    def shader_params(self):
+        """
+        Returns extra template substitutions for the shaders.
+        """
+        return {}
+
+    def shade(self, positions, normals, tangents, bitangents, uvs, lights,
+              cam_pos):
+        """
+        Shades surface samples on the CPU like the fragment shader does.
+        :return: (N, 3) float32 fragment colors.
+        """
+        raise NotImplementedError
+
+    def compile(self, num_lights, cache=None):
+        """
+        :param cache: ProgramCache to take the program from, the shared
+                      program_cache by default.
+        """
+        cache = program_cache if cache is None else cache
+        program = cache.get(*self.program_tmpl.sources(
+            num_lights, **self.shader_params()), num_lights=num_lights)
         program = self.update_uniforms(program)
         return program
 
@@ -39,6 +66,12 @@ class PhongMaterial(Material):
         self.spec_color = spec_color
         self.shininess = shininess
 
+    def shade(self, positions, normals, tangents, bitangents, uvs, lights,
+              cam_pos):
+        return shading.shade_phong(positions, normals, self.diff_color,
+                                   self.spec_color, self.shininess, lights,
+                                   cam_pos)
+
     def update_uniforms(self, program):
         program['u_diff'] = self.diff_color
         program['u_spec'] = self.spec_color
@@ -46,27 +79,140 @@ class PhongMaterial(Material):
         return program
 
 
+class _HostMaps:
+    """
+    Exposes a material's host maps with the attribute names of an SVBRDF.
+    """
+
+    def __init__(self, maps, alpha):
+        self.diffuse_map = maps['diffuse']
+        self.specular_map = maps['specular']
+        self.normal_map = maps['normal']
+        self.spec_shape_map = maps['spec_shape']
+        self.alpha = alpha
+
+
+_NORMAL_LOOKUP = 'texture2D(normal_map, v_uv).rgb'
+_COMPACT_NORMAL_LOOKUP = 'oct_decode(texture2D(normal_map, v_uv).rg)'
+
+
+# Maps are uploaded this many pixels at a time, so only one chunk at a time
+# is widened to float32.
+_UPLOAD_CHUNK_PIXELS = 1 << 20
+
+
+def _upload_texture(data, chunk_pixels=_UPLOAD_CHUNK_PIXELS, **kwargs):
+    """
+    Creates a Texture2D for a map and uploads it in chunks of rows. gloo only
+    uploads 32 bit floats, compact maps are stored as half floats on the GPU
+    through the internal format. With a current canvas each chunk is flushed
+    to GL before the next one is converted; otherwise gloo queues the chunks
+    until the texture is first drawn.
+    :param kwargs: passed to Texture2D.
+    """
+    shape = data.shape if data.ndim == 3 else data.shape + (1,)
+    texture = Texture2D(shape=shape, **kwargs)
+    canvas = get_current_canvas()
+    step = max(1, chunk_pixels // max(1, shape[1]))
+    for start in range(0, shape[0], step):
+        chunk = data[start:start + step].astype(np.float32)
+        proftools.count('texture_upload_bytes', chunk.nbytes)
+        texture.set_data(chunk.reshape((len(chunk),) + shape[1:]),
+                         offset=(start, 0))
+        if canvas is not None:
+            canvas.context.glir.associate(texture.glir)
+            canvas.context.flush_commands()
+    return texture
+
+
+@proftools.traced('texture_upload')
+def _svbrdf_textures(maps, compact):
+    """
+    Creates the textures of an SVBRDF material from its maps.
+    :param maps: dict with 'diffuse', 'specular', 'normal' and 'spec_shape'
+                 maps, in the compact format if compact is True.
+    """
+    if compact:
+        color_format = 'rgb16f'
+        normal_format, normal_internalformat = 'rg', 'rg16f'
+    else:
+        color_format = 'rgb32f'
+        normal_format, normal_internalformat = 'rgb', 'rgb32f'
+
+    return (
+        _upload_texture(maps['diffuse'],
+                        interpolation='linear',
+                        wrapping='repeat',
+                        internalformat=color_format),
+        _upload_texture(maps['specular'],
+                        interpolation='linear',
+                        wrapping='repeat',
+                        internalformat=color_format),
+        _upload_texture(maps['spec_shape'],
+                        wrapping='repeat',
+                        internalformat=color_format),
+        _upload_texture(maps['normal'],
+                        interpolation='linear',
+                        wrapping='repeat',
+                        format=normal_format,
+                        internalformat=normal_internalformat),
+    )
+
+
+def _material_maps(svbrdf, compact, diffuse_map=None):
+    """
+    Returns the host maps of a material and whether they are compact.
+    :param compact: see SVBRDFMaterial.
+    """
+    if compact is None:
+        compact = svbrdf.compact
+    if svbrdf.compact and not compact:
+        raise ValueError('An SVBRDF loaded with compact=True can only be used '
+                         'by compact materials.')
+    if diffuse_map is None:
+        diffuse_map = svbrdf.diffuse_map
+    if compact:
+        return compact_maps(svbrdf, diffuse_map=diffuse_map), True
+    return {
+        'diffuse': diffuse_map,
+        'specular': svbrdf.specular_map,
+        'normal': svbrdf.normal_map,
+        'spec_shape': svbrdf.spec_shape_map,
+    }, False
+
+
 class SVBRDFMaterial(Material):
-    def __init__(self, svbrdf):
+    def __init__(self, svbrdf, compact=None, gl=True):
+        """
+        :param compact: if True, keep half precision host copies of the maps
+                        (see svbrdf.compact) and store the textures as half
+                        floats with an octahedral-encoded normal map. The
+                        full precision maps are only dropped from memory if
+                        the SVBRDF itself was loaded with compact=True.
+                        Defaults to the compact flag of the SVBRDF.
+        :param gl: if False, only keep the host maps for shade, without
+                   creating textures.
+        """
         super().__init__(_load_shader('default.vert.glsl'),
                          _load_shader('svbrdf.frag.glsl'),
                          has_texture=True)
         self.alpha = svbrdf.alpha
-        self.diff_map = Texture2D(svbrdf.diffuse_map,
-                                  interpolation='linear',
-                                  wrapping='repeat',
-                                  internalformat='rgb32f')
-        self.spec_map = Texture2D(svbrdf.specular_map,
-                                  interpolation='linear',
-                                  wrapping='repeat',
-                                  internalformat='rgb32f')
-        self.spec_shape_map = Texture2D(svbrdf.spec_shape_map,
-                                        wrapping='repeat',
-                                        internalformat='rgb32f')
-        self.normal_map = Texture2D(svbrdf.normal_map,
-                                    interpolation='linear',
-                                    wrapping='repeat',
-                                    internalformat='rgb32f')
+        self.host_maps, self.compact = _material_maps(svbrdf, compact)
+        (self.diff_map, self.spec_map, self.spec_shape_map,
+         self.normal_map) = (_svbrdf_textures(self.host_maps, self.compact)
+                             if gl else (None,) * 4)
+
+    def shader_params(self):
+        return {'normal_lookup': (_COMPACT_NORMAL_LOOKUP if self.compact
+                                  else _NORMAL_LOOKUP)}
+
+    def shade(self, positions, normals, tangents, bitangents, uvs, lights,
+              cam_pos):
+        radiance = shading.shade_svbrdf(
+            positions, normals, tangents, bitangents, uvs,
+            _HostMaps(self.host_maps, self.alpha), lights, cam_pos,
+            octahedral_normals=self.compact)
+        return shading.rough_gamma(radiance)
 
     def update_uniforms(self, program):
         program['alpha'] = self.alpha
@@ -79,36 +225,47 @@ class SVBRDFMaterial(Material):
 
 class SVBRDFColorTransferMaterial(Material):
 
-    def __init__(self, svbrdf):
+    def __init__(self, svbrdf, compact=None, gl=True):
+        """
+        :param compact: see SVBRDFMaterial.
+        :param gl: see SVBRDFMaterial.
+        """
         super().__init__(_load_shader('default.vert.glsl'),
                          _load_shader('svbrdf_colortransfer.frag.glsl'),
                          has_texture=True)
-        from skimage import color
-        print('Converting diffuse map to Lab')
-        diff_map_lab = np.clip(svbrdf.diffuse_map, 0, 1)
-        diff_map_lab = color.rgb2lab(diff_map_lab).astype(dtype=np.float32)
-        self.diff_map_mean = diff_map_lab.mean(axis=(0, 1))
-        self.diff_map_std = diff_map_lab.std(axis=(0, 1))
-        diff_map_lab = (diff_map_lab - self.diff_map_mean) / self.diff_map_std
+        logger.info('Converting diffuse map to Lab')
+        self.diff_map_mean, self.diff_map_std = cached_lab_stats(svbrdf)
+        # Compact materials write the Lab map straight into half floats.
+        lab_dtype = (COMPACT_DTYPE if svbrdf.compact or compact
+                     else np.float32)
+        diff_map_lab = normalized_lab(
+            svbrdf.diffuse_map, self.diff_map_mean, self.diff_map_std,
+            clip=True, out=np.empty(svbrdf.diffuse_map.shape[:2] + (3,),
+                                    dtype=lab_dtype))
         self.spec_scale = 1
         self.spec_shape_scale = 1
 
         self.alpha = svbrdf.alpha
-        self.diff_map = Texture2D(diff_map_lab,
-                                  interpolation='linear',
-                                  wrapping='repeat',
-                                  internalformat='rgb32f')
-        self.spec_map = Texture2D(svbrdf.specular_map,
-                                  interpolation='linear',
-                                  wrapping='repeat',
-                                  internalformat='rgb32f')
-        self.spec_shape_map = Texture2D(svbrdf.spec_shape_map,
-                                        wrapping='repeat',
-                                        internalformat='rgb32f')
-        self.normal_map = Texture2D(svbrdf.normal_map,
-                                    interpolation='linear',
-                                    wrapping='repeat',
-                                    internalformat='rgb32f')
+        self.host_maps, self.compact = _material_maps(
+            svbrdf, compact, diffuse_map=diff_map_lab)
+        (self.diff_map, self.spec_map, self.spec_shape_map,
+         self.normal_map) = (_svbrdf_textures(self.host_maps, self.compact)
+                             if gl else (None,) * 4)
+
+    def shader_params(self):
+        return {'normal_lookup': (_COMPACT_NORMAL_LOOKUP if self.compact
+                                  else _NORMAL_LOOKUP)}
+
+    def shade(self, positions, normals, tangents, bitangents, uvs, lights,
+              cam_pos):
+        radiance = shading.shade_svbrdf(
+            positions, normals, tangents, bitangents, uvs,
+            _HostMaps(self.host_maps, self.alpha), lights, cam_pos,
+            diffuse_lab_stats=(self.diff_map_mean, self.diff_map_std),
+            spec_scale=self.spec_scale,
+            spec_shape_scale=self.spec_shape_scale,
+            octahedral_normals=self.compact)
+        return shading.rough_gamma(radiance)
 
     def update_uniforms(self, program):
         program['alpha'] = self.alpha
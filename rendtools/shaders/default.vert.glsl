@@ -2,6 +2,8 @@
 uniform mat4 u_view_mat;
 uniform mat4 u_model_mat;
 uniform mat4 u_perspective_mat;
+uniform vec2 u_uv_scale;
+uniform vec2 u_uv_offset;
 attribute vec3 a_position;
 attribute vec2 a_uv;
 attribute vec3 a_normal;
@@ -20,5 +22,5 @@ void main() {
     v_normal = a_normal;
     v_tangent = a_tangent;
     v_bitangent = a_bitangent;
-    v_uv  = a_uv;
+    v_uv  = a_uv * u_uv_scale + u_uv_offset;
 }
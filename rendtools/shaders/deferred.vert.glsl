@@ -0,0 +1,8 @@
+#version 120
+attribute vec2 a_screen;
+varying vec2 v_screen_uv;
+
+void main() {
+    v_screen_uv = a_screen * 0.5 + 0.5;
+    gl_Position = vec4(a_screen, 0.0, 1.0);
+}
@@ -0,0 +1,24 @@
+#version 120
+
+varying vec3 v_position;
+varying vec3 v_normal;
+varying vec3 v_tangent;
+varying vec3 v_bitangent;
+varying vec2 v_uv;
+
+uniform int u_channel;
+uniform float u_material_id;
+
+void main() {
+    if (u_channel == 0) {
+        gl_FragColor = vec4(v_position, 1.0);
+    } else if (u_channel == 1) {
+        gl_FragColor = vec4(v_normal, 1.0);
+    } else if (u_channel == 2) {
+        gl_FragColor = vec4(v_tangent, 1.0);
+    } else if (u_channel == 3) {
+        gl_FragColor = vec4(v_bitangent, 1.0);
+    } else {
+        gl_FragColor = vec4(v_uv, u_material_id, 1.0);
+    }
+}
@@ -19,6 +19,16 @@ uniform vec3 light_color[$num_lights];
 const float NUM_LIGHTS = $num_lights;
 const float F0 = 0.04;
 
+// Inverse of the octahedral encoding used by compact normal maps.
+vec3 oct_decode(vec2 e) {
+    vec3 v = vec3(e.xy, 1.0 - abs(e.x) - abs(e.y));
+    if (v.z < 0.0) {
+        v.xy = (1.0 - abs(v.yx)) * vec2(v.x >= 0.0 ? 1.0 : -1.0,
+                                        v.y >= 0.0 ? 1.0 : -1.0);
+    }
+    return normalize(v);
+}
+
 void main() {
     vec3 alb_d = texture2D(diff_map, v_uv).rgb;
     vec3 alb_s = texture2D(spec_map, v_uv).rgb;
@@ -27,7 +37,7 @@ void main() {
     vec3 E = normalize(cam_pos - v_position);
 
     mat3 TBN = mat3(v_tangent, v_bitangent, v_normal);
-    vec3 N = normalize(TBN * texture2D(normal_map, v_uv).rgb);
+    vec3 N = normalize(TBN * $normal_lookup);
     mat3 R = mat3(0, 0, N.x,
                   0, 0, N.y,
                   -N.x, -N.y, 0);
@@ -24,6 +24,16 @@ uniform float spec_shape_scale;
 const float NUM_LIGHTS = $num_lights;
 const float F0 = 0.04;
 
+// Inverse of the octahedral encoding used by compact normal maps.
+vec3 oct_decode(vec2 e) {
+    vec3 v = vec3(e.xy, 1.0 - abs(e.x) - abs(e.y));
+    if (v.z < 0.0) {
+        v.xy = (1.0 - abs(v.yx)) * vec2(v.x >= 0.0 ? 1.0 : -1.0,
+                                        v.y >= 0.0 ? 1.0 : -1.0);
+    }
+    return normalize(v);
+}
+
 vec3 lab2xyz( vec3 c ) {
     float fy = ( c.x + 16.0 ) / 116.0;
     float fx = c.y / 500.0 + fy;
@@ -60,7 +70,7 @@ void main() {
     vec3 E = normalize(cam_pos - v_position);
 
     mat3 TBN = mat3(v_tangent, v_bitangent, v_normal);
-    vec3 N = normalize(TBN * texture2D(normal_map, v_uv).rgb);
+    vec3 N = normalize(TBN * $normal_lookup);
     mat3 R = mat3(0, 0, N.x,
                   0, 0, N.y,
                   -N.x, -N.y, 0);
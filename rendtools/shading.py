@@ -0,0 +1,222 @@
+import numpy as np
+
+from svbrdf.compact import octahedral_decode
+
+F0 = 0.04
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+
+def _normalized(vectors):
+    norm = np.sqrt(np.sum(vectors * vectors, axis=-1, keepdims=True))
+    return vectors / np.where(norm == 0, 1.0, norm)
+
+
+def _dot(a, b):
+    return np.sum(a * b, axis=-1)
+
+
+def sample_bilinear(texture, uv):
+    """
+    Samples a texture with linear interpolation and repeat wrapping, like a
+    Texture2D with interpolation='linear' and wrapping='repeat'. Row 0 of the
+    array is at v = 0.
+    :param texture: (H, W, C) or (H, W) array.
+    :param uv: (N, 2) texture coordinates.
+    :return: (N, C) or (N,) float32 array.
+    """
+    height, width = texture.shape[:2]
+    x = uv[:, 0] * width - 0.5
+    y = uv[:, 1] * height - 0.5
+    x0 = np.floor(x)
+    y0 = np.floor(y)
+    fx = (x - x0).astype(np.float32)
+    fy = (y - y0).astype(np.float32)
+    x0 = x0.astype(np.int64) % width
+    y0 = y0.astype(np.int64) % height
+    x1 = (x0 + 1) % width
+    y1 = (y0 + 1) % height
+    if texture.ndim == 3:
+        fx = fx[:, None]
+        fy = fy[:, None]
+    top = texture[y0, x0] * (1 - fx) + texture[y0, x1] * fx
+    bottom = texture[y1, x0] * (1 - fx) + texture[y1, x1] * fx
+    return (top * (1 - fy) + bottom * fy).astype(np.float32, copy=False)
+
+
+def sample_nearest(texture, uv):
+    """
+    Samples a texture with nearest interpolation and repeat wrapping.
+    :param texture: (H, W, C) or (H, W) array.
+    :param uv: (N, 2) texture coordinates.
+    :return: (N, C) or (N,) float32 array.
+    """
+    height, width = texture.shape[:2]
+    x = np.floor(uv[:, 0] * width).astype(np.int64) % width
+    y = np.floor(uv[:, 1] * height).astype(np.int64) % height
+    return texture[y, x].astype(np.float32, copy=False)
+
+
+def lab_to_rgb(lab):
+    """
+    Converts CIE Lab to sRGB exactly like lab2rgb in
+    svbrdf_colortransfer.frag.glsl.
+    :param lab: (N, 3) array.
+    :return: (N, 3) float32 array.
+    """
+    fy = (lab[:, 0] + 16.0) / 116.0
+    fx = lab[:, 1] / 500.0 + fy
+    fz = fy - lab[:, 2] / 200.0
+
+    def _finv(f):
+        return np.where(f > 0.206897, f * f * f, (f - 16.0 / 116.0) / 7.787)
+
+    xyz = np.stack((95.047 * _finv(fx),
+                    100.000 * _finv(fy),
+                    108.883 * _finv(fz)), axis=1)
+    # GLSL 'v * M' multiplies the row vector by M.
+    xyz_to_rgb = np.array([[3.2406, -1.5372, -0.4986],
+                           [-0.9689, 1.8758, 0.0415],
+                           [0.0557, -0.2040, 1.0570]], dtype=np.float32)
+    v = xyz / 100.0 @ xyz_to_rgb.T
+    return np.where(v > 0.0031308,
+                    1.055 * np.power(np.maximum(v, 0.0031308), 1.0 / 2.4)
+                    - 0.055,
+                    12.92 * v).astype(np.float32)
+
+
+def _shade_svbrdf_chunk(positions, normals, tangents, bitangents, alb_d,
+                        alb_s, specv, normal_sample, lights, cam_pos, alpha):
+    E = _normalized(cam_pos[None, :] - positions)
+    N = _normalized(tangents * normal_sample[:, 0, None]
+                    + bitangents * normal_sample[:, 1, None]
+                    + normals * normal_sample[:, 2, None])
+    Nx, Ny, Nz = N[:, 0], N[:, 1], N[:, 2]
+
+    total_radiance = np.zeros_like(positions)
+    for light in lights:
+        L = np.asarray(light.position, dtype=np.float32)[None, :] - positions
+        D2 = _dot(L, L)
+        L = L / np.sqrt(D2)[:, None]
+        H = _normalized(L + E)
+
+        # Halfway vector in normal-oriented coordinates (so normal is
+        # [0,0,1]), R is the skew matrix of the shader.
+        RH = np.stack((-Nx * H[:, 2], -Ny * H[:, 2],
+                       Nx * H[:, 0] + Ny * H[:, 1]), axis=1)
+        RRH = np.stack((-Nx * RH[:, 2], -Ny * RH[:, 2],
+                        Nx * RH[:, 0] + Ny * RH[:, 1]), axis=1)
+        Hn = H + RH + RRH / (Nz + 1.0)[:, None]
+        Hnp = Hn[:, :2] / Hn[:, 2, None]
+
+        HnpW = np.stack((specv[:, 0] * Hnp[:, 0] + specv[:, 2] * Hnp[:, 1],
+                         specv[:, 2] * Hnp[:, 0] + specv[:, 1] * Hnp[:, 1]),
+                        axis=1)
+        # pow() of a negative base is undefined in GLSL, clamp it to zero.
+        with np.errstate(over='ignore'):
+            spec = np.exp(-np.power(np.maximum(_dot(HnpW, Hnp), 0),
+                                    alpha * 0.5))
+        cosine = np.maximum(0.0, _dot(N, L))
+
+        fres = F0 + (1 - F0) * np.power(1.0 - np.maximum(0, _dot(H, E)),
+                                        5.0)  # Schlick
+        spec = spec * fres / F0
+        spec = spec / _dot(H, L)  # From Brady et al. model A
+
+        radiance = ((spec[:, None] * alb_s + alb_d)
+                    * (cosine / D2 * light.intensity)[:, None]
+                    * np.asarray(light.color, dtype=np.float32)[None, :])
+        total_radiance += radiance
+    return total_radiance
+
+
+def shade_svbrdf(positions, normals, tangents, bitangents, uvs, svbrdf,
+                 lights, cam_pos, alpha=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 out=None, diffuse_lab_stats=None, spec_scale=1.0,
+                 spec_shape_scale=1.0, octahedral_normals=False):
+    """
+    Shades surface samples with the SVBRDF model of svbrdf.frag.glsl.
+    Samples are processed in chunks, so memory stays bounded for millions of
+    samples.
+    :param positions, normals, tangents, bitangents: (N, 3) world space
+                                                     arrays.
+    :param uvs: (N, 2) texture coordinates.
+    :param svbrdf: object with diffuse_map, specular_map, normal_map,
+                   spec_shape_map and alpha, e.g. an SVBRDF.
+    :param lights: list of Light.
+    :param cam_pos: camera position in world space.
+    :param alpha: overrides svbrdf.alpha.
+    :param out: optional (N, 3) float32 output array.
+    :param diffuse_lab_stats: (mean, std) if the diffuse map holds normalized
+                              Lab values, as for svbrdf_colortransfer.
+    :param spec_scale, spec_shape_scale: multipliers of the specular albedo
+                                         and spec-shape maps.
+    :param octahedral_normals: True if the normal map is octahedral-encoded,
+                               as in svbrdf.compact.
+    :return: (N, 3) float32 linear radiance, see rough_gamma.
+    """
+    alpha = svbrdf.alpha if alpha is None else alpha
+    cam_pos = np.asarray(cam_pos, dtype=np.float32)
+    num_samples = len(positions)
+    if out is None:
+        out = np.empty((num_samples, 3), dtype=np.float32)
+
+    for start in range(0, num_samples, chunk_size):
+        chunk = slice(start, min(start + chunk_size, num_samples))
+        uv = uvs[chunk]
+        alb_d = sample_bilinear(svbrdf.diffuse_map, uv)
+        if diffuse_lab_stats is not None:
+            mean, std = diffuse_lab_stats
+            alb_d = lab_to_rgb(alb_d * std + mean)
+        alb_s = sample_bilinear(svbrdf.specular_map, uv) * spec_scale
+        specv = sample_nearest(svbrdf.spec_shape_map, uv) * spec_shape_scale
+        normal_sample = sample_bilinear(svbrdf.normal_map, uv)
+        if octahedral_normals:
+            normal_sample = octahedral_decode(normal_sample)
+        out[chunk] = _shade_svbrdf_chunk(
+            positions[chunk], normals[chunk], tangents[chunk],
+            bitangents[chunk], alb_d, alb_s, specv, normal_sample, lights,
+            cam_pos, alpha)
+    return out
+
+
+def shade_phong(positions, normals, diff_color, spec_color, shininess,
+                lights, cam_pos, chunk_size=DEFAULT_CHUNK_SIZE, out=None):
+    """
+    Shades surface samples with the model of phong.frag.glsl.
+    :return: (N, 3) float32 color.
+    """
+    diff_color = np.asarray(diff_color, dtype=np.float32)[None, :]
+    spec_color = np.asarray(spec_color, dtype=np.float32)[None, :]
+    cam_pos = np.asarray(cam_pos, dtype=np.float32)
+    num_samples = len(positions)
+    if out is None:
+        out = np.empty((num_samples, 3), dtype=np.float32)
+
+    for start in range(0, num_samples, chunk_size):
+        chunk = slice(start, min(start + chunk_size, num_samples))
+        position = positions[chunk]
+        normal = normals[chunk]
+        view_dir = _normalized(cam_pos[None, :] - position)
+        color = np.zeros_like(position)
+        for light in lights:
+            light_dir = _normalized(
+                np.asarray(light.position, dtype=np.float32)[None, :]
+                - position)
+            ndotl = _dot(normal, light_dir)
+            refl_dir = _normalized(2.0 * ndotl[:, None] * normal - light_dir)
+            rdotv = _dot(refl_dir, view_dir)
+
+            Id = diff_color * ndotl[:, None]
+            Is = spec_color * np.power(np.maximum(rdotv, 0),
+                                       shininess)[:, None]
+            color += (np.asarray(light.color, dtype=np.float32)[None, :]
+                      * light.intensity / 2000 * (Id + Is))
+        out[chunk] = color
+    return out
+
+
+def rough_gamma(radiance):
+    """
+    Applies the rough gamma (square root) the SVBRDF shaders output.
+    """
+    return np.sqrt(np.maximum(radiance, 0))
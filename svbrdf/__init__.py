@@ -1,9 +1,15 @@
+import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from skimage import io as imio
-from skimage import color
 
+from proftools import span
 from . import io
+from .compact import COMPACT_DTYPE, compact_map
+from .lab import transfer_colors
 
 MAP_DIFF_FNAME = 'map_diff.pfm'
 MAP_SPEC_FNAME = 'map_spec.pfm'
@@ -11,42 +17,116 @@ MAP_NORMAL_FNAME = 'map_normal.pfm'
 MAP_SPEC_SHAPE_FNAME = 'map_spec_shape.pfm'
 MAP_PARAMS_FNAME = 'map_params.dat'
 
+logger = logging.getLogger(__name__)
+
 def transfer_color(source, target):
-    source_lab = color.rgb2lab(source)
-    target_lab = color.rgb2lab(target)
-    source_mean = source_lab.mean(axis=(0,1))
-    source_std = source_lab.std(axis=(0,1))
-    target_mean = target_lab.mean(axis=(0,1))
-    target_std = target_lab.std(axis=(0,1))
-    target_new = (target_lab - target_mean) * source_std / target_std + source_mean
-    return np.clip(color.lab2rgb(target_new), 0, 1)
+    """
+    Transfers the color distribution of source to target, see
+    lab.transfer_colors for many targets.
+    :return: (H, W, 3) float32 image in [0, 1].
+    """
+    return next(transfer_colors(source, [target]))
+
+
+def _map_property(name):
+    def getter(self):
+        if name not in self._maps:
+            self._load_map(name)
+        return self._maps[name]
+
+    def setter(self, value):
+        self._maps[name] = value
+
+    return property(getter, setter)
 
 
 class SVBRDF:
-    def __init__(self, path):
+    map_fnames = {
+        'diffuse': MAP_DIFF_FNAME,
+        'specular': MAP_SPEC_FNAME,
+        'normal': MAP_NORMAL_FNAME,
+        'spec_shape': MAP_SPEC_SHAPE_FNAME,
+    }
+
+    def __init__(self, path, lazy=False, mmap=False, compact=False,
+                 read_only=False, num_workers=4, executor=None):
+        """
+        :param path: SVBRDF capture directory.
+        :param lazy: if True, only read the map headers now and load each map
+                     on first access.
+        :param mmap: if True, maps are read-only memory-mapped views.
+        :param compact: if True, convert each map to the compact format of
+                        svbrdf.compact as it is read and keep only that, so
+                        the normal map holds octahedral coordinates.
+        :param read_only: if True, mark maps read-only as they are loaded.
+        :param num_workers: number of threads reading maps concurrently.
+        :param executor: executor to read the maps on instead of a pool of
+                         num_workers threads, so several loads can share a
+                         bound on threads. Must not be called from one of
+                         its own threads.
+        """
         if not os.path.exists(path):
             raise FileNotFoundError('The path {} does not exist'.format(path))
 
         path = os.path.join(path, 'out/reverse')
+        self.path = path
+        self.mmap = mmap
+        self.compact = compact
+        self.read_only = read_only
 
         with open(os.path.join(path, MAP_PARAMS_FNAME), 'r') as f:
             line = f.readline()
             self.alpha, _ = [float(i) for i in line.split(' ')]
 
-        print('Loading diffuse map.')
-        self.diffuse_map = io.load_pfm_texture(
-            os.path.join(path, MAP_DIFF_FNAME))
-
-        print('Loading specular map.')
-        self.specular_map = io.load_pfm_texture(
-            os.path.join(path, MAP_SPEC_FNAME))
-        # self.specular_map[:, :, :] = self.specular_map.mean()
-        print('Loading normal map.')
-        self.normal_map = io.load_pfm_texture(
-            os.path.join(path, MAP_NORMAL_FNAME))
-        print('Loading specular shape map.')
-        self.spec_shape_map = io.load_pfm_texture(
-            os.path.join(path, MAP_SPEC_SHAPE_FNAME))
-
-        print('Loaded SVBRDF with width={}, height={}, alpha={}'.format(
-            self.diffuse_map.shape[0], self.diffuse_map.shape[1], self.alpha))
+        self.map_paths = {name: os.path.join(path, fname)
+                          for name, fname in self.map_fnames.items()}
+        self.map_headers = {name: io.read_pfm_header(map_path)
+                            for name, map_path in self.map_paths.items()}
+        self.width = self.map_headers['diffuse'].width
+        self.height = self.map_headers['diffuse'].height
+        self._maps = {}
+        # Seconds spent reading each map.
+        self.load_times = {}
+
+        if not lazy:
+            if executor is not None:
+                list(executor.map(self._load_map, self.map_fnames))
+            elif num_workers > 1:
+                with ThreadPoolExecutor(max_workers=num_workers) as pool:
+                    list(pool.map(self._load_map, self.map_fnames))
+            else:
+                for name in self.map_fnames:
+                    self._load_map(name)
+            # self.specular_map[:, :, :] = self.specular_map.mean()
+
+        logger.info('Loaded SVBRDF with width=%d, height=%d, alpha=%s',
+                    self.width, self.height, self.alpha)
+
+    diffuse_map = _map_property('diffuse')
+    specular_map = _map_property('specular')
+    normal_map = _map_property('normal')
+    spec_shape_map = _map_property('spec_shape')
+
+    def _load_map(self, name):
+        logger.info('Loading %s map.', name.replace('_', ' '))
+        start_time = time.perf_counter()
+        with span('SVBRDF.load_map', map=name):
+            data = io.load_pfm_texture(self.map_paths[name], mmap=self.mmap)
+            if self.compact:
+                data = compact_map(name, data)
+            if self.read_only:
+                data.setflags(write=False)
+            self._maps[name] = data
+        self.load_times[name] = time.perf_counter() - start_time
+
+    def map_nbytes(self, name):
+        """
+        :return: size in bytes of a map, whether it is loaded yet or not.
+        """
+        if name in self._maps:
+            return self._maps[name].nbytes
+        header = self.map_headers[name]
+        channels = 2 if self.compact and name == 'normal' else header.channels
+        itemsize = np.dtype(COMPACT_DTYPE if self.compact
+                            else np.float32).itemsize
+        return header.width * header.height * channels * itemsize
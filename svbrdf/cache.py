@@ -0,0 +1,118 @@
+import os
+import threading
+from collections import OrderedDict
+
+from . import MAP_PARAMS_FNAME, SVBRDF
+
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+
+
+def _file_stamps(path):
+    """
+    Returns the resolved capture path and the (size, mtime) stamps of every
+    file an SVBRDF reads, which together identify its contents.
+    """
+    path = os.path.realpath(path)
+    map_dir = os.path.join(path, 'out/reverse')
+    stamps = []
+    for fname in [MAP_PARAMS_FNAME] + sorted(SVBRDF.map_fnames.values()):
+        stat = os.stat(os.path.join(map_dir, fname))
+        stamps.append((fname, stat.st_size, stat.st_mtime_ns))
+    return path, tuple(stamps)
+
+
+def _svbrdf_nbytes(svbrdf):
+    # Lazy maps count with their loaded size, so the total does not change
+    # as they are read.
+    return sum(svbrdf.map_nbytes(name) for name in svbrdf.map_fnames)
+
+
+class SVBRDFCache:
+    """
+    Process-wide LRU cache of loaded SVBRDFs, keyed by resolved path, the
+    size/mtime stamps of its files and the lazy, mmap and compact options
+    it was loaded with. Cached maps are shared between callers and marked
+    read-only. Least recently
+    used SVBRDFs are dropped once the total size of cached maps exceeds
+    max_bytes.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def get(self, path, **kwargs):
+        """
+        Returns the cached SVBRDF for path, loading it on a miss.
+        :param kwargs: passed to SVBRDF when loading, read_only is always
+                       set.
+        """
+        key = _file_stamps(path) + tuple(
+            bool(kwargs.get(name, False))
+            for name in ('lazy', 'mmap', 'compact'))
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Concurrent requests for the same SVBRDF wait for a single load.
+        with key_lock:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._entries[key]
+                self.misses += 1
+
+            try:
+                svbrdf = SVBRDF(path, **dict(kwargs, read_only=True))
+                with self._lock:
+                    self._entries[key] = svbrdf
+                    self.nbytes += _svbrdf_nbytes(svbrdf)
+                    self._evict()
+            finally:
+                with self._lock:
+                    self._key_locks.pop(key, None)
+        return svbrdf
+
+    def _evict(self):
+        # The most recently inserted entry is always kept.
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, svbrdf = self._entries.popitem(last=False)
+            self.nbytes -= _svbrdf_nbytes(svbrdf)
+            self.evictions += 1
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+default_cache = SVBRDFCache()
+
+
+def get_svbrdf(path, **kwargs):
+    """
+    Returns a shared, read-only SVBRDF from the process-wide cache.
+    """
+    return default_cache.get(path, **kwargs)
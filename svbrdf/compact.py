@@ -0,0 +1,110 @@
+import numpy as np
+
+COMPACT_DTYPE = np.float16
+# Pixels converted at a time, bounding the float32 temporaries.
+DEFAULT_CHUNK_PIXELS = 1 << 20
+
+
+def octahedral_encode(normals):
+    """
+    Encodes unit vectors as two-channel octahedral coordinates in [-1, 1].
+    :param normals: (..., 3) array, need not be normalized.
+    :return: (..., 2) array.
+    """
+    normals = np.asarray(normals, dtype=np.float32)
+    l1_norm = np.sum(np.abs(normals), axis=-1, keepdims=True)
+    l1_norm[l1_norm == 0] = 1.0
+    encoded = normals[..., :2] / l1_norm
+    lower = normals[..., 2] < 0
+    folded = encoded[lower]
+    signs = np.where(folded >= 0, 1.0, -1.0)
+    encoded[lower] = (1.0 - np.abs(folded[:, ::-1])) * signs
+    return encoded
+
+
+def octahedral_decode(encoded):
+    """
+    Decodes two-channel octahedral coordinates into unit vectors.
+    :param encoded: (..., 2) array.
+    :return: (..., 3) float32 array.
+    """
+    encoded = np.asarray(encoded, dtype=np.float32)
+    z = 1.0 - np.abs(encoded[..., 0]) - np.abs(encoded[..., 1])
+    xy = encoded.copy()
+    lower = z < 0
+    folded = xy[lower]
+    signs = np.where(folded >= 0, 1.0, -1.0)
+    xy[lower] = (1.0 - np.abs(folded[:, ::-1])) * signs
+    decoded = np.concatenate((xy, z[..., None]), axis=-1)
+    return decoded / np.linalg.norm(decoded, axis=-1, keepdims=True)
+
+
+def compact_map(name, data, chunk_pixels=DEFAULT_CHUNK_PIXELS):
+    """
+    Converts one SVBRDF map to the compact storage format, rows at a time.
+    :param name: map name, the 'normal' map is octahedral-encoded.
+    :return: COMPACT_DTYPE array of the shape of data, with 2 channels for
+             the normal map.
+    """
+    channels = (2,) if name == 'normal' else data.shape[2:]
+    out = np.empty(data.shape[:2] + channels, dtype=COMPACT_DTYPE)
+    step = max(1, chunk_pixels // max(1, data.shape[1]))
+    for start in range(0, data.shape[0], step):
+        rows = slice(start, start + step)
+        out[rows] = (octahedral_encode(data[rows]) if name == 'normal'
+                     else data[rows])
+    return out
+
+
+def compact_maps(svbrdf, diffuse_map=None):
+    """
+    Converts the maps of an SVBRDF to the compact storage format: half
+    precision albedos and spec-shape, and an octahedral-encoded two-channel
+    half precision normal map. Maps of an SVBRDF loaded with compact=True
+    already are in this format and are returned as they are.
+    :param diffuse_map: map to use instead of the SVBRDF's diffuse map.
+    :return: dict with 'diffuse', 'specular', 'normal' and 'spec_shape'.
+    """
+    if diffuse_map is None:
+        diffuse_map = svbrdf.diffuse_map
+    maps = {
+        'diffuse': diffuse_map,
+        'specular': svbrdf.specular_map,
+        'normal': svbrdf.normal_map,
+        'spec_shape': svbrdf.spec_shape_map,
+    }
+    if svbrdf.compact:
+        maps['diffuse'] = diffuse_map.astype(COMPACT_DTYPE, copy=False)
+        return maps
+    return {name: compact_map(name, data) for name, data in maps.items()}
+
+
+def compact_report(svbrdf):
+    """
+    Measures the memory saved and the error introduced by compact_maps.
+    :return: dict mapping map name to a dict with 'float32_bytes',
+             'compact_bytes', 'max_error' and 'rms_error'. Normal map errors
+             are angles in degrees, other errors are absolute differences.
+    """
+    if svbrdf.compact:
+        raise ValueError('compact_report needs an SVBRDF with full precision '
+                         'maps, not one loaded with compact=True.')
+    maps = compact_maps(svbrdf)
+    report = {}
+    for name, compact in maps.items():
+        original = getattr(svbrdf, name + '_map')
+        if name == 'normal':
+            reference = original / np.linalg.norm(original, axis=-1,
+                                                   keepdims=True)
+            cosines = np.sum(octahedral_decode(compact) * reference, axis=-1)
+            error = np.degrees(np.arccos(np.clip(cosines, -1.0, 1.0)))
+        else:
+            error = np.abs(compact.astype(np.float32) - original)
+        report[name] = {
+            'float32_bytes': original.nbytes,
+            'compact_bytes': compact.nbytes,
+            'max_error': float(error.max()),
+            'rms_error': float(np.sqrt(np.mean(np.square(error,
+                                                         dtype=np.float64)))),
+        }
+    return report
@@ -1,40 +1,207 @@
+import logging
+import os
+from collections import namedtuple
+
 import numpy as np
 
+from proftools import count, span
+
 HEADER_MAGIC = 'PF'
+HEADER_MAGIC_GRAYSCALE = 'Pf'
+
+logger = logging.getLogger(__name__)
+
+PFMHeader = namedtuple('PFMHeader',
+                       ['width', 'height', 'channels', 'dtype', 'offset'])
 
 
 def _print_debug(header_magic, width, height, tex):
-    print('magic={}, width={}, height={},'
-          'min=({:.2f}, {:.2f}, {:.2f}),'
-          'max=({:.2f}, {:.2f}, {:.2f}),'
-          'mean=({:.2f}, {:.2f}, {:.2f})'.format(
-        header_magic, width, height,
-        tex[:, :, 0].min(), tex[:, :, 1].min(), tex[:, :, 2].min(),
-        tex[:, :, 0].max(), tex[:, :, 1].max(), tex[:, :, 2].max(),
-        tex[:, :, 0].mean(), tex[:, :, 1].mean(), tex[:, :, 2].mean())
-    )
-
-
-def load_pfm_texture(filename: str):
+    logger.debug('magic=%s, width=%d, height=%d, '
+                 'min=(%.2f, %.2f, %.2f), '
+                 'max=(%.2f, %.2f, %.2f), '
+                 'mean=(%.2f, %.2f, %.2f)',
+                 header_magic, width, height,
+                 tex[:, :, 0].min(), tex[:, :, 1].min(), tex[:, :, 2].min(),
+                 tex[:, :, 0].max(), tex[:, :, 1].max(), tex[:, :, 2].max(),
+                 tex[:, :, 0].mean(), tex[:, :, 1].mean(),
+                 tex[:, :, 2].mean())
+
+
+def read_pfm_header(filename: str):
+    """
+    Parses and validates the header of a PFM file without reading pixels.
+    :return: PFMHeader with the image size, channel count, the dtype of the
+             pixel data (byte order given by the sign of the scale) and the
+             byte offset of the pixel data.
+    """
     with open(filename, 'rb') as f:
         header_magic = f.readline().decode().strip()
-        header_dims = f.readline().decode().strip()
-        _ = f.readline().decode()
-        width, height = [int(i) for i in header_dims.split(' ')]
-        tex = np.fromfile(f, dtype=np.float32)
-        dims = int(len(tex) / width / height)
-        tex = np.squeeze(tex.reshape((height, width, dims)))
+        if header_magic == HEADER_MAGIC:
+            channels = 3
+        elif header_magic == HEADER_MAGIC_GRAYSCALE:
+            channels = 1
+        else:
+            raise ValueError('{} is not a PFM file (magic {!r}).'.format(
+                filename, header_magic))
+        width, height = [int(i) for i in f.readline().decode().split()]
+        scale = float(f.readline().decode())
+        offset = f.tell()
+
+    dtype = np.dtype('<f4' if scale < 0 else '>f4')
+    expected_size = width * height * channels * dtype.itemsize
+    payload_size = os.path.getsize(filename) - offset
+    if payload_size != expected_size:
+        raise ValueError(
+            '{} has {} bytes of pixel data but a {}x{}x{} image needs '
+            '{}.'.format(filename, payload_size, width, height, channels,
+                         expected_size))
+    return PFMHeader(width, height, channels, dtype, offset)
+
+
+def load_pfm_texture(filename: str, mmap=False, flip=False):
+    """
+    Loads a PFM file.
+    :param mmap: if True, return a read-only view of a memory map of the file
+                 instead of reading it into memory. The view keeps the byte
+                 order of the file.
+    :param flip: if True, flip rows so the first row is the top of the image
+                 (PFM stores rows bottom to top).
+    :return: (height, width, 3) or (height, width) float32 array.
+    """
+    with span('load_pfm', path=filename, mmap=mmap):
+        header = read_pfm_header(filename)
+        shape = (header.height, header.width, header.channels)
+        if mmap:
+            tex = np.memmap(filename, dtype=header.dtype, mode='r',
+                            offset=header.offset, shape=shape)
+        else:
+            with open(filename, 'rb') as f:
+                f.seek(header.offset)
+                tex = np.fromfile(f, dtype=header.dtype,
+                                  count=int(np.prod(shape)))
+            count('bytes_read', tex.nbytes)
+            tex = tex.astype(np.float32, copy=False).reshape(shape)
+    tex = np.squeeze(tex, axis=2) if header.channels == 1 else tex
+    if flip:
+        tex = tex[::-1]
+    return tex
 
+
+def pfm_tiles(width, height, tile_size):
+    """
+    Generates the rectangles of a tile grid covering a width x height image.
+    :param tile_size: tile edge length, or a (tile_width, tile_height) pair.
+    :return: generator of (x, y, width, height) rectangles, edge tiles may be
+             smaller than tile_size.
+    """
+    if np.isscalar(tile_size):
+        tile_size = (tile_size, tile_size)
+    tile_width, tile_height = tile_size
+    for y in range(0, height, tile_height):
+        for x in range(0, width, tile_width):
+            yield (x, y, min(tile_width, width - x),
+                   min(tile_height, height - y))
+
+
+def read_pfm_region(filename: str, x, y, width, height, flip=False,
+                    header=None):
+    """
+    Reads a rectangular region of a PFM file without reading the rest.
+    :param x, y: top left corner of the region, in the row order returned by
+                 load_pfm_texture with the same flip argument.
+    :param header: PFMHeader of the file, read if not given.
+    :return: (height, width, 3) or (height, width) float32 array.
+    """
+    if header is None:
+        header = read_pfm_header(filename)
+    if (x < 0 or y < 0 or width <= 0 or height <= 0
+            or x + width > header.width or y + height > header.height):
+        raise ValueError('Region ({}, {}, {}, {}) is outside the {}x{} '
+                         'image.'.format(x, y, width, height, header.width,
+                                         header.height))
+
+    # Rows are stored bottom to top, so a top-down region starts further
+    # down the file.
+    first_row = header.height - y - height if flip else y
+    pixel_size = header.channels * header.dtype.itemsize
+    row_size = header.width * pixel_size
+    tex = np.empty((height, width, header.channels), dtype=header.dtype)
+    with open(filename, 'rb') as f:
+        if width == header.width:
+            f.seek(header.offset + first_row * row_size)
+            num_read = f.readinto(tex)
+        else:
+            num_read = 0
+            for i in range(height):
+                f.seek(header.offset + (first_row + i) * row_size
+                       + x * pixel_size)
+                num_read += f.readinto(tex[i])
+    count('bytes_read', num_read)
+    if num_read != tex.nbytes:
+        raise ValueError('{} ended before the end of the region.'.format(
+            filename))
+
+    tex = tex.astype(np.float32, copy=False)
+    tex = np.squeeze(tex, axis=2) if header.channels == 1 else tex
+    if flip:
+        tex = tex[::-1]
     return tex
 
 
+def iter_pfm_tiles(filename: str, tile_size=1024, flip=False):
+    """
+    Streams a PFM file tile by tile so only one tile is in memory at a time.
+    :param tile_size: tile edge length, or a (tile_width, tile_height) pair.
+                      Tiles spanning the full width are read with a single
+                      contiguous read.
+    :return: generator of (x, y, tile) with coordinates as in
+             read_pfm_region.
+    """
+    header = read_pfm_header(filename)
+    for x, y, width, height in pfm_tiles(header.width, header.height,
+                                         tile_size):
+        yield x, y, read_pfm_region(filename, x, y, width, height,
+                                    flip=flip, header=header)
+
+
+def pfm_channel_stats(filename: str, tile_rows=256):
+    """
+    Computes per-channel min, max and mean of a PFM file in bounded memory.
+    :return: (min, max, mean) arrays with one value per channel.
+    """
+    header = read_pfm_header(filename)
+    channel_min = np.full(header.channels, np.inf)
+    channel_max = np.full(header.channels, -np.inf)
+    channel_sum = np.zeros(header.channels)
+    for _, _, tile in iter_pfm_tiles(filename, (header.width, tile_rows)):
+        tile = tile.reshape(-1, header.channels)
+        channel_min = np.minimum(channel_min, tile.min(axis=0))
+        channel_max = np.maximum(channel_max, tile.max(axis=0))
+        channel_sum += tile.sum(axis=0, dtype=np.float64)
+    return (channel_min, channel_max,
+            channel_sum / (header.width * header.height))
+
+
 def save_pfm_texture(filename: str, tex: np.ndarray):
+    """
+    :param tex: (height, width) or (height, width, 1) grayscale or
+                (height, width, 3) color texture.
+    """
+    channels = 1 if tex.ndim == 2 else tex.shape[-1]
+    if tex.ndim not in (2, 3) or channels not in (1, 3):
+        raise ValueError('PFM files hold 1 or 3 channels, got an array of '
+                         'shape {}.'.format(tex.shape))
     if tex.dtype != np.float32:
-        print('Input is not 32 bit precision: converting to 32 bits.')
+        logger.warning('Input is not 32 bit precision: converting to 32 '
+                       'bits.')
         tex = tex.astype(np.float32)
     height, width = tex.shape[0], tex.shape[1]
+    if channels == 1:
+        header_magic = HEADER_MAGIC_GRAYSCALE
+    else:
+        header_magic = HEADER_MAGIC
     with open(filename, 'wb+') as f:
-        f.write('{}\n'.format(HEADER_MAGIC).encode())
+        f.write('{}\n'.format(header_magic).encode())
         f.write('{} {}\n'.format(width, height).encode())
         f.write('-1.0\n'.encode())
-        f.write(tex.tobytes())
+        f.write(tex.astype('<f4', copy=False).tobytes())
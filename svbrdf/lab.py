@@ -0,0 +1,209 @@
+import json
+import logging
+import os
+import uuid
+
+import numpy as np
+
+from proftools import span, traced
+
+# Pixels converted at once, bounding the temporaries of a conversion.
+DEFAULT_CHUNK_PIXELS = 1024 * 1024
+LAB_STATS_FNAME = 'map_diff_lab_stats.json'
+
+# sRGB (D65) to XYZ and back, and the D65 white point, as in skimage.color.
+_XYZ_FROM_RGB = np.array([[0.412453, 0.357580, 0.180423],
+                          [0.212671, 0.715160, 0.072169],
+                          [0.019334, 0.119193, 0.950227]], dtype=np.float32)
+_RGB_FROM_XYZ = np.linalg.inv(_XYZ_FROM_RGB.astype(np.float64)).astype(
+    np.float32)
+_WHITE = np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+
+logger = logging.getLogger(__name__)
+
+
+def rgb_to_lab(rgb, clip=False):
+    """
+    Converts sRGB to CIE Lab in float32, like skimage.color.rgb2lab.
+    :param rgb: (..., 3) array.
+    :param clip: if True, clip rgb to [0, 1] first.
+    :return: (..., 3) float32 array.
+    """
+    rgb = np.asarray(rgb, dtype=np.float32)
+    if clip:
+        rgb = np.clip(rgb, 0, 1)
+    linear = np.where(rgb > 0.04045,
+                      np.power((np.maximum(rgb, 0.04045) + 0.055) / 1.055,
+                               np.float32(2.4)),
+                      rgb / np.float32(12.92))
+    xyz = linear @ (_XYZ_FROM_RGB.T / _WHITE[None, :])
+    f = np.where(xyz > 0.008856, np.cbrt(xyz),
+                 np.float32(7.787) * xyz + np.float32(16.0 / 116.0))
+    fx, fy, fz = f[..., 0], f[..., 1], f[..., 2]
+    return np.stack((116.0 * fy - 16.0, 500.0 * (fx - fy),
+                     200.0 * (fy - fz)), axis=-1).astype(np.float32,
+                                                        copy=False)
+
+
+def lab_to_rgb(lab):
+    """
+    Converts CIE Lab to sRGB in float32, like skimage.color.lab2rgb but
+    without clipping the result.
+    :param lab: (..., 3) array.
+    :return: (..., 3) float32 array.
+    """
+    lab = np.asarray(lab, dtype=np.float32)
+    fy = (lab[..., 0] + 16.0) / 116.0
+    fx = fy + lab[..., 1] / 500.0
+    fz = np.maximum(fy - lab[..., 2] / 200.0, 0)
+    f = np.stack((fx, fy, fz), axis=-1)
+    xyz = np.where(f > 0.2068966, f * f * f,
+                   (f - np.float32(16.0 / 116.0)) / np.float32(7.787))
+    linear = (xyz * _WHITE) @ _RGB_FROM_XYZ.T
+    return np.where(linear > 0.0031308,
+                    1.055 * np.power(np.maximum(linear, 0.0031308),
+                                     np.float32(1.0 / 2.4)) - 0.055,
+                    12.92 * linear).astype(np.float32, copy=False)
+
+
+class RunningStats:
+    """
+    Per-channel mean and standard deviation accumulated over chunks of
+    samples in a single pass (Welford's algorithm, with Chan et al.'s
+    update for merging whole chunks).
+    """
+
+    def __init__(self, num_channels):
+        self.count = 0
+        self.mean = np.zeros(num_channels)
+        self._m2 = np.zeros(num_channels)
+
+    def update(self, values):
+        """
+        :param values: (N, num_channels) samples.
+        """
+        count = len(values)
+        if count == 0:
+            return
+        mean = values.mean(axis=0, dtype=np.float64)
+        m2 = np.sum(np.square(values - mean), axis=0)
+        delta = mean - self.mean
+        total = self.count + count
+        self.mean = self.mean + delta * (count / total)
+        self._m2 = self._m2 + m2 + delta ** 2 * (self.count * count / total)
+        self.count = total
+
+    @property
+    def variance(self):
+        return self._m2 / max(self.count, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+def _row_chunks(image, chunk_pixels):
+    height, width = image.shape[:2]
+    rows = max(1, chunk_pixels // max(width, 1))
+    for start in range(0, height, rows):
+        yield slice(start, min(start + rows, height))
+
+
+@traced()
+def lab_stats(rgb, clip=False, chunk_pixels=DEFAULT_CHUNK_PIXELS):
+    """
+    Mean and standard deviation of an image in Lab, converted chunk by
+    chunk.
+    :param rgb: (H, W, 3) sRGB image, may be memory-mapped.
+    :param clip: see rgb_to_lab.
+    :return: (mean, std) float32 arrays of 3 values.
+    """
+    stats = RunningStats(3)
+    for rows in _row_chunks(rgb, chunk_pixels):
+        stats.update(rgb_to_lab(rgb[rows], clip).reshape(-1, 3))
+    return stats.mean.astype(np.float32), stats.std.astype(np.float32)
+
+
+@traced()
+def normalized_lab(rgb, mean, std, clip=False, out=None,
+                   chunk_pixels=DEFAULT_CHUNK_PIXELS):
+    """
+    Converts an image to Lab standardized by mean and std, chunk by chunk.
+    :param out: optional (H, W, 3) output array, float32 or a smaller float
+                type to store the result in.
+    :return: out, a (H, W, 3) float32 array by default.
+    """
+    if out is None:
+        out = np.empty(rgb.shape[:2] + (3,), dtype=np.float32)
+    for rows in _row_chunks(rgb, chunk_pixels):
+        out[rows] = (rgb_to_lab(rgb[rows], clip) - mean) / std
+    return out
+
+
+def _stats_stamp(path, clip):
+    stat = os.stat(path)
+    return [os.path.basename(path), stat.st_size, stat.st_mtime_ns,
+            bool(clip)]
+
+
+def cached_lab_stats(svbrdf, clip=True, chunk_pixels=DEFAULT_CHUNK_PIXELS):
+    """
+    Lab statistics of the diffuse map of an SVBRDF, see lab_stats. They are
+    stored in LAB_STATS_FNAME next to the maps and reused as long as the
+    diffuse map file keeps its size and modification time.
+    :return: (mean, std) float32 arrays of 3 values.
+    """
+    map_path = svbrdf.map_paths['diffuse']
+    stats_path = os.path.join(os.path.dirname(map_path), LAB_STATS_FNAME)
+    stamp = _stats_stamp(map_path, clip)
+    try:
+        with open(stats_path, 'r') as f:
+            cached = json.load(f)
+        if cached['stamp'] == stamp:
+            return (np.array(cached['mean'], dtype=np.float32),
+                    np.array(cached['std'], dtype=np.float32))
+    except (OSError, ValueError, KeyError):
+        pass
+
+    mean, std = lab_stats(svbrdf.diffuse_map, clip, chunk_pixels)
+    tmp_path = '{}.tmp-{}'.format(stats_path, uuid.uuid4().hex)
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'stamp': stamp, 'mean': mean.tolist(),
+                       'std': std.tolist()}, f)
+        os.replace(tmp_path, stats_path)
+    except OSError:
+        # Read-only captures just recompute the statistics next time.
+        logger.warning('Could not write Lab statistics to %s', stats_path)
+    return mean, std
+
+
+def transfer_colors(source, targets, source_stats=None,
+                    chunk_pixels=DEFAULT_CHUNK_PIXELS):
+    """
+    Transfers the color distribution of one source image to many targets by
+    matching the per-channel mean and standard deviation in Lab (Reinhard
+    et al.). The source statistics are computed once, and each target is
+    converted in chunks of rows, so working memory stays bounded apart from
+    the outputs.
+    :param source: (H, W, 3) sRGB image.
+    :param targets: iterable of (H', W', 3) sRGB images.
+    :param source_stats: precomputed (mean, std) of the source in Lab, e.g.
+                         from cached_lab_stats.
+    :return: generator of (H', W', 3) float32 images in [0, 1], one per
+             target.
+    """
+    if source_stats is None:
+        source_stats = lab_stats(source, chunk_pixels=chunk_pixels)
+    source_mean, source_std = source_stats
+    for target in targets:
+        with span('transfer_colors.target'):
+            target_mean, target_std = lab_stats(target,
+                                                chunk_pixels=chunk_pixels)
+            scale = source_std / target_std
+            out = np.empty(target.shape[:2] + (3,), dtype=np.float32)
+            for rows in _row_chunks(target, chunk_pixels):
+                lab = (rgb_to_lab(target[rows]) - target_mean) * scale \
+                    + source_mean
+                out[rows] = np.clip(lab_to_rgb(lab), 0, 1)
+        yield out
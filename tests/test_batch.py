@@ -0,0 +1,50 @@
+import gc
+import os
+from collections import OrderedDict
+
+import pytest
+from vispy.gloo.globject import GLObject
+
+from benchmarks import synthetic
+from rendtools import batch
+from svbrdf import MAP_PARAMS_FNAME, SVBRDF
+
+
+@pytest.fixture
+def job(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, '_scenes', OrderedDict())
+    mesh_path = str(tmp_path / 'torus.obj')
+    synthetic.write_obj(mesh_path, 200)
+    map_dir = tmp_path / 'svbrdf' / 'out' / 'reverse'
+    map_dir.mkdir(parents=True)
+    for i, fname in enumerate(sorted(SVBRDF.map_fnames.values())):
+        synthetic.write_pfm(str(map_dir / fname), 32, 32, seed=i)
+    (map_dir / MAP_PARAMS_FNAME).write_text('10.0 0.0\n')
+    return {
+        'id': 'torus',
+        'mesh': mesh_path,
+        'materials': {'segment_0': {'type': 'svbrdf',
+                                    'path': str(tmp_path / 'svbrdf'),
+                                    'compact': True}},
+        'lights': [{'position': [0, 100, 100], 'intensity': 2000}],
+        'camera': {'fov': 40, 'position': [0, 50, 200]},
+        'size': [64, 48],
+    }
+
+
+def _queued_data():
+    """
+    :return: number of GL objects with texture or buffer data queued.
+    """
+    return sum(1 for obj in gc.get_objects()
+               if isinstance(obj, GLObject) and hasattr(obj, '_glir')
+               and any(command[0] in ('DATA', 'SIZE')
+                       for command in obj._glir._shared._commands))
+
+
+def test_render_job_queues_no_gl_data(job, tmp_path):
+    gc.collect()
+    queued = _queued_data()
+    batch.render_job(job, str(tmp_path))
+    assert os.path.exists(batch.output_path(str(tmp_path), job))
+    assert _queued_data() == queued
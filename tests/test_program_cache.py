@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from rendtools import core, materials
+from rendtools.core import ProgramCache, Renderable, reset_stats, stats
+from rendtools.gsd import GSDRenderer
+from rendtools.materials import SVBRDFMaterial
+
+
+class _StubProgram:
+    def __init__(self, vert_source, frag_source):
+        self.values = {}
+
+    def __setitem__(self, name, value):
+        self.values[name] = value
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def draw(self, *args, **kwargs):
+        pass
+
+
+class _StubBuffer:
+    def __init__(self, data=None, **kwargs):
+        self.data = data
+
+    def set_data(self, data, **kwargs):
+        self.data = data
+
+    def set_subdata(self, data, offset=0):
+        pass
+
+
+@pytest.fixture
+def stub_gloo(monkeypatch):
+    monkeypatch.setattr(core, 'gloo', SimpleNamespace(
+        Program=_StubProgram, VertexBuffer=_StubBuffer,
+        IndexBuffer=_StubBuffer))
+    monkeypatch.setattr(materials, 'Texture2D', _StubBuffer)
+    monkeypatch.setattr(materials, 'get_current_canvas', lambda: None)
+    reset_stats()
+    yield
+    reset_stats()
+
+
+def _svbrdf():
+    maps = np.full((4, 4, 3), 0.5, dtype=np.float32)
+    return SimpleNamespace(alpha=10.0, compact=False, diffuse_map=maps,
+                           specular_map=maps, normal_map=maps,
+                           spec_shape_map=maps)
+
+
+def _renderable(cache):
+    attributes = {name: np.zeros((3, 3), dtype=np.float32)
+                  for name in ('a_position', 'a_normal', 'a_tangent',
+                               'a_bitangent')}
+    attributes['a_uv'] = np.zeros((3, 2), dtype=np.float32)
+    return Renderable(SVBRDFMaterial(_svbrdf()), attributes, 2, cache)
+
+
+def test_update_reuses_program(stub_gloo):
+    renderable = _renderable(ProgramCache())
+    renderable.bind()
+    for _ in range(3):
+        renderable.update()
+        renderable.bind()
+    renderer = SimpleNamespace(scene=SimpleNamespace(
+        renderables=[renderable]), update=lambda: None)
+    GSDRenderer.update_alpha(renderer, 5.0)
+    renderable.bind()
+    assert stats['compilations'] == 1
+    assert renderable.program['alpha'] == 5.0
+
+
+def test_rebind_unchanged_sends_nothing(stub_gloo):
+    renderable = _renderable(ProgramCache())
+    renderable.bind()
+    uniform_uploads = stats['uniform_uploads']
+    attribute_binds = stats['attribute_binds']
+    renderable.bind()
+    assert stats['uniform_uploads'] == uniform_uploads
+    assert stats['attribute_binds'] == attribute_binds